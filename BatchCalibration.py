@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 12:29:53 2026
+
+@author: mtd
+"""
+
+import os
+import io
+import contextlib
+import warnings
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import pandas as pd
+from numpy import empty,nan
+
+from FlowLawCalibration import FlowLawCalibration
+
+class BatchCalibration:
+    # calibrate many flow laws at once, e.g. every variant on every gauged reach. each
+    #   job is a tuple (reach, variant, FlowLaw, Qtrue), where reach and variant are just
+    #   labels for the results. the jobs are independent, so they run on a pool of
+    #   processes. results come back in the order of the jobs
+
+    def __init__(self,D,jobs,nWorkers=None,chunksize=None,verbose=False,Scheduler=None,
+                 Cache=None):
+        """
+            D= Domain, used for the error stats
+            jobs= list of (reach, variant, FlowLaw, Qtrue) tuples. see MakeJobs
+            nWorkers= number of processes. None uses one per core, less any BLAS threads
+                each process is set up to use (see DefaultWorkers). 1 runs serially
+            chunksize= number of jobs sent to a process at a time. None picks one so
+                that each process gets about four chunks
+            verbose= show the printout of each calibration
+            Scheduler= a CalibrationScheduler to order the algorithms each calibration
+                tries. with one worker it is updated after each calibration. with a pool
+                each worker gets a copy of it as it is at the start, so the order is fixed
+                for the batch, and it is updated with the telemetry of the whole batch at 
+                the end. it is saved if it has a file
+            Cache= a ResultCache. jobs already in it are not rerun, and a job whose 
+                inputs have changed starts from the last calibration of its reach and 
+                variant
+        """
+        self.D=D
+        self.jobs=list(jobs)
+        self.nWorkers=nWorkers
+        self.chunksize=chunksize
+        self.verbose=verbose
+        self.Scheduler=Scheduler
+        self.Cache=Cache
+
+        self.results=None
+        self.telemetry=None
+
+    def Calibrate(self):
+        # run all of the jobs. self.results is a DataFrame with one row per job, in the
+        #   order of the jobs: reach, variant, params, success, method, cache_hit, time, Qhat,
+        #   then the error stats. self.telemetry has one row per optimize attempt; see TelemetrySummary
+
+        nWorkers=self.nWorkers or DefaultWorkers()
+        args=(repeat(self.D),[job[2] for job in self.jobs],[job[3] for job in self.jobs],
+              repeat(self.verbose),repeat(self.Scheduler),repeat(self.Cache),
+              [job[:2] for job in self.jobs])
+
+        if nWorkers == 1 or len(self.jobs) <= 1:
+            # the calibrations update the scheduler themselves
+            outputs=list(map(CalibrateJob,*args))
+        else:
+            chunksize=self.chunksize or max(1,len(self.jobs)//(4*nWorkers))
+            with BLASThreadEnviron(), ProcessPoolExecutor(max_workers=nWorkers,
+                                                          initializer=LimitBLASThreads) as pool:
+                outputs=list(pool.map(CalibrateJob,*args,chunksize=chunksize))
+
+            # each process had its own copy of the scheduler
+            if self.Scheduler is not None:
+                for job,output in zip(self.jobs,outputs):
+                    if output['telemetry']:
+                        self.Scheduler.Update(type(job[2]).__name__,output['telemetry'])
+
+        if self.Scheduler is not None and self.Scheduler.Filename is not None:
+            self.Scheduler.Save()
+
+        rows=[]
+        attempts=[]
+        for job,output in zip(self.jobs,outputs):
+            row={'reach':job[0],'variant':job[1]}
+            for i,record in enumerate(output.pop('telemetry')):
+                attempts.append(dict(row,attempt=i,**record))
+            row.update(output)
+            rows.append(row)
+
+        self.results=pd.DataFrame(rows)
+        self.telemetry=pd.DataFrame(attempts,columns=['reach','variant','attempt','method','nfev',
+                                                      'njev','time','objective','success',
+                                                      'status','message'])
+
+        return self.results
+
+    def TelemetrySummary(self,by=('variant','method')):
+        # totals over the attempts of the last Calibrate, grouped by the columns in by: 
+        #   number of attempts and successes, success rate, function and jacobian 
+        #   evaluations, and total and mean wall time in seconds
+        summary=self.telemetry.groupby(list(by)).agg(attempts=('success','size'),
+                                                      successes=('success','sum'),
+                                                      nfev=('nfev','sum'),
+                                                      njev=('njev','sum'),
+                                                      time=('time','sum'),
+                                                      mean_time=('time','mean'))
+        summary['success_rate']=summary['successes']/summary['attempts']
+        return summary
+
+def MakeJobs(Obs,Truth,FlowLawVariants,reaches=None):
+    # jobs for BatchCalibration: every variant in the dict FlowLawVariants, which maps
+    #   names to flow law classes, e.g. {'Constant-n':MWACN}, on every reach in reaches
+    #   (default all reaches) of the ReachObservations Obs, against the ReachTruth Truth
+    if reaches is None:
+        reaches=range(Obs.D.nR)
+
+    jobs=[]
+    for r in reaches:
+        for variant,FlowLaw in FlowLawVariants.items():
+            jobs.append( (r,variant,FlowLaw.FromReachObservations(Obs,r),Truth.Q[r,:]) )
+
+    return jobs
+
+def CalibrateJob(D,FlowLaw,Qtrue,verbose=False,Scheduler=None,Cache=None,CacheLabel=None):
+    # calibrate one flow law and return what BatchCalibration keeps. a failure in one
+    #   job is reported, not raised, so that it does not stop the rest of the batch
+
+    output={'params':None,'success':False,'method':None,'cache_hit':False,'time':0.,'Qhat':None,
+            'telemetry':[]}
+    try:
+        with warnings.catch_warnings(), contextlib.ExitStack() as stack:
+            warnings.simplefilter("ignore")
+            if not verbose:
+                stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            cal=FlowLawCalibration(D,Qtrue,FlowLaw)
+            t0=time.perf_counter()
+            cal.CalibrateReach(verbose=False,Scheduler=Scheduler,Cache=Cache,CacheLabel=CacheLabel)
+            output['time']=time.perf_counter()-t0
+    except Exception as err:
+        print('BatchCalibration: calibration of',type(FlowLaw).__name__,'failed with:',repr(err))
+        output['params']=empty(len(FlowLaw.GetInitParams()))
+        output['params'][:]=nan
+        return output
+
+    output['params']=cal.param_est
+    output['success']=bool(cal.success)
+    output['method']=cal.Method
+    output['cache_hit']=cal.CacheHit
+    output['telemetry']=cal.Telemetry
+    output['Qhat']=cal.Qhat
+    for stat,value in vars(cal.Performance).items():
+        if stat not in ('Qt','Qhat','D'):
+            output[stat]=value
+
+    return output
+
+# the environment variables that set the number of BLAS threads
+BLASThreadVars=('OMP_NUM_THREADS','OPENBLAS_NUM_THREADS','MKL_NUM_THREADS')
+
+def BLASThreads():
+    # number of BLAS threads the environment variables ask for, 1 if none are set
+    nthreads=1
+    for var in BLASThreadVars:
+        try:
+            nthreads=max(nthreads,int(os.environ.get(var,1)))
+        except ValueError:
+            pass
+    return nthreads
+
+def DefaultWorkers():
+    # one process per core. if BLAS has been told to use more than one thread, through
+    #   the usual environment variables, each process gets that many cores
+    return max(1,(os.cpu_count() or 1)//BLASThreads())
+
+@contextlib.contextmanager
+def BLASThreadEnviron():
+    # set the BLAS thread variables that are not set to 1 while a pool starts its 
+    #   processes, so that workers which load BLAS themselves (the spawn and forkserver
+    #   start methods) each use one thread rather than one per core
+    unset=[var for var in BLASThreadVars if var not in os.environ]
+    for var in unset:
+        os.environ[var]='1'
+    try:
+        yield
+    finally:
+        for var in unset:
+            os.environ.pop(var,None)
+
+def LimitBLASThreads():
+    # pool initializer. a forked worker has the BLAS of the parent, already loaded with
+    #   a thread per core, so it is limited here with threadpoolctl if that is 
+    #   installed, to the number of threads DefaultWorkers allowed for
+    for var in BLASThreadVars:
+        os.environ.setdefault(var,'1')
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(BLASThreads())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 12:37:18 2026
+
+@author: mtd
+"""
+
+import os
+import json
+import tempfile
+
+from FlowLawCalibration import DefaultStrategies
+
+class CalibrationScheduler:
+    # orders the strategies CalibrateReach tries, separately for each flow law, from how
+    #   often each strategy has worked for that law and how long it has taken. strategies
+    #   are tried in decreasing order of success rate per second, which minimizes the
+    #   expected time to the first success. the rates are smoothed towards 1/2, so that a
+    #   strategy with few attempts is neither ruled in nor out. until a flow law has
+    #   MinAttempts calibrations recorded, its strategies keep their given order. the
+    #   statistics can be kept in a json file, so they build up across runs.
+    #   the order only changes as calibrations are recorded in this object. a pooled 
+    #   BatchCalibration sends each worker a copy of the scheduler as it was at the start
+    #   of the batch, so the order is fixed for the whole batch; the batch's telemetry is
+    #   added afterwards, and changes the order for the next batch
+
+    def __init__(self,Filename=None,MinAttempts=5):
+        self.Filename=Filename
+        self.MinAttempts=MinAttempts
+
+        # stats[flow law class name][strategy name]= {'attempts','successes','time'}
+        self.stats={}
+        self.ncalibrations={}
+        if Filename is not None and os.path.exists(Filename):
+            self.Load()
+
+    def Order(self,FlowLawName,strategies):
+        # strategies, a list of CalibrateReach strategy dicts, in the order to try them for
+        #   the flow law class named FlowLawName, e.g. 'MWACN'
+        if self.ncalibrations.get(FlowLawName,0) < self.MinAttempts:
+            return list(strategies)
+
+        stats=self.stats.get(FlowLawName,{})
+        times=[stat['time']/stat['attempts'] for stat in stats.values() if stat['attempts'] > 0]
+        if not times:
+            return list(strategies)
+        default_time=sum(times)/len(times)
+
+        def Score(strategy):
+            stat=stats.get(strategy['name'],{'attempts':0,'successes':0,'time':0.})
+            rate=(stat['successes']+1.)/(stat['attempts']+2.)
+            if stat['attempts'] > 0:
+                seconds=stat['time']/stat['attempts']
+            else:
+                seconds=default_time
+            return rate/max(seconds,1e-6)
+
+        # sorted is stable, so ties keep the given order
+        return sorted(strategies,key=lambda strategy: -Score(strategy))
+
+    def Update(self,FlowLawName,telemetry,strategies=None):
+        # add the attempts of one calibration, i.e. FlowLawCalibration.Telemetry. only
+        #   attempts by the strategies CalibrateReach orders are recorded, by default 
+        #   those in DefaultStrategies; the others, e.g. polyfit or variable projection,
+        #   always run first. a calibration that did not get as far as the strategies
+        #   is not counted
+        names={strategy['name'] for strategy in (strategies or DefaultStrategies)}
+        records=[record for record in telemetry if record['method'] in names]
+        if not records:
+            return
+
+        stats=self.stats.setdefault(FlowLawName,{})
+        for record in records:
+            stat=stats.setdefault(record['method'],{'attempts':0,'successes':0,'time':0.})
+            stat['attempts']+=1
+            stat['successes']+=int(record['success'])
+            stat['time']+=float(record['time'])
+        self.ncalibrations[FlowLawName]=self.ncalibrations.get(FlowLawName,0)+1
+
+    def Load(self):
+        with open(self.Filename) as fid:
+            saved=json.load(fid)
+        self.stats=saved['stats']
+        self.ncalibrations=saved['ncalibrations']
+
+    def Save(self):
+        # write to a temporary file first, so a reader never sees a partial file
+        dirname=os.path.dirname(os.path.abspath(self.Filename))
+        fd,tmpname=tempfile.mkstemp(dir=dirname,suffix='.tmp')
+        with os.fdopen(fd,'w') as fid:
+            json.dump({'stats':self.stats,'ncalibrations':self.ncalibrations},fid,indent=1)
+        os.replace(tmpname,self.Filename)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 12:40:39 2026
+
+@author: mtd
+"""
+
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+from scipy import optimize
+from scipy.stats import norm
+from numpy import empty,nan,ones,sqrt,bincount,cov,percentile,clip,isfinite,array
+from numpy.random import default_rng
+
+class CalibrationUncertainty:
+    # parameter uncertainty of a calibrated flow law, by resampling the overpasses:
+    #   bootstrap (Method='bootstrap') or delete-one jackknife ('jackknife'). a replicate
+    #   is the full sample with each overpass weighted by the number of times it was drawn
+    #   (zero for the one left out of a jackknife replicate). weighting the residuals this
+    #   way is the same least-squares problem as calibrating to the resampled overpasses,
+    #   and it lets every replicate reuse the flow law as it is, with its observation
+    #   terms already computed. each replicate starts from the full-sample calibration
+
+    def __init__(self,cal,Method='bootstrap',nReplicates=200,nWorkers=1,seed=0,Alpha=0.05):
+        """
+            cal= a FlowLawCalibration that has been calibrated
+            Method= 'bootstrap' or 'jackknife'. a jackknife has one replicate per overpass
+            nReplicates= number of bootstrap replicates
+            nWorkers= number of processes. the flow law goes to each process once
+            seed= seed for drawing the bootstrap samples. each replicate draws its own, so
+                the results do not depend on nWorkers
+            Alpha= the intervals cover 1-Alpha
+        """
+        self.cal=cal
+        self.Method=Method
+        self.nReplicates=nReplicates
+        self.nWorkers=nWorkers
+        self.seed=seed
+        self.Alpha=Alpha
+
+    def Run(self):
+        # calibrate the replicates, then:
+        #   ParamReplicates= (nReplicates,nparams) parameters, nan where a replicate failed
+        #   ParamCov= parameter covariance matrix
+        #   ParamInterval= (2,nparams) lower and upper ends of the parameter intervals.
+        #       percentiles for a bootstrap; for a jackknife, normal intervals from ParamCov
+        #   QhatBand= (2,nt) lower and upper ends of the Qhat intervals, made the same way
+        cal=self.cal
+        if not cal.success:
+            print('CalibrationUncertainty: the calibration did not succeed. Nothing to resample')
+            return
+
+        nt=len(cal.Qtrue)
+        if self.Method == 'jackknife':
+            nReplicates=nt
+        else:
+            nReplicates=self.nReplicates
+
+        setup=(self.Method,cal.FlowLaw,cal.Qtrue,cal.GetParamBoundArrays(),
+               array(cal.param_est,dtype=float),self.seed)
+        if self.nWorkers == 1:
+            InitReplicates(*setup)
+            outputs=list(map(SolveReplicate,range(nReplicates)))
+        else:
+            nWorkers=self.nWorkers or os.cpu_count()
+            with ProcessPoolExecutor(max_workers=nWorkers,initializer=InitReplicates,
+                                     initargs=setup) as pool:
+                outputs=list(pool.map(SolveReplicate,range(nReplicates),
+                                      chunksize=max(1,nReplicates//(4*nWorkers))))
+
+        self.ParamReplicates=array([output[0] for output in outputs])
+        self.ReplicateSuccess=array([output[1] for output in outputs])
+        self.ParamReplicates[~self.ReplicateSuccess,:]=nan
+
+        ok=self.ParamReplicates[self.ReplicateSuccess,:]
+        if len(ok) < 2:
+            print('CalibrationUncertainty: fewer than two replicates succeeded')
+            self.ParamCov=self.ParamInterval=self.QhatBand=None
+            return
+
+        # all of the replicates' discharge in one pass
+        Qhat=cal.FlowLaw.CalcQ(ok)
+
+        tails=[100*self.Alpha/2,100*(1-self.Alpha/2)]
+        if self.Method == 'jackknife':
+            # jackknife variance: (n-1)/n times the sum of squared deviations
+            n=len(ok)
+            dev=ok-ok.mean(axis=0)
+            self.ParamCov=(n-1)/n*dev.T@dev
+            z=norm.ppf(1-self.Alpha/2)
+            halfwidth=z*sqrt(self.ParamCov.diagonal())
+            self.ParamInterval=array([cal.param_est-halfwidth,cal.param_est+halfwidth])
+            halfwidth=z*sqrt((n-1)/n*((Qhat-Qhat.mean(axis=0))**2).sum(axis=0))
+            self.QhatBand=array([cal.Qhat-halfwidth,cal.Qhat+halfwidth])
+        else:
+            self.ParamCov=cov(ok,rowvar=False).reshape(ok.shape[1],ok.shape[1])
+            self.ParamInterval=percentile(ok,tails,axis=0)
+            self.QhatBand=percentile(Qhat,tails,axis=0)
+
+# the state for SolveReplicate, set once per process by InitReplicates
+Replicates={}
+
+def InitReplicates(Method,FlowLaw,Qtrue,bounds,param_est,seed):
+    Replicates.update(Method=Method,FlowLaw=FlowLaw,Qtrue=array(Qtrue,dtype=float),
+                      bounds=bounds,param_est=clip(param_est,bounds[0],bounds[1]),seed=seed)
+
+def ReplicateWeights(i):
+    # square root of the weight of each overpass in replicate i
+    nt=len(Replicates['Qtrue'])
+    if Replicates['Method'] == 'jackknife':
+        weights=ones(nt)
+        weights[i]=0.
+    else:
+        rng=default_rng([Replicates['seed'],i])
+        weights=bincount(rng.integers(0,nt,nt),minlength=nt).astype(float)
+    return sqrt(weights)
+
+def SolveReplicate(i):
+    # calibrate replicate i, starting from the full-sample calibration. returns the
+    #   parameters and whether the solve succeeded
+    FlowLaw=Replicates['FlowLaw']
+    Qtrue=Replicates['Qtrue']
+    w=ReplicateWeights(i)
+
+    # least_squares asks for the jacobian at the point whose residuals it has just
+    #   computed, so keep the last one
+    last={'params':None}
+    def Eval(params):
+        if last['params'] is None or not (params == last['params']).all():
+            Qhat,res,sse,grad,JQ=FlowLaw.CalcObjective(params,Qtrue)
+            last.update(params=params.copy(),res=w*res,JQ=w[:,None]*JQ)
+        return last
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            res=optimize.least_squares(lambda params: Eval(params)['res'],
+                                       Replicates['param_est'],
+                                       bounds=Replicates['bounds'],
+                                       jac=lambda params: Eval(params)['JQ'])
+        except ValueError:
+            x=empty(len(Replicates['param_est']))
+            x[:]=nan
+            return x,False
+
+    return res.x,bool(res.success and isfinite(res.x).all())
@@ -6,7 +6,9 @@ Created on Thu Jan 14 22:11:07 2021
 @author: mtd
 """
 
-from numpy import concatenate, zeros, tril,ones
+from numpy import concatenate, zeros, tril,ones,reshape,cumsum
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator
 
 class Domain:
     def __init__(self,RiverData):
@@ -19,6 +21,8 @@ class Domain:
         
         
     def CalcU(self):
+        # dense version of U: (nR*nt) x (nR*(nt-1)). memory goes as nR^2*nt^2, 
+        #   so prefer CalcUOperator or CalcUSparse for anything but small domains
             
         M=self.nR * self.nt
         N=self.nR *(self.nt-1)
@@ -34,4 +38,38 @@ class Domain:
             d=(self.nt-1)*i+(self.nt-1)
             U[a:b,c:d  ] = u   
             
-        return U
\ No newline at end of file
+        return U
+
+    def CalcUSparse(self):
+        # same matrix as CalcU, stored as a scipy.sparse csr matrix. 
+        #   note each reach block is still lower-triangular, so nnz goes as nR*nt^2/2
+
+        u=sparse.vstack( (sparse.csr_matrix( (1,self.nt-1) ), sparse.tril(ones( (self.nt-1,self.nt-1) )) ) )
+
+        return sparse.kron(sparse.identity(self.nR),u,format='csr')
+
+    def CalcUOperator(self):
+        # matrix-free version of U: applying U is a cumulative sum along time for each
+        #   reach, with a zero in front; applying U' is a reversed cumulative sum. 
+        #   O(nR*nt) time and memory. supports U @ x, U.matvec, U.rmatvec and U.T @ y
+
+        nR=self.nR
+        nt=self.nt
+
+        def matmat(X):
+            k=X.shape[1]
+            X=reshape(X,(nR,nt-1,k))
+            Y=zeros( (nR,nt,k),dtype=X.dtype )
+            cumsum(X,axis=1,out=Y[:,1:,:])
+            return reshape(Y,(nR*nt,k))
+
+        def rmatmat(Y):
+            k=Y.shape[1]
+            Y=reshape(Y,(nR,nt,k))
+            X=cumsum(Y[:,:0:-1,:],axis=1)[:,::-1,:]
+            return reshape(X,(nR*(nt-1),k))
+
+        return LinearOperator( (nR*nt,nR*(nt-1)),
+                               matvec=lambda x: matmat(reshape(x,(-1,1))),
+                               rmatvec=lambda y: rmatmat(reshape(y,(-1,1))),
+                               matmat=matmat,rmatmat=rmatmat,dtype=float)
@@ -7,46 +7,104 @@ Created on Thu Jan 21 04:49:20 2021
 """
 
 from scipy import optimize
-from numpy import zeros,empty,nan,mean,log,exp,polyfit,array
+from scipy.stats import qmc
+from numpy import zeros,empty,nan,mean,log,exp,polyfit,array,array_equal,concatenate,clip,outer,inf,isfinite,errstate,\
+   where,argmin
 from ErrorStats import ErrorStats
 
 import matplotlib.pyplot as plt
 import warnings
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# bump this whenever a change to the flow laws or to the calibration changes its results,
+#   so that calibrations saved in a ResultCache are not reused
+CalibrationVersion=1
 
 class FlowLawCalibration:
-    def __init__(self,D,Qtrue,FlowLaw):
+    def __init__(self,D,Qtrue,FlowLaw,Logger=None):
+        # Logger= a logging.Logger to send the progress messages to, at level INFO. by
+        #   default they are printed
         self.D=D
         self.Qtrue=Qtrue
         self.FlowLaw=FlowLaw
+        self.Logger=Logger
         
         self.param_est=[]
         self.success=[]
         self.Qhat=[]
         self.Performance={}
+        self.Telemetry=[]
+        self.Method=None
+        self.CacheHit=False
 
-    def CalibrateReach(self,verbose=True,optmethod='L-BFGS-B',suppress_warnings=False):     
+    def CalibrateReach(self,verbose=True,optmethod='L-BFGS-B',suppress_warnings=False,VarPro=False,
+                       Strategies=None,Scheduler=None,init_params=None,Cache=None,CacheLabel=None):     
+        # VarPro= if the flow law is linear in its first parameter (FlowLaw.LinearParam), 
+        #   solve for that parameter inside the objective and optimize only the others
+        # Strategies= list of algorithms to try, in order, as in DefaultStrategies. 
+        #   'L-BFGS-B' in a strategy stands for optmethod
+        # Scheduler= a CalibrationScheduler to reorder the strategies for this flow law and
+        #   to record how they did
+        # init_params= parameters to start from instead of FlowLaw.GetInitParams, e.g. the
+        #   calibration of the same reach before its latest observations came in. if no 
+        #   algorithm works from there, the calibration starts again from GetInitParams
+        # Cache= a ResultCache. a calibration of the same flow law class, observations, 
+        #   Qtrue and settings as one already in the cache is not rerun
+        # CacheLabel= a name for this calibration that stays the same when its inputs 
+        #   change, e.g. (reach id, variant). with a Cache, the last calibration with this 
+        #   label is used as init_params when there is no exact match
   
         if suppress_warnings:
             warnings.filterwarnings("ignore")
         
+        self.ResParams=None
+        self.Telemetry=[]
+        self.Method=None
+        self.CacheHit=False
         self.success= zeros( 1, dtype=bool )
         self.Qhat=zeros( (1,self.D.nt) )    
 
-        init_params=self.FlowLaw.GetInitParams()
+        if Cache is not None:
+            config=(optmethod,VarPro,Strategies,Scheduler is not None)
+            key=self.CacheKey(Cache,config,init_params)
+            cached=Cache.Load(key)
+            if cached is not None:
+                self.SetCachedResult(cached)
+                self.Print('... found this calibration in the cache')
+                return
+
+            if CacheLabel is not None:
+                label_key=Cache.MakeKey('label',type(self.FlowLaw).__name__,CacheLabel,config)
+                if init_params is None:
+                    cached=Cache.Load(label_key)
+                    if cached is not None and cached['success']:
+                        init_params=cached['param_est']
+                        self.Print('... starting from the last calibration of',CacheLabel)
+
+        warm_start=init_params is not None
+        if not warm_start:
+            init_params=self.FlowLaw.GetInitParams()
         fl_param_bounds=self.FlowLaw.GetParamBounds()         
 
         # 1 first try for AHGW only, try using the numpy 'polyfit' function 
         self.success=False
         ls_success=False
         if self.FlowLaw.name ==  'AHGW':
+            t0=time.perf_counter()
             a,b=self.LeastSquaresFit(self.FlowLaw.W,self.Qtrue)
+            ls_ok=a >= fl_param_bounds[0][0] and a <= fl_param_bounds[0][1] \
+               and b >= fl_param_bounds[1][0] and b <= fl_param_bounds[1][1]
+            self.Telemetry.append({'method':'polyfit','nfev':0,'njev':0,
+                                   'time':time.perf_counter()-t0,'objective':nan,'success':ls_ok,
+                                   'status':int(ls_ok),'message':'' if ls_ok else 'out of bounds'})
 
-            if a >= fl_param_bounds[0][0] and a <= fl_param_bounds[0][1] \
-               and b >= fl_param_bounds[1][0] and b <= fl_param_bounds[1][1]:
-       
+            if ls_ok:
                ls_success=True
                self.success=True
-               print('... AHGW: polyfit worked!')
+               self.Method='polyfit'
+               self.Print('... AHGW: polyfit worked!')
  
         # intialize for other calibration
         np=len(init_params)
@@ -61,99 +119,78 @@ class FlowLawCalibration:
             lb[0]=fl_param_bounds[0]
             ub[0]=fl_param_bounds[1]
 
-        param_bounds=optimize.Bounds(lb,ub)
+        if warm_start:
+            init_params=clip(array(init_params,dtype=float).reshape(np),lb,ub)
 
-        # 2 try optimize 'least_squares' function
-        if not self.success:
-            res = optimize.least_squares(self.ObjectiveFuncRes,
-                                init_params,
+        # 2a with VarPro, first try 'least_squares' over the nonlinear parameters only, with
+        #   the linear one solved for inside the objective. if that does not give a usable
+        #   fit, e.g. when the best linear parameter is stuck on a bound, carry on with all 
+        #   parameters as usual
+        self.VarPro=VarPro and self.FlowLaw.LinearParam is not None and np > 1
+        if self.VarPro and not self.success:
+            self.LinearParamBounds=(lb[0],ub[0])
+            self.VPParams=None
+            res = self.Attempt('varpro least_squares',optimize.least_squares,self.ObjectiveFuncResVP,
+                                init_params[1:],
                                 args=([self.Qtrue]),
-                                bounds=param_bounds)
- 
-            if res.success:
-                print('... the least_squares solution worked')
-                self.success=True
- 
-        # 3 try the L-BFGS-B function
-        if not self.success:
-            print('... least_squares failed. Now trying with L-BFGS-B')
-            res = optimize.minimize(fun=self.ObjectiveFunc,
-                                x0=init_params,
-                                args=(self.Qtrue),
-                                bounds=param_bounds,
-                                method=optmethod,
-                                #jac=self.FlowLaw.Jacobian)
-                                jac='none')
-            if res.success:
-                print('... L-BFGS-B succeeded!')
-                self.success=True
+                                bounds=optimize.Bounds(lb[1:],ub[1:]),
+                                jac=self.ObjectiveFuncResJacVP)
+            params_vp=self.EvalResVP(res.x,self.Qtrue)[0]
 
-        if not self.success:
-            print('... default algo failed. trying with finite-difference jacobian')
-            res = optimize.minimize(fun=self.ObjectiveFunc,
-                                x0=init_params,
-                                args=(self.Qtrue),
-                                bounds=param_bounds,
-                                method=optmethod,
-                                jac='none')
-            if res.success:
-                print('... one of the backup algorithm succeeded!')
-                self.success=True
- 
-        if not self.success:
-            print('... default algo with f-d jacobian failed. trying another algorithm')
-            res = optimize.minimize(fun=self.ObjectiveFunc,
-                                x0=init_params,
-                                args=(self.Qtrue),
-                                bounds=param_bounds,
-                                method='trust-constr',
-                                jac='none')
-                                #jac=self.FlowLaw.Jacobian)
-            if res.success:
-                print('... one of the backup algorithm succeeded!')
+            if res.success and isfinite(params_vp).all() and isfinite(self.FlowLaw.CalcQ(params_vp)).all():
+                self.Print('... the variable projection least_squares solution worked')
                 self.success=True
-                            
+            else:
+                self.Telemetry[-1]['success']=False
+                self.Print('... variable projection failed. Now trying with all parameters')
+                self.VarPro=False
 
+        # 2 on to the general algorithms, in turn, until one works. by default this is 
+        #   least_squares, then the backups in DefaultStrategies. a strategy that would 
+        #   repeat an earlier one exactly is skipped
         if not self.success:
-            #retry with bounds required to stay feasible
-            param_bounds=optimize.Bounds(lb,ub,keep_feasible=True)
-            
-            res = optimize.minimize(fun=self.ObjectiveFunc,
-                                x0=init_params,
-                                args=(self.Qtrue),
-                                bounds=param_bounds,
-                                method=optmethod,
-                                #jac=self.FlowLaw.Jacobian,
-                                jac='none',
-                                options={'disp':verbose,'maxiter':1e4,'verbose':0})
-            if res.success:
-                print('... one of the backup algorithm succeeded!')
-                self.success=True
-        
-        if not self.success:
-             #retry with a larger step size
-             res = optimize.minimize(fun=self.ObjectiveFunc,
-                                x0=init_params,
-                                args=(self.Qtrue),
-                                bounds=param_bounds,
-                                method=optmethod,
-                                #jac=self.FlowLaw.Jacobian,
-                                jac='none',
-                                options={'disp':verbose,'maxiter':1e4,'verbose':0,'finite_diff_rel_step':1.0})
-             if res.success:
-                print('... one of the backup algorithm succeeded!')
-                self.success=True
+            strategies=UniqueStrategies(Strategies or DefaultStrategies,optmethod)
+            if Scheduler is not None:
+                strategies=Scheduler.Order(type(self.FlowLaw).__name__,strategies)
+
+            for i,strategy in enumerate(strategies):
+                res=self.RunStrategy(strategy,init_params,lb,ub,verbose)
+                if res.success:
+                    self.Print('... the',strategy['name'],'solution worked')
+                    self.success=True
+                    break
+                elif i+1 < len(strategies):
+                    self.Print('...',strategy['name'],'failed. Now trying',strategies[i+1]['name'])
 
         # ok done trying algorithms... 
         #self.success=res.success
+        if self.success and self.Method is None:
+            self.Method=self.Telemetry[-1]['method']
+
+        if not self.success and warm_start:
+            # the retry tries the strategies in the same order. the scheduler and the cache 
+            #   get the attempts from both starts, and the result, here
+            self.Print('... nothing worked from the warm start. Starting again from GetInitParams')
+            telemetry=self.Telemetry
+            self.CalibrateReach(verbose,optmethod,False,VarPro,strategies)
+            self.Telemetry=telemetry+self.Telemetry
+            if Scheduler is not None:
+                Scheduler.Update(type(self.FlowLaw).__name__,self.Telemetry,strategies)
+            if Cache is not None:
+                Cache.Save(key,self.GetCachedResult())
+                if CacheLabel is not None and self.success:
+                    Cache.Save(label_key,self.GetCachedResult())
+            return
 
         if not self.success:
-            print('FlowLawCalibration: Optimize Failed! Setting flow law parameters to nan')
+            self.Print('FlowLawCalibration: Optimize Failed! Setting flow law parameters to nan')
             self.param_est=empty( len(fl_param_bounds), )
             self.param_est[:]=nan
         else:
             if ls_success:
                 self.param_est=array([a,b])
+            elif self.VarPro:
+                self.param_est=params_vp
             else:
                 self.param_est=res.x
 
@@ -162,7 +199,169 @@ class FlowLawCalibration:
         self.Performance=ErrorStats(self.Qtrue,self.Qhat,self.D)
         self.Performance.CalcErrorStats()
 
+        if Scheduler is not None:
+            Scheduler.Update(type(self.FlowLaw).__name__,self.Telemetry,
+                             UniqueStrategies(Strategies or DefaultStrategies,optmethod))
+
+        if Cache is not None:
+            Cache.Save(key,self.GetCachedResult())
+            if CacheLabel is not None and self.success:
+                Cache.Save(label_key,self.GetCachedResult())
+
+    def CacheKey(self,Cache,config,init_params=None):
+        # everything a calibration depends on: the code version, the flow law class, its
+        #   observations, Qtrue, the settings and any warm start given by the caller
+        FlowLaw=self.FlowLaw
+        if init_params is not None:
+            init_params=array(init_params,dtype=float)
+        return Cache.MakeKey('calibration',CalibrationVersion,type(FlowLaw).__name__,FlowLaw.dA,FlowLaw.W,FlowLaw.S,
+                             FlowLaw.H,array(self.Qtrue,dtype=float),config,init_params)
+
+    def GetCachedResult(self):
+        return {'param_est':self.param_est,'success':bool(self.success),'Qhat':self.Qhat,
+                'Method':self.Method,'Telemetry':self.Telemetry}
+
+    def SetCachedResult(self,cached):
+        self.param_est=cached['param_est']
+        self.success=cached['success']
+        self.Qhat=cached['Qhat']
+        self.Method=cached['Method']
+        self.Telemetry=[]
+        self.CacheHit=True
+
+        self.Performance=ErrorStats(self.Qtrue,self.Qhat,self.D)
+        self.Performance.CalcErrorStats()
     
+    def CalibrateReachMultiStart(self,nStarts=16,nAgree=3,rtol=1e-6,Sampler='lhs',seed=0,
+                                 nWorkers=1,Spread=10.,verbose=False):
+        # calibrate from many starting points, rather than from GetInitParams only. the 
+        #   starts are GetInitParams plus nStarts-1 points drawn with a latin hypercube 
+        #   (Sampler='lhs') or a sobol sequence ('sobol') within FlowLaw.GetStartBounds. 
+        #   each start gets one bounded least_squares solve. once nAgree solves have 
+        #   reached the best objective found so far, to within rtol, the remaining starts
+        #   are dropped. with nWorkers other than 1 the starts run in batches of nWorkers
+        #   on a pool of processes (scipy's optimizers change the global warning filters, 
+        #   so they cannot share a process), and the results are taken in the order of 
+        #   the starts, so they are the same as with nWorkers=1.
+        #   this is the robust mode, not the fast one: it always runs at least nAgree 
+        #   solves, where CalibrateReach usually needs one, so on one core it takes a 
+        #   few times as long. it only keeps up in wall time with about nAgree workers.
+        #   self.MultiStartResults holds (start, params, objective, success) for each solve,
+        #   and self.Telemetry a record of each solve as in CalibrateReach
+
+        lb,ub=self.FlowLaw.GetStartBounds(Spread)
+        bounds=self.GetParamBoundArrays()
+
+        starts=array([self.FlowLaw.GetInitParams()]+list(DrawStarts(lb,ub,nStarts-1,Sampler,seed)))
+        # keep the starts inside the bounds the solver will use
+        starts=clip(starts,bounds[0],bounds[1])
+
+        setup=(self.FlowLaw,self.Qtrue,bounds)
+        results=[]
+        self.Telemetry=[]
+        self.Method=None
+        def done():
+            ok=[result for result in results if result[3]]
+            if len(ok) < nAgree:
+                return False
+            best=min(result[2] for result in ok)
+            return sum(result[2] <= best+rtol*abs(best) for result in ok) >= nAgree
+
+        def Take(outputs):
+            # add solves in the order of the starts, up to the one that settles it
+            for output in outputs:
+                *result,record=output
+                results.append(result)
+                self.Telemetry.append(record)
+                if done():
+                    return True
+            return False
+
+        # the flow law, Qtrue and bounds go to each worker once, not with every start
+        if nWorkers == 1:
+            InitMultiStart(*setup)
+            Take(LocalSolve(start) for start in starts)
+        else:
+            nWorkers=nWorkers or os.cpu_count()
+            with ProcessPoolExecutor(max_workers=nWorkers,initializer=InitMultiStart,
+                                     initargs=setup) as pool:
+                for i in range(0,len(starts),nWorkers):
+                    if Take(pool.map(LocalSolve,starts[i:i+nWorkers])):
+                        break
+
+        self.MultiStartResults=results
+        if verbose:
+            self.Print('... multi-start: ran',len(results),'of',len(starts),'starts')
+
+        ok=[result for result in results if result[3]]
+        self.success=len(ok) > 0
+        if self.success:
+            self.param_est=ok[argmin([result[2] for result in ok])][1]
+            self.Method='multi-start least_squares'
+        else:
+            self.Print('FlowLawCalibration: Optimize Failed! Setting flow law parameters to nan')
+            self.param_est=empty( len(lb), )
+            self.param_est[:]=nan
+
+        self.Qhat=self.FlowLaw.CalcQ(self.param_est)      
+        
+        self.Performance=ErrorStats(self.Qtrue,self.Qhat,self.D)
+        self.Performance.CalcErrorStats()
+
+    def RunStrategy(self,strategy,init_params,lb,ub,verbose=False):
+        # one attempt at the calibration with one of the strategies
+        param_bounds=optimize.Bounds(lb,ub,keep_feasible=strategy.get('keep_feasible',False))
+
+        if strategy['solver'] == 'least_squares':
+            self.ResParams=None
+            return self.Attempt(strategy['name'],optimize.least_squares,self.ObjectiveFuncResFused,
+                                init_params,
+                                args=([self.Qtrue]),
+                                bounds=param_bounds,
+                                jac=self.ObjectiveFuncResJac)
+
+        if strategy.get('jac',True):
+            fun,jac=self.ObjectiveFuncAndJac,True
+        else:
+            fun,jac=self.ObjectiveFunc,'none'
+
+        options=strategy.get('options')
+        if options is not None:
+            options=dict(options,disp=verbose)
+
+        return self.Attempt(strategy['name'],optimize.minimize,fun=fun,
+                            x0=init_params,
+                            args=(self.Qtrue),
+                            bounds=param_bounds,
+                            method=strategy['method'],
+                            jac=jac,
+                            options=options)
+
+    def Attempt(self,label,solver,*args,**kwargs):
+        # run one optimize call and add a record of it to self.Telemetry: method, number
+        #   of function and jacobian evaluations, wall time in seconds, final objective 
+        #   (sum of squared errors), success, status and message
+        t0=time.perf_counter()
+        res=solver(*args,**kwargs)
+        self.Telemetry.append(AttemptRecord(label,res,time.perf_counter()-t0))
+        return res
+
+    def Print(self,*args):
+        # progress messages go to self.Logger if there is one, otherwise to the screen
+        if self.Logger is None:
+            print(*args)
+        else:
+            self.Logger.info(' '.join(str(arg) for arg in args))
+
+    def GetParamBoundArrays(self):
+        # GetParamBounds as arrays of lower and upper bounds
+        fl_param_bounds=self.FlowLaw.GetParamBounds()
+        if len(self.FlowLaw.GetInitParams()) == 1:
+            fl_param_bounds=(fl_param_bounds,)
+        lb=array([bound[0] for bound in fl_param_bounds],dtype=float)
+        ub=array([bound[1] for bound in fl_param_bounds],dtype=float)
+        return lb,ub
+
     def ObjectiveFunc(self,params,Q):      
         Qhat=self.FlowLaw.CalcQ(params)
         y=sum((Qhat-Q)**2)
@@ -173,6 +372,76 @@ class FlowLawCalibration:
         y=Qhat-Q
         return y
 
+    def ObjectiveFuncJac(self,params,Q):
+        # gradient of ObjectiveFunc
+        return self.FlowLaw.Jacobian(params,Q)
+
+    def ObjectiveFuncAndJac(self,params,Q):
+        # ObjectiveFunc and its gradient from one pass, for minimize with jac=True
+        Qhat,res,sse,grad,JQ=self.FlowLaw.CalcObjective(params,Q)
+        return sse,grad
+
+    def EvalRes(self,params,Q):
+        # residuals and their jacobian from one pass. least_squares asks for the jacobian
+        #   at the point whose residuals it has just computed, so the last pair is kept
+        if self.ResParams is None or not array_equal(params,self.ResParams):
+            Qhat,res,sse,grad,JQ=self.FlowLaw.CalcObjective(params,Q)
+            self.ResParams=array(params,dtype=float)
+            self.ResEval=(res,JQ)
+        return self.ResEval
+
+    def ObjectiveFuncResFused(self,params,Q):
+        return self.EvalRes(params,Q)[0]
+
+    def ObjectiveFuncResJac(self,params,Q):
+        # jacobian of ObjectiveFuncRes: nt x nparams
+        return self.EvalRes(params,Q)[1]
+
+    def EvalResVP(self,params_nonlin,Q):
+        # variable projection. the flow law is Q=c*g(params_nonlin), where c is its first 
+        #   parameter (LinearParam='direct') or one over it (LinearParam='inverse'). for given
+        #   params_nonlin, the best c is the least squares c=g.Q/g.g, clipped to the bounds of
+        #   the first parameter. returns the full parameter vector, the residuals and their
+        #   jacobian with respect to params_nonlin, including the change in the best c
+        if self.VPParams is None or not array_equal(params_nonlin,self.VPParams):
+            g,JQ=self.FlowLaw.CalcQJacobianQ(concatenate(([1.],params_nonlin)))
+            G=JQ[:,1:]
+            gg=g @ g
+            c=(g @ Q)/gg
+
+            lb,ub=self.LinearParamBounds
+            if self.FlowLaw.LinearParam == 'inverse':
+                lb,ub=(1/ub if ub < inf else 0.), (1/lb if lb > 0 else inf)
+            cclip=clip(c,lb,ub)
+            if cclip == c:
+                dc=(G.T @ Q - 2*c*(G.T @ g))/gg
+            else:
+                dc=zeros(len(params_nonlin))
+
+            if self.FlowLaw.LinearParam == 'inverse':
+                with errstate(divide='ignore'):
+                    p0=1/cclip
+            else:
+                p0=cclip
+
+            self.VPParams=array(params_nonlin,dtype=float)
+            self.VPEval=(concatenate(([p0],params_nonlin)), cclip*g-Q, cclip*G+outer(g,dc))
+        return self.VPEval
+
+    def ObjectiveFuncVP(self,params_nonlin,Q):
+        res=self.EvalResVP(params_nonlin,Q)[1]
+        return sum(res**2)
+
+    def ObjectiveFuncAndJacVP(self,params_nonlin,Q):
+        params,res,J=self.EvalResVP(params_nonlin,Q)
+        return sum(res**2),2*J.T @ res
+
+    def ObjectiveFuncResVP(self,params_nonlin,Q):
+        return self.EvalResVP(params_nonlin,Q)[1]
+
+    def ObjectiveFuncResJacVP(self,params_nonlin,Q):
+        return self.EvalResVP(params_nonlin,Q)[2]
+
     def LeastSquaresFit(self,O,Q):
         # O = observations, either H or W
         # Q = discharge
@@ -228,3 +497,104 @@ class FlowLawCalibration:
         plt.xlabel('Measured WSE m')
         plt.ylabel('True Discharge m^3/s')
         plt.show()   
+
+# the algorithms CalibrateReach tries, in order, until one works. solver is least_squares 
+#   or minimize. for minimize: method, jac=False for a finite-difference gradient, bounds 
+#   with keep_feasible, and options
+DefaultStrategies=[
+    {'name':'least_squares','solver':'least_squares'},
+    {'name':'L-BFGS-B','solver':'minimize','method':'L-BFGS-B'},
+    {'name':'L-BFGS-B f-d','solver':'minimize','method':'L-BFGS-B','jac':False},
+    {'name':'trust-constr','solver':'minimize','method':'trust-constr'},
+    {'name':'L-BFGS-B keep_feasible','solver':'minimize','method':'L-BFGS-B','keep_feasible':True,
+     'options':{'maxiter':1e4}},
+    {'name':'L-BFGS-B f-d step 1','solver':'minimize','method':'L-BFGS-B','jac':False,
+     'keep_feasible':True,'options':{'maxiter':1e4,'finite_diff_rel_step':1.0}},
+]
+
+def UniqueStrategies(strategies,optmethod='L-BFGS-B'):
+    # the strategies with 'L-BFGS-B' replaced by optmethod, less any that would repeat an 
+    #   earlier one. all of the algorithms are deterministic, so running the same one 
+    #   from the same start twice gets the same answer. only trust-constr uses 
+    #   keep_feasible, and the iteration limit and display options do not change where 
+    #   a run that has stopped short of it ends up
+    unique=[]
+    keys=set()
+    for strategy in strategies:
+        strategy=dict(strategy)
+        if strategy.get('method') == 'L-BFGS-B':
+            strategy['method']=optmethod
+            strategy['name']=strategy['name'].replace('L-BFGS-B',optmethod)
+
+        key=(strategy['solver'],strategy.get('method'),bool(strategy.get('jac',True)),
+             strategy.get('method') == 'trust-constr' and strategy.get('keep_feasible',False),
+             (strategy.get('options') or {}).get('finite_diff_rel_step'))
+        if key not in keys:
+            keys.add(key)
+            unique.append(strategy)
+
+    return unique
+
+def DrawStarts(lb,ub,n,Sampler='lhs',seed=0):
+    # n space-filling points between lb and ub. positive parameters whose range spans more
+    #   than two orders of magnitude, e.g. Manning's n, are spread evenly in log space
+    if n < 1:
+        return empty((0,len(lb)))
+
+    if Sampler == 'sobol':
+        sample=qmc.Sobol(len(lb),seed=seed)
+    else:
+        sample=qmc.LatinHypercube(len(lb),seed=seed)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore") #sobol warns if n is not a power of two
+        u=sample.random(n)
+
+    logscale=(lb > 0) & (ub > 100*lb)
+    with errstate(divide='ignore',invalid='ignore'):
+        starts=where(logscale, exp(log(lb)+u*(log(ub)-log(lb))), lb+u*(ub-lb))
+
+    return starts
+
+# the state for LocalSolve, set once per process by InitMultiStart
+MultiStart={}
+
+def InitMultiStart(FlowLaw,Qtrue,bounds):
+    MultiStart.update(FlowLaw=FlowLaw,Qtrue=array(Qtrue,dtype=float),bounds=bounds)
+
+def LocalSolve(start):
+    # one bounded least_squares calibration from start, for CalibrateReachMultiStart. 
+    #   returns start, params, objective, success and the telemetry record
+    FlowLaw=MultiStart['FlowLaw']
+    Qtrue=MultiStart['Qtrue']
+    bounds=MultiStart['bounds']
+    cal=FlowLawCalibration(None,Qtrue,FlowLaw)
+    cal.ResParams=None
+    t0=time.perf_counter()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            res = optimize.least_squares(cal.ObjectiveFuncResFused,
+                                start,
+                                args=([Qtrue]),
+                                bounds=bounds,
+                                jac=cal.ObjectiveFuncResJac)
+        except ValueError as err:
+            record={'method':'multi-start least_squares','nfev':0,'njev':0,
+                    'time':time.perf_counter()-t0,'objective':inf,'success':False,
+                    'status':-1,'message':str(err)}
+            return start,start,inf,False,record
+
+    record=AttemptRecord('multi-start least_squares',res,time.perf_counter()-t0)
+    sse=record['objective']
+    return start,res.x,sse,bool(res.success and isfinite(sse)),record
+
+def AttemptRecord(method,res,seconds):
+    # telemetry record of one optimize result. least_squares reports half the sum of 
+    #   squares as cost; minimize reports the objective itself
+    if 'cost' in res:
+        objective=2*float(res.cost)
+    else:
+        objective=float(res.fun)
+    return {'method':method,'nfev':int(res.get('nfev',0) or 0),'njev':int(res.get('njev',0) or 0),
+            'time':seconds,'objective':objective,'success':bool(res.success),
+            'status':int(res.status),'message':str(res.message)}
@@ -6,9 +6,53 @@ Created on Thu Jan 21 04:50:53 2021
 @author: mtd
 """
 
-from numpy import inf,sqrt,mean,std,zeros_like,log
+from numpy import inf,sqrt,zeros_like,log,exp,column_stack,asarray,maximum,absolute,\
+   ascontiguousarray,nanmin,nanmax,nanmean,nanstd,broadcast_to,isfinite,ones,where
+
+def ObsProperty(name):
+    # an observation array of a flow law, stored as a contiguous float array. assigning a 
+    #   new array clears the cached observation terms. arrays must be replaced rather 
+    #   than edited in place for the cache to notice
+    def get(self):
+        return self.__dict__['_'+name]
+    def set(self,value):
+        if value is not None:
+            value=ascontiguousarray(value,dtype=float)
+        self.__dict__['_'+name]=value
+        self.__dict__['ObsTermsCache']=None
+    return property(get,set)
+
+def SplitParams(params):
+    # flow law parameters are either one vector, or a (P,nparams) matrix with one set of
+    #   parameters per row. this returns the parameters one at a time: scalars for a 
+    #   vector, or (P,1) columns for a matrix, which broadcast against the (nt,) 
+    #   observations to give a (P,nt) discharge matrix
+    params=asarray(params,dtype=float)
+    if params.ndim == 2:
+        return [params[:,i:i+1] for i in range(params.shape[1])]
+    return list(params)
+
+# statistics of the observations along time, per reach when they are (nR,nt). missing
+#   data (nan) are left out
+def ObsMin(x):
+    return nanmin(x,axis=-1)
+def ObsMax(x):
+    return nanmax(x,axis=-1)
+def ObsMean(x):
+    return nanmean(x,axis=-1)
+def ObsStd(x):
+    return nanstd(x,axis=-1)
 
 class FlowLaws:
+
+    # Q is proportional to the first parameter ('direct'), to one over it ('inverse'), or 
+    #   neither (None). FlowLawCalibration uses this to solve for it directly
+    LinearParam=None
+
+    dA=ObsProperty('dA')
+    W=ObsProperty('W')
+    S=ObsProperty('S')
+    H=ObsProperty('H')
     
     def __init__(self,dA,W,S,H,name='No Name'):
         self.dA=dA
@@ -20,121 +64,335 @@ class FlowLaws:
         self.init_params=[]                
 
         self.name=name
+
+        self.ObsTermsCache=self.CalcObsTerms()
+
+    # a flow law can also hold (nR,nt) blocks of observations for many reaches. CalcQ then 
+    #   takes a (nR,nparams) block with one row of parameters per reach, and returns (nR,nt)
+    #   discharge. GetInitParams and GetParamBounds give one value per reach for each 
+    #   parameter. missing observations (nan) give nan discharge
+
+    @classmethod
+    def FromReachObservations(cls,Obs,reaches=None):
+        # the flow law for all reaches of a ReachObservations, or for a list of reaches. 
+        #   an integer gives the usual single reach flow law
+        if reaches is None:
+            reaches=slice(None)
+        return cls(Obs.dA[reaches,:],Obs.w[reaches,:],Obs.S[reaches,:],Obs.h[reaches,:])
+
+    def GetInitParamBlock(self):
+        # GetInitParams as a (nR,nparams) block, or a vector for a single reach
+        init_params=[asarray(p,dtype=float) for p in self.GetInitParams()]
+        if self.W.ndim == 1:
+            return asarray(init_params)
+        return column_stack([broadcast_to(p,self.W.shape[:1]) for p in init_params])
+
+    def GetStartBounds(self,Spread=10.):
+        # finite lower and upper bounds to draw calibration starting points from. these are
+        #   GetParamBounds, with each infinite bound replaced by one Spread times as far 
+        #   from the initial parameters as the finite bound, or as the initial parameter
+        #   is from zero if both are infinite. the initial parameters are set from the 
+        #   data, so the ranges are too
+        init_params=asarray(self.GetInitParams(),dtype=float)
+        bounds=self.GetParamBounds()
+        if len(init_params) == 1:
+            bounds=(bounds,)
+        lb=asarray([bound[0] for bound in bounds],dtype=float)
+        ub=asarray([bound[1] for bound in bounds],dtype=float)
+
+        span=absolute(init_params)
+        span=where(isfinite(lb),init_params-lb,span)
+        span=where(isfinite(ub),ub-init_params,span)
+        span=Spread*maximum(span,1.)
+
+        lb=where(isfinite(lb),lb,init_params-span)
+        ub=where(isfinite(ub),ub,init_params+span)
+
+        return lb,ub
+
+    def GetObsMask(self):
+        # True where all of the observations are available
+        igood=ones(self.W.shape,dtype=bool)
+        for x in (self.dA,self.W,self.S,self.H):
+            if x is not None:
+                igood&=isfinite(x)
+        return igood
+
+    # terms that depend only on the observations, e.g. W**(-2/3)*S**(1/2), are computed
+    #   once by CalcObsTerms and reused by every CalcQ call. they are recomputed if dA, W,
+    #   S or H are replaced
+
+    def CalcObsTerms(self):
+        return {}
+
+    @property
+    def obs(self):
+        if self.ObsTermsCache is None:
+            self.ObsTermsCache=self.CalcObsTerms()
+        return self.ObsTermsCache
+
+    # each flow law provides CalcQJacobianQ(params), which returns Q and JacobianQ: the 
+    #   nt x nparams matrix of derivatives of Q with respect to the parameters, i.e. the
+    #   jacobian of the residuals CalcQ-Qt. both come from one pass over the data
+
+    def JacobianQ(self,params):
+        Q,JQ=self.CalcQJacobianQ(params)
+        return JQ
+
+    def Jacobian(self,params,Qt):
+        # gradient of the sum of squared errors sum((CalcQ-Qt)**2), from JacobianQ
+        Q,JQ=self.CalcQJacobianQ(params)
+        return 2*JQ.T @ (Q-Qt)
+
+    def CalcObjective(self,params,Qt):
+        # Q, the residuals Q-Qt, their sum of squares and its gradient, all from one 
+        #   CalcQJacobianQ evaluation
+        Q,JQ=self.CalcQJacobianQ(params)
+        res=Q-Qt
+        sse=sum(res**2)
+        grad=2*JQ.T @ res
+        return Q,res,sse,grad,JQ
+
+    # each flow law also provides CalcQObsJacobian(params), which returns Q and its 
+    #   derivatives with respect to the observations dA, W, S and H at the same overpass,
+    #   each shaped like Q. CalcQUnObs turns these into a first-order uncertainty
+
+    def CalcQUnObs(self,params,sigh,sigw,sigS,Partials=None):
+        # first-order (delta method) standard deviation of Q at each overpass, from 
+        #   independent errors sigh, sigw and sigS in the observed heights, widths and 
+        #   slopes. dA is made from the heights and widths, and H and W may be the 
+        #   observations projected onto the height-width fit; Partials is a dict of the
+        #   derivatives that carry the observation errors through those steps, as made 
+        #   by ReachObservations.CalcObsPartials. by default H and W are the observations
+        #   and dA follows the height-width fit, dA(H)=integral of W dH, so that dA 
+        #   changes by W for a change in H. returns QUn, and the parts of it due to the
+        #   height, width and slope errors
+        Q,dQdA,dQdW,dQdS,dQdH=self.CalcQObsJacobian(params)
+        p={'dHdh':1.,'dHdw':0.,'dWdh':0.,'dWdw':1.,'dAdH':self.W,'dAdW':0.,'dAVarH':0.,'dAVarW':0.}
+        if Partials is not None:
+            p.update(Partials)
+
+        # sensitivity to the H and W the flow law sees, including through dA
+        gH=dQdH+dQdA*p['dAdH']
+        gW=dQdW+dQdA*p['dAdW']
+
+        QUnH=sqrt(((gH*p['dHdh']+gW*p['dWdh'])*sigh)**2+dQdA**2*p['dAVarH'])
+        QUnW=sqrt(((gH*p['dHdw']+gW*p['dWdw'])*sigw)**2+dQdA**2*p['dAVarW'])
+        QUnS=absolute(dQdS*sigS)
+        QUn=sqrt(QUnH**2+QUnW**2+QUnS**2)
+        return QUn,QUnH,QUnW,QUnS
+
+    def CheckObsJacobian(self,rel_step=1e-6,params=None):
+        # compare CalcQObsJacobian with central finite differences of CalcQ, changing 
+        #   each observation in turn. returns the largest difference relative to the size
+        #   of each derivative
+        if params is None:
+            params=self.GetInitParams()
+        Q,*J=self.CalcQObsJacobian(params)
+        err=0.
+        for i,name in enumerate(('dA','W','S','H')):
+            x=getattr(self,name)
+            # the step is at least rel_step of the typical size of x, so observations
+            #   near zero, e.g. dA at the first overpass, are not lost in roundoff
+            dx=rel_step*maximum(absolute(x),nanmean(absolute(x)))
+            setattr(self,name,x+dx)
+            Qplus=self.CalcQ(params)
+            setattr(self,name,x-dx)
+            Qminus=self.CalcQ(params)
+            setattr(self,name,x)
+            Jfd=(Qplus-Qminus)/(2*dx)
+            scale=maximum(absolute(Jfd).max(),1e-300)
+            err=max(err,(absolute(J[i]-Jfd)/scale).max())
+        return err
+
+    def CheckJacobianQ(self,params,rel_step=1e-6):
+        # compare JacobianQ with central finite differences of CalcQ. returns the largest
+        #   difference, relative to the size of each column
+        params=asarray(params,dtype=float)
+        J=self.JacobianQ(params)
+        Jfd=zeros_like(J)
+        for i in range(len(params)):
+            dp=rel_step*max(absolute(params[i]),1.)
+            pplus=params.copy()
+            pminus=params.copy()
+            pplus[i]+=dp
+            pminus[i]-=dp
+            Jfd[:,i]=(self.CalcQ(pplus)-self.CalcQ(pminus))/(2*dp)
+        scale=maximum(absolute(Jfd).max(axis=0),1e-300)
+        return (absolute(J-Jfd)/scale).max()
         
 class MWACN(FlowLaws):
     # this flow law is Manning's equation, wide-river approximation, area-formulation, 
     #   constant friction coefficient, no channel shape assumption: MWACN
+    LinearParam='inverse'
     def __init__(self,dA,W,S,H):
         super().__init__(dA,W,S,H)        
         
+    def CalcObsTerms(self):
+        return {'WS':ascontiguousarray(self.W**(-2/3)*self.S**(1/2)),
+                'meanW':ObsMean(self.W),'stddA':ObsStd(self.dA),'stdH':ObsStd(self.H)}
     def CalcQ(self,params):
-        Q=1/params[0]*(params[1]+self.dA)**(5/3)*self.W**(-2/3)*self.S**(1/2)
+        params=SplitParams(params)
+        Q=1/params[0]*(params[1]+self.dA)**(5/3)*self.obs['WS']
         return Q
     def GetInitParams(self):
         #etc
-        init_params=[.03, -min(self.dA)+1+std(self.dA)]
+        init_params=[.03, -ObsMin(self.dA)+1+ObsStd(self.dA)]
         return init_params
         #etc
     def GetParamBounds(self):
-        param_bounds=( (.001, 1)  , (-min(self.dA)+1,inf) )
+        param_bounds=( (.001, 1)  , (-ObsMin(self.dA)+1,inf) )
         return param_bounds
     def CalcQUn(self,params,sigh,sigw,order):
+        params=asarray(params,dtype=float).T #so that params[i] is per reach for a block
         if order == 1:
-             QUnH=5/3*sqrt(2)*mean(self.W)*sigh/(params[1]+std(self.dA)) #1st order approximation
-             QUnW_dA=5/3*sqrt(2)*std(self.H)*sigw/(params[1]+std(self.dA)) #1st order approximation
-             QUnW_W=2/3*sigw/mean(self.W)
+             obs=self.obs
+             QUnH=5/3*sqrt(2)*obs['meanW']*sigh/(params[1]+obs['stddA']) #1st order approximation
+             QUnW_dA=5/3*sqrt(2)*obs['stdH']*sigw/(params[1]+obs['stddA']) #1st order approximation
+             QUnW_W=2/3*sigw/obs['meanW']
              QUnW=(QUnW_W**2+QUnW_dA**2)**0.5
              QUn=(QUnH**2+QUnW**2)**0.5
         else:
              QUn=inf
         return QUn,QUnH,QUnW
-    def Jacobian(self,params,Qt):
-        dydp=zeros_like(params)                  
-        dydp[0]=2*sum(((self.dA+params[1])**(5/3)*(Qt*sqrt(self.S)*self.W**(2/3)*params[0]-self.S*(self.dA+params[1])**(5/3)))/(self.W**(4/3)*params[0]**3))
-        dydp[1]=(10/3)*sum(((self.dA+params[1])**(2/3)*(self.S*(self.dA+params[1])**(5/3)-Qt*sqrt(self.S)*self.W**(2/3)*params[0])/(self.W**(4/3)*params[0]**2)))
-        return dydp
+    def CalcQJacobianQ(self,params):
+        A=params[1]+self.dA
+        Q=1/params[0]*A**(5/3)*self.obs['WS']
+        return Q,column_stack( (-Q/params[0], 5/3*Q/A) )
+    def CalcQObsJacobian(self,params):
+        params=SplitParams(params)
+        A=params[1]+self.dA
+        Q=1/params[0]*A**(5/3)*self.obs['WS']
+        return Q,5/3*Q/A,-2/3*Q/self.W,Q/(2*self.S),zeros_like(Q)
 
 class MWAPN(FlowLaws):
     # this flow law is Manning's equation, wide-river approximation, area-formulation, 
     #   powerlaw  friction coefficient, no channel shape assumption: MWAPN
+    LinearParam='inverse'
     def __init__(self,dA,W,S,H):
         super().__init__(dA,W,S,H)     
+    def CalcObsTerms(self):
+        return {'WS':ascontiguousarray(self.W**(-2/3)*self.S**(1/2)),'logW':log(self.W)}
     def CalcQ(self,params):
-        n=params[0]*((params[1]+self.dA)/self.W)**params[2]
-        Q=1/n*(params[1]+self.dA)**(5/3)*self.W**(-2/3)*self.S**(1/2)
+        params=SplitParams(params)
+        # n=params[0]*((params[1]+dA)/W)**params[2], folded into one exponential
+        logA=log(params[1]+self.dA)
+        Q=1/params[0]*exp((5/3-params[2])*logA+params[2]*self.obs['logW'])*self.obs['WS']
         return Q
     def GetInitParams(self):
         #etc
-        init_params=[.03, -min(self.dA)+1+std(self.dA),1]
+        init_params=[.03, -ObsMin(self.dA)+1+ObsStd(self.dA),1]
         return init_params       
     def GetParamBounds(self):
         #etc
-        param_bounds=( (.001, 1)  , (-min(self.dA)+1,inf), (-inf,inf) )
+        param_bounds=( (.001, 1)  , (-ObsMin(self.dA)+1,inf), (-inf,inf) )
         return param_bounds
-    def Jacobian(self,params,Qt):
-        dydp=zeros_like(params)                  
-        dydp[0]=sum((2*(self.dA+params[1])**(5/3)*sqrt(self.S)*(Qt-((self.dA+params[1])**(5/3)*sqrt(self.S))/(((self.dA+params[1])/self.W)**params[2]*self.W**(2/3)*params[0])))/(((self.dA+ params[1])/self.W)**params[2]*self.W**(2/3)*params[0]**2))
-        dydp[1]=sum(2*((sqrt(self.S)*params[2]*(params[1]+self.dA)**(2/3))/(self.W**(2/3)*params[0]*((params[1]+self.dA)/self.W)**params[2])-(5*sqrt(self.S)*(params[1]+self.dA)**(2/3))/(3*self.W**(2/3)*params[0]*((params[1]+self.dA)/self.W)**params[2]))*(Qt-(sqrt(self.S)*(params[1]+self.dA)**(5/3))/(self.W**(2/3)*params[0]*((params[1]+self.dA)/self.W)**params[2])))
-        dydp[2]=sum((2*(self.dA+params[1])**(5/3)*sqrt(self.S)*log((self.dA+params[1])/self.W)*(Qt-((self.dA+params[1])**(5/3)*sqrt(self.S))/(((self.dA+params[1])/self.W)**params[2]*self.W**(2/3)*params[0])))/(((self.dA+params[1])/self.W)**params[2]*self.W**(2/3)*params[0]))
-        return dydp
+    def CalcQJacobianQ(self,params):
+        A=params[1]+self.dA
+        logA=log(A)
+        Q=1/params[0]*exp((5/3-params[2])*logA+params[2]*self.obs['logW'])*self.obs['WS']
+        return Q,column_stack( (-Q/params[0], (5/3-params[2])*Q/A, -Q*(logA-self.obs['logW'])) )
+    def CalcQObsJacobian(self,params):
+        params=SplitParams(params)
+        A=params[1]+self.dA
+        Q=1/params[0]*exp((5/3-params[2])*log(A)+params[2]*self.obs['logW'])*self.obs['WS']
+        return Q,(5/3-params[2])*Q/A,(params[2]-2/3)*Q/self.W,Q/(2*self.S),zeros_like(Q)
 
 class MWAVN(FlowLaws):
     # this flow law is Manning's equation, wide-river approximation, area-formulation, 
     #   hydraulic spatial variability approach, no channel shape assumption: MWAVN
+    LinearParam='inverse'
     def __init__(self,dA,W,S,H):
         super().__init__(dA,W,S,H)     
+    def CalcObsTerms(self):
+        return {'WS':ascontiguousarray(self.W**(-2/3)*self.S**(1/2)),'W2':self.W**2}
     def CalcQ(self,params):
-        RHS=(1. + 5/6 * (self.W*params[2]/(params[1]+self.dA))**2 )
-        if any(RHS <= 0):
-            Q=inf
+        params=SplitParams(params)
+        RHS=(1. + 5/6 * self.obs['W2']*params[2]**2/(params[1]+self.dA)**2 )
+        if RHS.ndim == 1:
+            if any(RHS <= 0):
+                Q=inf
+            else:
+                n=params[0]*RHS
+                Q=1/n*(params[1]+self.dA)**(5/3)*self.obs['WS']
         else:
+            # for a matrix of parameters, only the rows with RHS <= 0 are set to inf
             n=params[0]*RHS
-            Q=1/n*(params[1]+self.dA)**(5/3)*self.W**(-2/3)*self.S**(1/2)
+            Q=1/n*(params[1]+self.dA)**(5/3)*self.obs['WS']
+            Q[(RHS <= 0).any(axis=1),:]=inf
         return Q
     def GetInitParams(self):
         #etc
-        init_params=[.03, -min(self.dA)+1+std(self.dA),1]
+        init_params=[.03, -ObsMin(self.dA)+1+ObsStd(self.dA),1]
         return init_params       
     def GetParamBounds(self):
         #etc
-        param_bounds=( (.001, 1)  , (-min(self.dA)+1,inf), (-inf,inf) )
+        param_bounds=( (.001, 1)  , (-ObsMin(self.dA)+1,inf), (-inf,inf) )
         return param_bounds
-    def Jacobian(self,params,Qt):
-        dydp=zeros_like(params)
-        dydp[0]=sum((2*(params[1]+self.dA)**(5/3)*sqrt(self.S)*(Qt-((params[1]+self.dA)**(5/3)*sqrt(self.S))/(self.W**(2/3)*((5*self.W**2*params[2]**2)/(6*(params[1]+self.dA)**2)+1)*params[0])))/(self.W**(2/3)*((5*self.W**2*params[2]**2)/(6*(params[1]+self.dA)**2)+1)*params[0]**2))
-        dydp[1]=sum(2*(-(5*sqrt(self.S)*(params[1]+self.dA)**(2/3))/(3*self.W**(2/3)*params[0]*((5*self.W**2*params[2]**2)/(6*(params[1]+self.dA)**2)+1))-(5*sqrt(self.S)*self.W**(4/3)*params[2]**2)/(3*params[0]*(params[1]+self.dA)**(4/3)*((5*self.W**2*params[2]**2)/(6*(params[1]+self.dA)**2)+1)**2))*(Qt-(sqrt(self.S)*(params[1]+self.dA)**(5/3))/(self.W**(2/3)*params[0]*((5*self.W**2*params[2]**2)/(6*(params[1]+self.dA)**2)+1))))
-        dydp[2]=sum((10*sqrt(self.S)*self.W**(4/3)*params[2]*(Qt-((params[1]+self.dA)**(5/3)*sqrt(self.S))/(self.W**(2/3)*params[0]*((5*self.W**2*params[2]**2)/(6*(params[1]+self.dA)**2)+1))))/(3*(params[1]+self.dA)**(1/3)*params[0]*((5*self.W**2* params[2]**2)/(6*(params[1]+self.dA)**2)+1)**2))
-        return dydp     
+    def CalcQJacobianQ(self,params):
+        # the jacobian is returned even where RHS <= 0 and Q is inf, as in CalcQ
+        A=params[1]+self.dA
+        W2=self.obs['W2']
+        RHS=(1. + 5/6 * W2*params[2]**2/A**2 )
+        Q=1/(params[0]*RHS)*A**(5/3)*self.obs['WS']
+        dRHSdA=-5/3*W2*params[2]**2/A**3
+        dRHSdp2=5/3*W2*params[2]/A**2
+        JQ=column_stack( (-Q/params[0], Q*(5/3/A-dRHSdA/RHS), -Q*dRHSdp2/RHS) )
+        if any(RHS <= 0):
+            Q=inf
+        return Q,JQ
+    def CalcQObsJacobian(self,params):
+        # where RHS <= 0 the derivatives are those of the formula, as in CalcQJacobianQ
+        params=SplitParams(params)
+        A=params[1]+self.dA
+        W2=self.obs['W2']
+        RHS=(1. + 5/6 * W2*params[2]**2/A**2 )
+        Q=1/(params[0]*RHS)*A**(5/3)*self.obs['WS']
+        dRHSdA=-5/3*W2*params[2]**2/A**3
+        dRHSdW=5/3*self.W*params[2]**2/A**2
+        return Q,Q*(5/3/A-dRHSdA/RHS),-Q*(2/3/self.W+dRHSdW/RHS),Q/(2*self.S),zeros_like(Q)
 
 class MWHCN(FlowLaws):
     # this flow law is Manning's equation, height only, constant n: MWHCN
     # params=n, H0
+    LinearParam='inverse'
     def __init__(self,dA,W,S,H):
         super().__init__(dA,W,S,H)     
+    def CalcObsTerms(self):
+        return {'WS':ascontiguousarray(self.W*self.S**(1/2))}
     def CalcQ(self,params):
-        Q=1/params[0]*(self.H-params[1])**(5/3)*self.W*self.S**(1/2)
+        params=SplitParams(params)
+        Q=1/params[0]*(self.H-params[1])**(5/3)*self.obs['WS']
         return Q
     def GetInitParams(self):
         #etc
-        H0max=min(self.H)-0.1
+        H0max=ObsMin(self.H)-0.1
         init_params=[.03,H0max-1.0] 
         return init_params       
     def GetParamBounds(self):
         #etc
-        param_bounds=( (.001, 1.0)  , (-inf,min(self.H)-0.1) )
+        param_bounds=( (.001, 1.0)  , (-inf,ObsMin(self.H)-0.1) )
         return param_bounds 
-    def Jacobian(self,params,Qt):
-        dydp=zeros_like(params)
-        dydp[0]=2*sum((sqrt(self.S)*self.W*(self.H-params[1])**(5/3)*(Qt-(sqrt(self.S)*self.W*(self.H-params[1])**(5/3))/params[0]))/params[0]**2)
-        dydp[1]=10*sum((sqrt(self.S)*self.W*(Qt-(sqrt(self.S)*self.W*(self.H-params[1])**(5/3))/params[0])*(self.H-params[1])**(2/3))/(3*params[0]))
-        return dydp     
+    def CalcQJacobianQ(self,params):
+        D=self.H-params[1]
+        Q=1/params[0]*D**(5/3)*self.obs['WS']
+        return Q,column_stack( (-Q/params[0], -5/3*Q/D) )
+    def CalcQObsJacobian(self,params):
+        params=SplitParams(params)
+        D=self.H-params[1]
+        Q=1/params[0]*D**(5/3)*self.obs['WS']
+        return Q,zeros_like(Q),Q/self.W,Q/(2*self.S),5/3*Q/D
 
 class AHGW(FlowLaws):
     # this flow law is at-a-station hydraulic geometry for width
     #    Q=aW**b params=a,b
+    LinearParam='direct'
     def __init__(self,dA,W,S,H):
         super().__init__(dA,W,S,H,'AHGW')     
+    def CalcObsTerms(self):
+        return {'logW':log(self.W)}
     def CalcQ(self,params):
+        params=SplitParams(params)
         Q=params[0]*self.W**params[1]
         return Q
     def GetInitParams(self):
@@ -146,109 +404,164 @@ class AHGW(FlowLaws):
         #param_bounds=(( 0.000001,inf),(0.01,100.0) )
         param_bounds=(( -inf,inf),(0.01,100.0) )
         return param_bounds               
-    def Jacobian(self,params,Qt):
-        dydp=zeros_like(params)
-        dydp[0]=-2*sum( (Qt-params[0]*self.W**params[1])*self.W**params[1] )
-        dydp[1]=-2*sum( (Qt-params[0]*self.W**params[1])*(log(self.W**params[1]))*(params[0]*self.W**params[1]))
-        return dydp 
+    def CalcQJacobianQ(self,params):
+        Wb=self.W**params[1]
+        Q=params[0]*Wb
+        return Q,column_stack( (Wb, Q*self.obs['logW']) )
+    def CalcQObsJacobian(self,params):
+        params=SplitParams(params)
+        Q=params[0]*self.W**params[1]
+        return Q,zeros_like(Q),params[1]*Q/self.W,zeros_like(Q),zeros_like(Q)
 
 class AHGD(FlowLaws):
     # this flow law is at-a-station hydraulic geometry for depth
     #    it is identical to typical rating curves
+    LinearParam='direct'
 
     def __init__(self,dA,W,S,H):
         super().__init__(dA,W,S,H,'AHGD')     
     def CalcQ(self,params):
+        params=SplitParams(params)
         Q=params[0]*(self.H-params[1])**params[2]
         return Q
     def GetInitParams(self):
-        H0max=min(self.H)-0.1
+        H0max=ObsMin(self.H)-0.1
         init_params=[5.0,H0max-1.0,2.0]
         return init_params       
     def GetParamBounds(self):
         #etc
-        param_bounds=( (0.01,inf),(-inf,min(self.H)-0.1),(0.01,10.) )
+        param_bounds=( (0.01,inf),(-inf,ObsMin(self.H)-0.1),(0.01,10.) )
         return param_bounds
-    def Jacobian(self,params,Qt):
-        dydp=zeros_like(params)
-        dydp[0]=-2*sum((self.H-params[1])**params[2]*(Qt-(self.H-params[1])**params[2]*params[0]))
-        dydp[1]=-2*sum((params[0]*params[2]*(Qt-params[0]*(self.H-params[1])**params[2])*(self.H-params[1])**(params[2]-1)))
-        dydp[2]=-2*sum((params[0]*(self.H-params[1])**params[2]*log(self.H-params[1])*(Qt-params[0]*(self.H-params[1])**params[2])))
-        return dydp       
+    def CalcQJacobianQ(self,params):
+        D=self.H-params[1]
+        Hb=D**params[2]
+        Q=params[0]*Hb
+        return Q,column_stack( (Hb, -params[2]*Q/D, Q*log(D)) )
+    def CalcQObsJacobian(self,params):
+        params=SplitParams(params)
+        D=self.H-params[1]
+        Q=params[0]*D**params[2]
+        return Q,zeros_like(Q),zeros_like(Q),zeros_like(Q),params[2]*Q/D
             
             
             
 class MOMMA(FlowLaws):
     # this is MOMMA, as written in eqns 9 and 10 of Frasson et al 2021
     # params=nb, Hb, B, r
+    LinearParam='inverse'
     def __init__(self,dA,W,S,H):
         super().__init__(dA,W,S,H)     
     def CalcQ(self,params):
+        params=SplitParams(params)
         n=params[0]*(1+log( (params[1]-params[2] )/(self.H-params[2]) ) )
-        Q=1/n*( (self.H-params[2])*(params[3]/(1+params[3])))**(5/3)*self.W*self.S**0.5
+        Q=1/n*( (self.H-params[2])*(params[3]/(1+params[3])))**(5/3)*self.obs['WS']
         return Q
+    def CalcObsTerms(self):
+        return {'WS':ascontiguousarray(self.W*self.S**0.5)}
     def GetInitParams(self):
-        Bmax=min(self.H)-0.1
-        init_params=[0.03,mean(self.H),Bmax-1.0,0.5]
+        Bmax=ObsMin(self.H)-0.1
+        init_params=[0.03,ObsMean(self.H),Bmax-1.0,0.5]
         return init_params       
     def GetParamBounds(self):
         #etc
-        param_bounds=( (0.01,inf),(min(self.H)+0.1,max(self.H)),(-inf,min(self.H)-0.1),(0.01,inf) )
+        param_bounds=( (0.01,inf),(ObsMin(self.H)+0.1,ObsMax(self.H)),(-inf,ObsMin(self.H)-0.1),(0.01,inf) )
         return param_bounds
-    def Jacobian(self,params,Qt):
-        dydp=zeros_like(params)
-        dydp[0]=sum((2*sqrt(self.S)*self.W* params[3]**(5/3)*(self.H-params[2])**(5/3)*(Qt-(sqrt(self.S)*self.W*params[3]**(5/3)*(self.H-params[2])**(5/3))/((params[3]+1)**(5/3)*(log((params[1]- params[2])/(self.H-params[2]))+1)* params[0])))/(( params[3]+1)**(5/3)*(log((params[1]-params[2])/(self.H-params[2]))+1)*params[0]**2))
-        dydp[1]=sum((2*sqrt(self.S)*self.W* params[3]**(5/3)*(self.H- params[2])**(5/3)*(Qt-(sqrt(self.S)*self.W* params[3]**(5/3)*(self.H- params[2])**(5/3))/( params[0]*( params[3]+1)**(5/3)*(log((params[1]- params[2])/(self.H- params[2]))+1))))/(params[0]*( params[3]+1)**(5/3)*(params[1]- params[2])*(log((params[1]- params[2])/(self.H- params[2]))+1)**2))
-        dydp[2]=sum(2*(Qt-(sqrt(self.S)*self.W* params[3]**(5/3)*(self.H- params[2])**(5/3))/(params[0]*(params[3]+1)**(5/3)*(log((params[1]- params[2])/(self.H- params[2]))+1)))*((sqrt(self.S)*self.W* params[3]**(5/3)*(( params[1]-params[2])/(self.H- params[2])**2-1/(self.H- params[2]))*(self.H- params[2])**(8/3))/(params[0]*( params[3]+1)**(5/3)*(log((params[1]- params[2])/(self.H-params[2]))+1)**2*( params[1]- params[2]))+(5*sqrt(self.S)*self.W*params[3]**(5/3)*(self.H- params[2])**(2/3))/(3*params[0]*( params[3]+1)**(5/3)*(log((params[1]- params[2])/(self.H-params[2]))+1))))
-        dydp[3]=sum(2*((5*sqrt(self.S)*self.W*(self.H-params[2])**(5/3)* params[3]**(5/3))/(3*params[0]*(log((params[1]-params[2])/(self.H- params[2]))+1)*(params[3]+1)**(8/3))-(5*sqrt(self.S)*self.W*(self.H- params[2])**(5/3)*params[3]**(2/3))/(3*params[0]*(log((params[1]- params[2])/(self.H-params[2]))+1)*(params[3]+1)**(5/3)))*(Qt-(sqrt(self.S)*self.W*(self.H-params[2])**(5/3)* params[3]**(5/3))/(params[0]*(log((params[1]- params[2])/(self.H-params[2]))+1)*(params[3]+1)**(5/3))))
-        return dydp 
+    def CalcQJacobianQ(self,params):
+        D=self.H-params[2]
+        L=1+log( (params[1]-params[2] )/D )
+        Q=1/(params[0]*L)*( D*(params[3]/(1+params[3])))**(5/3)*self.obs['WS']
+        dLdHb=1/(params[1]-params[2])
+        dLdB=1/D-dLdHb
+        return Q,column_stack( (-Q/params[0], -Q*dLdHb/L, -Q*(dLdB/L+5/3/D),
+                                5/3*Q/(params[3]*(1+params[3]))) )
+    def CalcQObsJacobian(self,params):
+        params=SplitParams(params)
+        D=self.H-params[2]
+        L=1+log( (params[1]-params[2] )/D )
+        Q=1/(params[0]*L)*( D*(params[3]/(1+params[3])))**(5/3)*self.obs['WS']
+        # dL/dH=-1/D
+        return Q,zeros_like(Q),Q/self.W,Q/(2*self.S),Q*(5/3+1/L)/D
 
 class MWHFN(FlowLaws):
     # this flow law is Manning's equation, height only, fixed n: MWHCN
     # params= H0
     def __init__(self,dA,W,S,H):
         super().__init__(dA,W,S,H)     
+    def CalcObsTerms(self):
+        return {'WS':ascontiguousarray(self.W*self.S**(1/2))}
     def CalcQ(self,params):
-        Q=1/0.03*(self.H-params[0])**(5/3)*self.W*self.S**(1/2)
+        params=SplitParams(params)
+        Q=1/0.03*(self.H-params[0])**(5/3)*self.obs['WS']
         return Q
     def GetInitParams(self):
         #etc
-        H0max=min(self.H)-0.1
+        H0max=ObsMin(self.H)-0.1
         init_params=[H0max-1.0] 
         return init_params       
     def GetParamBounds(self):
         #etc
-        param_bounds=( (-inf,min(self.H)-0.1) )
+        param_bounds=( (-inf,ObsMin(self.H)-0.1) )
         return param_bounds               
+    def CalcQJacobianQ(self,params):
+        D=self.H-params[0]
+        Q=1/0.03*D**(5/3)*self.obs['WS']
+        return Q,column_stack( (-5/3*Q/D,) )
+    def CalcQObsJacobian(self,params):
+        params=SplitParams(params)
+        D=self.H-params[0]
+        Q=1/0.03*D**(5/3)*self.obs['WS']
+        return Q,zeros_like(Q),Q/self.W,Q/(2*self.S),5/3*Q/D
 
 class PVK(FlowLaws):
     # this flow law is Prandtl von Karman equation
     # params= C, A0, y0
+    LinearParam='direct'
     def __init__(self,dA,W,S,H):
         super().__init__(dA,W,S,H)     
-    def CalcQ(self,params):
+    def CalcObsTerms(self):
         g=9.81
-        Q=params[0]*(params[1]+self.dA)*(g*(params[1]+self.dA)/self.W*self.S )**0.5*log( (params[1]+self.dA)/self.W/params[2] )
+        return {'gSW':ascontiguousarray(g*self.S/self.W),'logW':log(self.W)}
+    def CalcQ(self,params):
+        params=SplitParams(params)
+        A=params[1]+self.dA
+        Q=params[0]*A*(A*self.obs['gSW'])**0.5*(log(A)-self.obs['logW']-log(params[2]))
         return Q
     def GetInitParams(self):
         #etc
-        H0max=min(self.H)-0.1
-        init_params=[10., -min(self.dA)+1+std(self.dA),1]
+        H0max=ObsMin(self.H)-0.1
+        init_params=[10., -ObsMin(self.dA)+1+ObsStd(self.dA),1]
         return init_params       
     def GetParamBounds(self):
         #etc
-        param_bounds=( (0.001, inf)  , (-min(self.dA)+1,inf), (0.001,inf) )
+        param_bounds=( (0.001, inf)  , (-ObsMin(self.dA)+1,inf), (0.001,inf) )
         return param_bounds               
+    def CalcQJacobianQ(self,params):
+        A=params[1]+self.dA
+        V=(A*self.obs['gSW'])**0.5
+        logterm=log(A)-self.obs['logW']-log(params[2])
+        Q=params[0]*A*V*logterm
+        return Q,column_stack( (A*V*logterm, params[0]*V*(1.5*logterm+1), -params[0]*A*V/params[2]) )
+    def CalcQObsJacobian(self,params):
+        params=SplitParams(params)
+        A=params[1]+self.dA
+        V=(A*self.obs['gSW'])**0.5
+        logterm=log(A)-self.obs['logW']-log(params[2])
+        Q=params[0]*A*V*logterm
+        return Q,params[0]*V*(1.5*logterm+1),-(Q/2+params[0]*A*V)/self.W,Q/(2*self.S),zeros_like(Q)
 
 class AHGD_field(FlowLaws):
     # this flow law is at-a-station hydraulic geometry for depth
     #    intended to be used with depth - discharge field data
     #    for simplicity, redfine H as hydraulic depth
    #     note - in other functions, it is WSE 
+    LinearParam='direct'
 
     def __init__(self,dA,W,S,H):
         super().__init__(dA,W,S,H)     
+    def CalcObsTerms(self):
+        return {'logH':log(self.H)}
     def CalcQ(self,params):
+        params=SplitParams(params)
         Q=params[0]*self.H ** params[1]
         return Q
     def GetInitParams(self):
@@ -258,3 +571,11 @@ class AHGD_field(FlowLaws):
         #etc
         param_bounds=( (0.01,inf),(0.,inf) )
         return param_bounds               
+    def CalcQJacobianQ(self,params):
+        Hb=self.H ** params[1]
+        Q=params[0]*Hb
+        return Q,column_stack( (Hb, Q*self.obs['logH']) )
+    def CalcQObsJacobian(self,params):
+        params=SplitParams(params)
+        Q=params[0]*self.H ** params[1]
+        return Q,zeros_like(Q),zeros_like(Q),zeros_like(Q),params[1]*Q/self.H
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 12:44:08 2026
+
+@author: mtd
+"""
+
+import numpy as np
+from numpy.random import default_rng
+
+from ReachObservations import CalcdAMetroMan,MapPointsToHypsometricCurve
+
+class ObservationEnsemble:
+    # Monte Carlo propagation of the observation errors sigh, sigw and sigS to discharge.
+    #   each member perturbs every h, w and S with independent gaussian errors, changes dA
+    #   by the change in the MetroMan-style (dAOpt=0) areas of the perturbed h and w, and
+    #   runs each reach's calibrated flow law on them, with the parameters held fixed. 
+    #   members are made in chunks of (k,nR,nt) arrays so memory does not grow with K.
+    #   the quantiles are exact when all K members fit in one chunk; otherwise they come
+    #   from a histogram of each overpass's discharge. its bins span three times the range
+    #   of a pilot sample, the first nPilot members, so they are good to about 3/nBins of
+    #   that range however small the chunks are.
+    #   if the observations were projected onto sub-domain height-width fits
+    #   (ConstrainHWSwitch with CalcAreaFitOpt > 0), the perturbed raw observations are
+    #   projected onto the same fits; otherwise the perturbations are added to the h and
+    #   w the flow laws were calibrated with
+
+    def __init__(self,Obs,cals,K=1000,Quantiles=(0.05,0.5,0.95),ChunkSize=None,MaxBytes=2e8,
+                 nBins=1000,nPilot=1000,seed=0):
+        """
+            Obs= ReachObservations
+            cals= one calibrated FlowLawCalibration per reach, or None to skip a reach
+            K= number of members
+            Quantiles= discharge quantiles to report
+            ChunkSize= members per chunk. None picks the largest that keeps the working
+                arrays within about MaxBytes
+            nBins= histogram bins per overpass, when K takes more than one chunk
+            nPilot= members whose discharge sets the histogram bins. their chunks are kept
+                until the bins are set, so this is cut to what fits in about MaxBytes
+            seed= random seed
+        """
+        self.Obs=Obs
+        self.cals=cals
+        self.K=K
+        self.Quantiles=np.asarray(Quantiles,dtype=float)
+        self.nBins=nBins
+        self.seed=seed
+
+        nR,nt=Obs.D.nR,Obs.D.nt
+        self.Project=Obs.ConstrainHWSwitch and Obs.CalcAreaFitOpt > 0
+        if ChunkSize is None:
+            # about 16 (k,nR,nt) float arrays are alive at once, and 5 more per 
+            #   sub-domain while projecting onto the height-width fits
+            narrays=16
+            if self.Project:
+                narrays+=5*max([fit['fit_coeffs'].shape[1] for fit in Obs.area_fits if fit is not None],
+                               default=0)
+            ChunkSize=int(max(1,MaxBytes//(narrays*8*nR*nt)))
+        self.ChunkSize=min(ChunkSize,K)
+        self.nPilot=int(min(K,max(self.ChunkSize,min(nPilot,MaxBytes//(2*8*nR*nt)))))
+
+        self.dA0=CalcdAMetroMan(Obs.h,Obs.w)
+
+    def Run(self):
+        # Qmean, Qstd= (nR,nt) mean and standard deviation of discharge over the members
+        # Qquantiles= (len(Quantiles),nR,nt) discharge quantiles
+        # nValid= (nR,nt) number of members with a finite discharge. members can lose an
+        #   overpass if, e.g., the perturbed slope is negative
+        Obs=self.Obs
+        nR,nt=Obs.D.nR,Obs.D.nt
+
+        rng=default_rng(self.seed)
+        self.nValid=np.zeros((nR,nt),dtype=int)
+        Qsum=np.zeros((nR,nt))
+        Q2sum=np.zeros((nR,nt))
+        Qref=None
+        pilot=[]
+
+        done=0
+        while done < self.K:
+            k=min(self.ChunkSize,self.K-done)
+            Q=self.CalcQMembers(rng,k)
+            done+=k
+
+            valid=np.isfinite(Q)
+            self.nValid+=valid.sum(axis=0)
+
+            # sums are about the first chunk's mean, to keep the variance accurate
+            if Qref is None:
+                with np.errstate(invalid='ignore'):
+                    Qref=np.nan_to_num(np.nanmean(Q,axis=0))
+            d=np.where(valid,Q-Qref,0.)
+            Qsum+=d.sum(axis=0)
+            Q2sum+=(d**2).sum(axis=0)
+
+            if pilot is None:
+                self.AddToHistogram(Q,valid)
+                continue
+
+            # hold the chunks until there are nPilot members to set the bins from
+            pilot.append(Q)
+            if done >= self.nPilot:
+                Q=np.concatenate(pilot) if len(pilot) > 1 else pilot[0]
+                pilot=None
+                if done == self.K:
+                    # every member is in the pilot: exact quantiles
+                    with np.errstate(invalid='ignore'):
+                        self.Qquantiles=np.nanquantile(Q,self.Quantiles,axis=0)
+                else:
+                    self.InitHistogram(Q)
+                    self.AddToHistogram(Q,np.isfinite(Q))
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+            n=self.nValid
+            self.Qmean=Qref+Qsum/n
+            self.Qstd=np.sqrt(np.maximum(Q2sum/n-(Qsum/n)**2,0.)*n/(n-1))
+        if self.nPilot < self.K:
+            self.Qquantiles=self.HistogramQuantiles()
+
+    def CalcQMembers(self,rng,k):
+        # discharge for k members: (k,nR,nt), nan for reaches without a flow law
+        Obs=self.Obs
+        nR,nt=Obs.D.nR,Obs.D.nt
+
+        sigh=self.ReachSigma(Obs.sigh)
+        sigw=self.ReachSigma(Obs.sigw)
+        sigS=self.ReachSigma(Obs.sigS)
+
+        if self.Project:
+            h=Obs.hobs+sigh*rng.standard_normal((k,nR,nt))
+            w=Obs.wobs+sigw*rng.standard_normal((k,nR,nt))
+            ifit=[r for r in range(nR) if Obs.area_fits[r] is not None]
+            if ifit:
+                fit_coeffs=np.stack([Obs.area_fits[r]['fit_coeffs'][:,:,0] for r in ifit])
+                h_break=np.stack([Obs.area_fits[r]['h_break'][:,0] for r in ifit])
+                hhat,what,isd,fallback=MapPointsToHypsometricCurve(h[:,ifit,:],w[:,ifit,:],
+                        fit_coeffs,h_break,np.broadcast_to(Obs.sigh,(nR,))[ifit],
+                        np.broadcast_to(Obs.sigw,(nR,))[ifit])
+                h[:,ifit,:]=hhat
+                w[:,ifit,:]=what
+        else:
+            h=Obs.h+sigh*rng.standard_normal((k,nR,nt))
+            w=Obs.w+sigw*rng.standard_normal((k,nR,nt))
+        S=Obs.S+sigS*rng.standard_normal((k,nR,nt))
+
+        # with dAOpt=0 this is just the dA of the perturbed h and w
+        dA=Obs.dA+(CalcdAMetroMan(h,w)-self.dA0)
+
+        Q=np.full((k,nR,nt),np.nan)
+        with np.errstate(invalid='ignore',divide='ignore',over='ignore'):
+            for r,cal in enumerate(self.cals):
+                if cal is None or not np.all(np.isfinite(cal.param_est)):
+                    continue
+                FlowLaw=type(cal.FlowLaw)(dA[:,r,:],w[:,r,:],S[:,r,:],h[:,r,:])
+                Q[:,r,:]=FlowLaw.CalcQ(cal.param_est)
+        Q[~np.isfinite(Q)]=np.nan
+
+        return Q
+
+    def ReachSigma(self,sig):
+        # an error standard deviation as a scalar, or (nR,1) or (nR,nt) for broadcasting
+        sig=np.asarray(sig,dtype=float)
+        if sig.ndim == 1:
+            sig=sig[:,np.newaxis]
+        return sig
+
+    def InitHistogram(self,Q):
+        # bins for each overpass, from the spread of the pilot sample
+        with np.errstate(invalid='ignore'):
+            lo=np.nanmin(Q,axis=0)
+            hi=np.nanmax(Q,axis=0)
+        pad=np.nan_to_num(hi-lo)+1e-6*np.abs(np.nan_to_num(lo))+1e-12
+        self.HistLo=np.nan_to_num(lo)-pad
+        self.HistWidth=(np.nan_to_num(hi)+pad-self.HistLo)/self.nBins
+        self.HistCounts=np.zeros(Q.shape[1:]+(self.nBins,),dtype=np.int64)
+
+    def AddToHistogram(self,Q,valid):
+        # values outside the bins are counted in the end bins
+        nBins=self.nBins
+        with np.errstate(invalid='ignore'):
+            ibin=np.clip(np.floor((Q-self.HistLo)/self.HistWidth),0,nBins-1)
+        ibin=np.where(valid,ibin,0).astype(np.int64)
+        cell=np.arange(Q.shape[1]*Q.shape[2]).reshape(Q.shape[1:])
+        flat=(cell*nBins+ibin)[valid]
+        self.HistCounts+=np.bincount(flat,minlength=self.HistCounts.size).reshape(self.HistCounts.shape)
+
+    def HistogramQuantiles(self):
+        # quantiles by linear interpolation within the bins
+        counts=self.HistCounts
+        cum=np.cumsum(counts,axis=-1)
+        n=cum[...,-1]
+        quantiles=np.full((len(self.Quantiles),)+n.shape,np.nan)
+        for i,p in enumerate(self.Quantiles):
+            target=p*n
+            ibin=np.minimum(np.argmax(cum >= target[...,np.newaxis],axis=-1),self.nBins-1)
+            below=np.take_along_axis(cum,ibin[...,np.newaxis],axis=-1)[...,0]-\
+                  np.take_along_axis(counts,ibin[...,np.newaxis],axis=-1)[...,0]
+            inbin=np.take_along_axis(counts,ibin[...,np.newaxis],axis=-1)[...,0]
+            with np.errstate(invalid='ignore',divide='ignore'):
+                frac=np.clip((target-below)/inbin,0.,1.)
+            quantiles[i]=np.where(n > 0,self.HistLo+(ibin+frac)*self.HistWidth,np.nan)
+        return quantiles
@@ -5,17 +5,26 @@ Created on Wed Jan 13 23:49:40 2021
 @author: mtd
 """
 
-from numpy import reshape,concatenate,zeros,ones,triu,empty,arctan,tan,pi,std,\
+from numpy import reshape,zeros,empty,arctan,tan,pi,std,\
    mean,sqrt,var,cov,inf,polyfit,linspace,array,median,piecewise,nanmedian
 import numpy as np
 from scipy import stats,optimize
 import matplotlib.pyplot as plt
 import copy
+import os
 import warnings
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
+from itertools import repeat
+
+# bump this whenever a change to the height-width fitting code changes its results, so 
+#   that fits saved in an AreaFitCache are not reused
+AreaFitVersion=2
 
 class ReachObservations:    
         
-    def __init__(self,D,RiverData,ConstrainHWSwitch=False,CalcAreaFitOpt=0,dAOpt=0,Verbose=False,σW=[]):
+    def __init__(self,D,RiverData,ConstrainHWSwitch=False,CalcAreaFitOpt=0,dAOpt=0,Verbose=False,σW=[],
+                 AreaFitEngine='trust-constr',AreaFitSubDomains=3,nWorkers=1,PoolType='process',
+                 AreaFitCache=None,Lazy=False):
 
         """  Initialize ReachObservation Ojbect. 
             Input Arguments:
@@ -24,9 +33,24 @@ class ReachObservations:
                     1 : use equal-spaced breakpoints; 
                     2 : optimize breakpoints & fits together
                     3 : optimize breakpoints, then optimize fits
+                    4 : globally optimal breakpoints for AreaFitSubDomains sub-domains 
+                        by dynamic programming, then fit with SolveInnerKKT
                 dAOpt= 
                     0 : use MetroMan style calculation; 
                     1 : use SWOT L2 style calculation
+                AreaFitEngine= solver for the inner height-width fit at fixed breakpoints
+                    'trust-constr' : scipy trust-constr with continuity constraints
+                    'kkt' : SolveInnerKKT, a direct solve on the constraint-free basis
+                AreaFitSubDomains= number of height-width sub-domains for CalcAreaFitOpt=4
+                nWorkers= number of workers used to fit the reaches in parallel. 1 runs 
+                    serially; None uses all cores
+                PoolType= 'process' or 'thread' pool for nWorkers > 1
+                AreaFitCache= optional ResultCache. reaches whose h, w, uncertainties and fit
+                    options match a saved fit reuse it instead of being fit again
+                Lazy= if True, steps 2-4 below are not run here. each product (area_fits, 
+                    hobs, hv, dA, ...) is computed the first time it is used, and kept. h and
+                    w are held as read-only views of RiverData, and only copied if 
+                    ConstrainHWSwitch changes them
 
             Flow:
                 1. Assign data
@@ -44,10 +68,25 @@ class ReachObservations:
         self.CalcAreaFitOpt=CalcAreaFitOpt
         self.ConstrainHWSwitch=ConstrainHWSwitch
         self.Verbose=Verbose
+        self.AreaFitEngine=AreaFitEngine
+        self.AreaFitSubDomains=AreaFitSubDomains
+        self.nWorkers=nWorkers
+        self.PoolType=PoolType
+        self.AreaFitCache=AreaFitCache
+        self.dAOpt=dAOpt
 
         # 1 assign data from input dictionary
-        self.h=copy.deepcopy(RiverData["h"])        
-        self.w=copy.deepcopy(RiverData["w"])
+        if Lazy:
+            self.hin=np.asarray(RiverData["h"]).view()
+            self.win=np.asarray(RiverData["w"]).view()
+            self.hin.flags.writeable=False
+            self.win.flags.writeable=False
+            if not ConstrainHWSwitch:
+                self.h=self.hin
+                self.w=self.win
+        else:
+            self.h=copy.deepcopy(RiverData["h"])        
+            self.w=copy.deepcopy(RiverData["w"])
         self.S=RiverData["S"]
         self.h0=RiverData["h0"]
         self.sigh=RiverData["sigh"]
@@ -57,11 +96,14 @@ class ReachObservations:
             self.sigw=σW
         self.sigS=RiverData["sigS"]    
 
+        if Lazy:
+            self.LazyStepsDone=set()
+            self.LazyStepsRunning=set()
+            return
 
         # 2 calculate Area (i.e. H-W) fits for 3 sub-domain using EIV model a la SWOT
         if self.CalcAreaFitOpt > 0:
-            #caution! right now this only runs on reach 0 in this set. 
-            self.CalcAreaFits()
+            self.CalcAllAreaFits()
 
             # not sure what this was intended to do...
             #if ("area_fit") not in globals() :
@@ -74,109 +116,241 @@ class ReachObservations:
             self.plotHW()
 
         # create resahepd versions of observations
+        self.ReshapeObs()
+        
+        # 4 calculate areas
+        self.CalcdA()
+
+    # products computed on first use in lazy mode, and the step that computes each
+    LazyProducts=dict.fromkeys(['h','w','hobs','wobs','hw_subdomain','hw_fallback','stdh_LOChat',
+                                'stdw_LOChat','area_fits','area_fit','Hbp','HWparams'],'LazyConstrainHW')
+    LazyProducts.update(dict.fromkeys(['hv','Sv','wv'],'ReshapeObs'))
+    LazyProducts.update(dict.fromkeys(['dA','dAv','DeltaAHatv'],'CalcdA'))
+
+    def __getattr__(self,name):
+        # only called for attributes that are not set. in lazy mode, run the step that
+        #   computes the product, once. a step is done only once it succeeds, so one that
+        #   fails is run again next time; while it runs, its own products are not lazy
+        step=ReachObservations.LazyProducts.get(name)
+        done=self.__dict__.get('LazyStepsDone')
+        running=self.__dict__.get('LazyStepsRunning')
+        if step is None or done is None or step in done or step in running:
+            raise AttributeError("'ReachObservations' object has no attribute '"+name+"'")
+        running.add(step)
+        try:
+            getattr(self,step)()
+        finally:
+            running.discard(step)
+        done.add(step)
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError("'ReachObservations' object has no attribute '"+name+"'") from None
+
+    def LazyConstrainHW(self):
+        # steps 2 & 3 of __init__, for lazy mode
+        if 'h' not in self.__dict__:
+            self.h=self.hin
+            self.w=self.win
+
+        if self.CalcAreaFitOpt > 0:
+            self.CalcAllAreaFits()
+
+        self.ConstrainHW()
+
+        if self.Verbose:
+            self.plotHW()
+
+    def ReshapeObs(self):
         self.hv=reshape(self.h, (self.D.nR*self.D.nt,1) )
         self.Sv=reshape(self.S, (self.D.nR*self.D.nt,1) )
         self.wv=reshape(self.w, (self.D.nR*self.D.nt,1) )
-        
-        # 4 calculate areas
+
+    def CalcdA(self):
         #   check area calculation option
-        if dAOpt==1 and ( "area" not in globals() ):
+        if self.dAOpt==1 and ( "area" not in globals() or not hasattr(self,'area_fits') ):
              if self.Verbose:
                   print('Warning: ReachObservations tried to use', 
                      'SWOT-style area calcs, but no area function available.')
                   print('Using MetroMan-style instead')
-             dAOpt=0
+             self.dAOpt=0
 
         # calculate
-        if dAOpt == 0:
+        if self.dAOpt == 0:
              if self.Verbose:
                 print('MetroMan-style area calculations')
              DeltaAHat=empty( (self.D.nR,self.D.nt-1) )
              self.DeltaAHatv = self.calcDeltaAHatv(DeltaAHat)
-             self.dA= concatenate(  (zeros( (self.D.nR,1) ), DeltaAHat @ triu(ones( (self.D.nt-1,self.D.nt-1) ),0)),1 )
-             self.dAv=self.D.CalcU() @ self.DeltaAHatv
-        elif dAOpt == 1:
+             # dA is the cumulative sum of the increments; overpasses with no h or w get nan
+             self.dAv=self.D.CalcUOperator() @ self.DeltaAHatv
+             igood=np.logical_and(np.isfinite(self.hv),np.isfinite(self.wv))
+             self.dAv[np.logical_not(igood)]=np.nan
+             self.dA=reshape(self.dAv,(self.D.nR,self.D.nt))
+        elif self.dAOpt == 1:
              if self.Verbose:
                 print('SWOT-style area calculations')
-             self.dA=empty( (self.D.nR,self.D.nt)   )
-             for t in range(self.D.nt):
-                 self.dA[0,t],what,hhat,dAUnc=area(self.h[0,t],self.w[0,t],self.area_fit)
-                 #if ConstrainHWSwitch and not np.isnan(hhat):
-                 #    self.h[0,t]=hhat
-                 #    self.w[0,t]=what
+             self.dA=np.full( (self.D.nR,self.D.nt),np.nan   )
+             for r,area_fit in enumerate(self.area_fits):
+                 if area_fit is not None:
+                     self.dA[r,:],what,hhat,dAUnc=AreaFit(area_fit).area(self.h[r,:],self.w[r,:])
+                 #if ConstrainHWSwitch:
+                 #    self.h[r,:]=np.where(np.isnan(hhat),self.h[r,:],hhat)
+                 #    self.w[r,:]=np.where(np.isnan(hhat),self.w[r,:],what)
              
              if self.Verbose:
                      self.plotHdA()
 
+    def CalcObsPartials(self):
+        # how errors in the observed h and w reach the H, W and dA the flow laws use, for
+        #   FlowLaws.CalcQUnObs. a dict of (nR,nt) arrays:
+        #   dHdh, dHdw, dWdh, dWdw= derivatives of H and W with respect to the observed h
+        #       and w. with ConstrainHWSwitch, H and W are the observations projected 
+        #       onto the sub-domain height-width fits, which takes out much of their 
+        #       error. otherwise H=h and W=w
+        #   dAdH, dAdW= derivatives of dA with respect to H and W at the same overpass
+        #   dAVarH, dAVarW= variance of dA from the h and w errors at other overpasses
+        #   for MetroMan-style areas these are exact to first order (dAMetroManPartials).
+        #   for SWOT-style areas dA follows the area fit, so it changes by the width for a
+        #   change in height, and does not depend on other overpasses
+        shape=(self.D.nR,self.D.nt)
+        one=np.ones(shape)
+        zero=np.zeros(shape)
+        partials={'dHdh':one,'dHdw':zero,'dWdh':zero,'dWdw':one}
+
+        if self.ConstrainHWSwitch:
+            # slope of the sub-domain fit each point was projected onto (Fuller 1.3.17)
+            ifit=[r for r in range(self.D.nR) if self.area_fits[r] is not None]
+            for key in partials:
+                partials[key]=partials[key].copy()
+            for r in ifit:
+                p1=self.area_fits[r]['fit_coeffs'][0,:,0][np.maximum(self.hw_subdomain[r,:],0)]
+                svv=self.sigw**2+p1**2*self.sigh**2
+                k=-p1*self.sigh**2/svv
+                # points put on a breakpoint do not move with the data
+                moving=np.logical_not(self.hw_fallback[r,:])
+                partials['dHdh'][r,:]=np.where(moving,1+k*p1,0.)
+                partials['dHdw'][r,:]=np.where(moving,-k,0.)
+                partials['dWdh'][r,:]=np.where(moving,p1*(1+k*p1),0.)
+                partials['dWdw'][r,:]=np.where(moving,-p1*k,0.)
+
+        if self.dAOpt == 0:
+            dAdH,dAdW,dAVarH,dAVarW=dAMetroManPartials(self.h,self.w,self.sigh,self.sigw,partials)
+        else:
+            dAdH=np.where(np.isfinite(self.dA),self.w,np.nan)
+            dAdW=dAVarH=dAVarW=np.where(np.isfinite(self.dA),0.,np.nan)
+        partials.update(dAdH=dAdH,dAdW=dAdW,dAVarH=dAVarH,dAVarW=dAVarW)
+
+        return partials
+
     def calcDeltaAHatv(self, DeltaAHat):
-        
-        for r in range(0,self.D.nR):
-            for t in range(0,self.D.nt-1):
-                DeltaAHat[r,t]=(self.w[r,t]+self.w[r,t+1])/2 * (self.h[r,t+1]-self.h[r,t])
+        # trapezoid area increments between successive overpasses, all reaches at once
+        DeltaAHat[:,:]=DeltaAHatIncrements(self.h,self.w)
          
         # changed how this part works compared with Matlab, avoiding translating calcU
         return reshape(DeltaAHat,(self.D.nR*(self.D.nt-1),1) )
     
     def ConstrainHW(self):
+
+        # in lazy mode h and w are read-only views of the input data, so hobs and wobs 
+        #   can share them. h and w are copied only if they are about to be changed
+        ReadOnly=not self.h.flags.writeable
+        if ReadOnly and self.ConstrainHWSwitch:
+            self.h=self.h.copy()
+            self.w=self.w.copy()
         
         if self.CalcAreaFitOpt == 0:
             # calculate single sub-domain height-width-area fits and project data
-            #   onto calculated line
-            self.hobs=copy.deepcopy(self.h[0,:])
-            self.wobs=copy.deepcopy(self.w[0,:])
-
-            #range-normalize data
-            x=self.hobs
-            y=self.wobs
-            x_range=max(x)-min(x)        
-            x_mean=mean(x) 
-            xn=(x-x_mean)/x_range
-            y_range=max(y)-min(y)        
-            y_mean=mean(y) 
-            yn=(y-y_mean)/y_range
-        
-            #[m,b]=self.FitLOC(xn,yn)
-            [m,b]=self.FitEIV(xn,yn)
-            mo=-tan(pi/2-arctan(m))
- 
-            #projet w,h onto LOC or EIV
-            hhatn=(yn-mo*xn-b)/(m-mo)
-            whatn=m*hhatn+b
-
-            #un-normalize data
-            hhat=hhatn*x_range+x_mean
-            what=whatn*y_range+y_mean
+            #   onto calculated line. all reaches are done at once; missing data are masked
+            if ReadOnly:
+                self.hobs=self.hin
+                self.wobs=self.win
+            else:
+                self.hobs=copy.deepcopy(self.h)
+                self.wobs=copy.deepcopy(self.w)
+
+            with np.errstate(divide='ignore',invalid='ignore'):
+                igood=np.logical_and(np.isfinite(self.hobs),np.isfinite(self.wobs))
+                x=np.where(igood,self.hobs,np.nan)
+                y=np.where(igood,self.wobs,np.nan)
+
+                #range-normalize data. reaches with no data stay nan
+                ifit=np.any(igood,axis=1)
+                x_range,x_mean,y_range,y_mean=np.full((4,self.D.nR,1),np.nan)
+                x_range[ifit]=np.nanmax(x[ifit],axis=1,keepdims=True)-np.nanmin(x[ifit],axis=1,keepdims=True)
+                x_mean[ifit]=np.nanmean(x[ifit],axis=1,keepdims=True)
+                xn=(x-x_mean)/x_range
+                y_range[ifit]=np.nanmax(y[ifit],axis=1,keepdims=True)-np.nanmin(y[ifit],axis=1,keepdims=True)
+                y_mean[ifit]=np.nanmean(y[ifit],axis=1,keepdims=True)
+                yn=(y-y_mean)/y_range
+
+                m,b=FitEIVBatch(xn,yn)
+                m=m[:,np.newaxis]
+                b=b[:,np.newaxis]
+                mo=-tan(pi/2-arctan(m))
+
+                #projet w,h onto EIV
+                hhatn=(yn-mo*xn-b)/(m-mo)
+                whatn=m*hhatn+b
+
+                #un-normalize data
+                hhat=hhatn*x_range+x_mean
+                what=whatn*y_range+y_mean
+
+                hres=self.hobs-hhat
+                wres=self.wobs-what
+
+                # one value per reach, nan for a reach with no projected data. note these
+                #   were scalars for reach 0 before every reach was projected
+                ifit=np.any(np.isfinite(hres),axis=1)
+                self.stdh_LOChat=np.full(self.D.nR,np.nan)
+                self.stdw_LOChat=np.full(self.D.nR,np.nan)
+                self.stdh_LOChat[ifit]=np.nanstd(hres[ifit,:],axis=1)
+                self.stdw_LOChat[ifit]=np.nanstd(wres[ifit,:],axis=1)
 
-            hres=self.h[0,:]-hhat
-            wres=self.w[0,:]-what
+            if self.ConstrainHWSwitch:
+                 # reaches or overpasses that could not be projected keep their data
+                 iproj=np.isfinite(hhat)
+                 self.h=np.where(iproj,hhat,self.h)
+                 self.w=np.where(iproj,what,self.w)
+        else: # if there are several sub-domains
+            if ReadOnly:
+                self.hobs=self.hin
+                self.wobs=self.win
+            else:
+                self.hobs=copy.deepcopy(self.h)
+                self.wobs=copy.deepcopy(self.w)
 
-            self.stdh_LOChat=std(hres)
-            self.stdw_LOChat=std(wres)
+            ifit=[r for r in range(self.D.nR) if self.area_fits[r] is not None]
+            if not ifit:
+                return
 
-            if self.ConstrainHWSwitch:
-                 self.h[0,:]=hhat
-                 self.w[0,:]=what
-        else: # if there are three sub-domains
-            self.hobs=copy.deepcopy(self.h[0,:])
-            self.wobs=copy.deepcopy(self.w[0,:])
+            # project all reaches and points at once. points that miss every sub-domain are 
+            #   flagged in hw_fallback rather than printed one at a time
+            fit_coeffs=np.stack([self.area_fits[r]['fit_coeffs'][:,:,0] for r in ifit])
+            h_break=np.stack([self.area_fits[r]['h_break'][:,0] for r in ifit])
+            hhat,what,hw_subdomain,hw_fallback=MapPointsToHypsometricCurve(self.hobs[ifit,:],self.wobs[ifit,:],
+                    fit_coeffs,h_break,self.sigh,self.sigw)
 
-            hhat=np.empty((1,self.D.nt))
-            what=np.empty((1,self.D.nt))
+            self.hw_subdomain=np.full( (self.D.nR,self.D.nt),-1 )
+            self.hw_subdomain[ifit,:]=hw_subdomain
+            self.hw_fallback=np.zeros( (self.D.nR,self.D.nt),dtype=bool )
+            self.hw_fallback[ifit,:]=hw_fallback
 
-            for i in range(self.D.nt):
-                hhat[0,i],what[0,i]=self.MapPointToHypsometricCurve(self.hobs[i],self.wobs[i])
+            if self.Verbose and np.any(self.hw_fallback):
+                print(np.count_nonzero(self.hw_fallback),'data points did not map to a valid sub-domain...')
 
             if self.ConstrainHWSwitch:
-                 self.h[0,:]=hhat[0,:]
-                 self.w[0,:]=what[0,:]
+                 self.h[ifit,:]=hhat
+                 self.w[ifit,:]=what
 
-            
-            self.area_fit['h_break'][0]=np.nanmin(hhat)
-            self.area_fit['h_break'][3]=np.nanmax(hhat)
+            for i,r in enumerate(ifit):
+                self.area_fits[r]['h_break'][0]=np.nanmin(hhat[i,:])
+                self.area_fits[r]['h_break'][-1]=np.nanmax(hhat[i,:])
                 
 
     def MapPointToHypsometricCurve(self,h,w):
-        sds=[0,1,2]
+        nsd=self.area_fit['fit_coeffs'].shape[1]
+        sds=range(nsd)
 
         hhat=np.nan
         what=np.nan
@@ -188,7 +362,7 @@ class ReachObservations:
 
             DataInSubdomain = (hhatsd >= self.area_fit['h_break'][sd] and hhatsd < self.area_fit['h_break'][sd+1] )
             DataValidExtrapLow = (sd ==0 and hhatsd < self.area_fit['h_break'][0])
-            DataValidExtrapHi = (sd == 2 and hhatsd > self.area_fit['h_break'][2])
+            DataValidExtrapHi = (sd == nsd-1 and hhatsd > self.area_fit['h_break'][nsd-1])
             DataValidExtrap = DataValidExtrapHi or DataValidExtrapLow
 
             if DataInSubdomain or DataValidExtrap:
@@ -202,7 +376,7 @@ class ReachObservations:
             close_break = np.argmin(np.abs(self.area_fit['h_break'] - h))
 
             # If hhat is beyond the maximum observed h, map point to final breakpoint
-            if close_break == 3:
+            if close_break == nsd:
 
                 # Retrieve final region fit
                 p0 = self.area_fit['fit_coeffs'][1, close_break-1, 0]  # intercept
@@ -245,16 +419,18 @@ class ReachObservations:
 
         if hasattr(self,'area_fit'):
 
-            for sd in range(3):
+            for sd in range(self.area_fit['fit_coeffs'].shape[1]):
                 htest=linspace(self.area_fit['h_break'][sd],self.area_fit['h_break'][sd+1],10)
                 wtest=self.area_fit['fit_coeffs'][0,sd,0]*htest+self.area_fit['fit_coeffs'][1,sd,0]
                 #plt.plot(htest,wtest,color='C0')
                 plt.plot(htest,wtest,color='tab:orange')
         
         if self.ConstrainHWSwitch:
+            hobs=np.atleast_2d(self.hobs)[0,:]
+            wobs=np.atleast_2d(self.wobs)[0,:]
             for i in range(self.D.nt):
-                ax.plot([self.hobs[i],self.h[0,i]],[self.wobs[i],self.w[0,i]],color='grey')
-            ax.scatter(self.hobs,self.wobs,marker='o')   
+                ax.plot([hobs[i],self.h[0,i]],[wobs[i],self.w[0,i]],color='grey')
+            ax.scatter(hobs,wobs,marker='o')   
             ax.scatter(self.h[0,:],self.w[0,:],marker='o')   
         else: 
             ax.scatter(self.h[0,:],self.w[0,:],marker='o')   
@@ -328,188 +504,349 @@ class ReachObservations:
 
         return beta1hat, beta0hat
 
-    def CalcAreaFits(self,r=0):
+    def CalcAllAreaFits(self):
+        # compute the SWOT-like height-width fit for every reach, and save them in 
+        #   self.area_fits, indexed by reach. the fits are independent, so with nWorkers
+        #   other than 1 they run on a pool of processes or threads. self.area_fit, 
+        #   self.Hbp and self.HWparams hold the reach 0 fit, as before
+
+        if self.sigw<0:
+             self.sigw=10 
+
+        # reuse fits for reaches whose inputs have been fit before
+        fits=[None]*self.D.nR
+        if self.AreaFitCache is not None:
+             keys=[self.AreaFitCache.MakeKey(AreaFitVersion,self.h[r,:],self.w[r,:],self.sigh,self.sigw,
+                        self.CalcAreaFitOpt,self.AreaFitEngine,self.AreaFitSubDomains) for r in range(self.D.nR)]
+             fits=[self.AreaFitCache.Load(key) for key in keys]
+             if self.Verbose:
+                 print('CalcAllAreaFits: reusing saved fits for',self.D.nR-fits.count(None),'of',self.D.nR,'reaches')
+
+        ifit=[r for r in range(self.D.nR) if fits[r] is None]
+
+        args=(self.h[ifit,:],self.w[ifit,:],repeat(self.sigh),repeat(self.sigw),repeat(self.CalcAreaFitOpt),
+              repeat(self.AreaFitEngine),repeat(self.AreaFitSubDomains),repeat(self.Verbose))
 
-        warnings.filterwarnings("ignore", message="delta_grad == 0.0. Check if the approximated function is linear.")
+        # scipy's optimizers change the global warning filters while they run, so they are
+        #   not thread safe. only the pure numpy fits (SolveInnerKKT at set breakpoints, and
+        #   the dynamic programming option) can use threads
+        ThreadSafe=self.CalcAreaFitOpt == 4 or (self.CalcAreaFitOpt == 1 and self.AreaFitEngine == 'kkt')
 
-        # this computes the SWOT-like height-width fit
+        if self.nWorkers == 1 or len(ifit) <= 1:
+             newfits=list(map(CalcAreaFit,*args))
+        else:
+             if self.PoolType == 'thread' and ThreadSafe:
+                 Executor=ThreadPoolExecutor
+             else:
+                 if self.PoolType == 'thread' and self.Verbose:
+                     print('CalcAllAreaFits: these height-width fits are not thread safe. Using processes instead.')
+                 Executor=ProcessPoolExecutor
+             nWorkers=self.nWorkers or os.cpu_count()
+             with Executor(max_workers=nWorkers) as pool:
+                 newfits=list(pool.map(CalcAreaFit,*args,chunksize=max(1,len(ifit)//(4*nWorkers))))
+
+        for r,fit in zip(ifit,newfits):
+             fits[r]=fit
+             if self.AreaFitCache is not None and fit is not None:
+                 self.AreaFitCache.Save(keys[r],fit)
+
+        self.area_fits=[None if fit is None else fit[0] for fit in fits]
+        if fits[0] is not None:
+             self.area_fit,self.Hbp,self.HWparams=fits[0]
 
- 	# r : reach ID
+        return
 
-        # outer level parameter vector:
-        # po = Hb0,Hb1 i.e. WSE breakpoint 0, then WSE breakpoint 1
-        # inner level parameter vector:
-        # pi = p00, p01, p10, p11, p20,p21 i.e. p[domain 0][coefficient 0], p[domain 0][coefficient 1], p[domain 1][coefficient 0],...
+    def CalcAreaFits(self,r=0):
+        # compute the SWOT-like height-width fit for reach r. see CalcAreaFit
 
-        #0 check uncertainties
         if self.sigw<0:
              self.sigw=10 
-        igoodh=np.logical_not(np.isnan(self.h[r,:]))
-        igoodw=np.logical_not(np.isnan(self.w[r,:]))
-        igoodhw=np.logical_and(igoodh,igoodw)
 
-        if not any(igoodhw):
-            print('No good data. Not computing height-width fits.')
+        fit=CalcAreaFit(self.h[r,:],self.w[r,:],self.sigh,self.sigw,self.CalcAreaFitOpt,
+                        self.AreaFitEngine,self.AreaFitSubDomains,self.Verbose)
+        if fit is None:
             return
 
-        #1 choose initial parameters for outer loop
+        self.area_fit,self.Hbp,self.HWparams=fit
+
+        return
+
+    def UpdateAreaFit(self,hnew,wnew,r=0):
+        # refine the height-width fit for reach r with new observations hnew, wnew, e.g.
+        #   from the latest overpass, without fitting from scratch. the breakpoints are
+        #   kept; the fit coefficients are re-solved with SolveInnerKKTMoments, warm started
+        #   from the current ones. the data enter only through running sums kept in
+        #   self.area_fit_stats, so the data already used are never rescanned. 
+        #   returns the updated area_fit.
+        #   only the fit is updated: the new overpasses are not added to h, w, hobs, wobs
+        #   or dA, which hold the nt overpasses of every reach in the domain, and which
+        #   are not recomputed with the new fit. to calibrate with the new overpasses, 
+        #   the caller builds a ReachObservations on the extended data, e.g. with an 
+        #   AreaFitCache holding these updated fits
+
+        # with CalcAreaFitOpt=0 there are no fits at all
+        area_fits=getattr(self,'area_fits',None)
+        area_fit=None if area_fits is None else area_fits[r]
+        if area_fit is None:
+            print('UpdateAreaFit: no height-width fit for reach',r,'to update')
+            return None
+
+        Hbp=area_fit['h_break'][1:-1,0]
+
+        # running sums of the data used for the fit, set up on the first update
+        if not hasattr(self,'area_fit_stats'):
+            self.area_fit_stats=[None]*self.D.nR
+        fit_stats=self.area_fit_stats[r]
+        if fit_stats is None:
+            h=self.hobs[r,:]
+            w=self.wobs[r,:]
+            igoodhw=np.logical_and(np.isfinite(h),np.isfinite(w))
+            fit_stats={}
+            fit_stats['href']=mean(h[igoodhw])
+            fit_stats['moments']=SubDomainMoments(h[igoodhw],w[igoodhw],Hbp,fit_stats['href'])
+            fit_stats['hsorted']=np.sort(h[np.isfinite(h)])
+            fit_stats['wsorted']=np.sort(w[np.isfinite(w)])
+            self.area_fit_stats[r]=fit_stats
+
+        hnew=np.atleast_1d(np.asarray(hnew,dtype=float))
+        wnew=np.atleast_1d(np.asarray(wnew,dtype=float))
+        igoodhw=np.logical_and(np.isfinite(hnew),np.isfinite(wnew))
+
+        fit_stats['moments']+=SubDomainMoments(hnew[igoodhw],wnew[igoodhw],Hbp,fit_stats['href'])
+        for key,x in (('hsorted',hnew),('wsorted',wnew)):
+            x=np.sort(x[np.isfinite(x)])
+            fit_stats[key]=np.insert(fit_stats[key],np.searchsorted(fit_stats[key],x),x)
+
+        # re-solve the fit at the same breakpoints, starting from the current one
+        HWparams=reshape(area_fit['fit_coeffs'][:,:,0],-1,order='F')
+        J,HWparams=SolveInnerKKTMoments(Hbp,fit_stats['moments'],fit_stats['href'],self.sigh,self.sigw,HWparams)
+
+        nsd=len(Hbp)+1
+        for sd in range(nsd):
+            area_fit['fit_coeffs'][:,sd,0]=HWparams[2*sd:2*sd+2]
+
+        # dataset stats, from the summed moments. heights are shifted by href, which
+        #   does not change the variances
+        n,Sh,Sw,Shh,Sww,Shw=fit_stats['moments'].sum(axis=0)
+        area_fit['h_variance']=array(Shh/n-(Sh/n)**2)
+        area_fit['w_variance']=array(Sww/n-(Sw/n)**2)
+        area_fit['hw_covariance']=(Shw-Sh*Sw/n)/(n-1)
+        area_fit['h_w_nobs']=area_fit['h_w_nobs']+np.count_nonzero(igoodhw)
+
+        # ConstrainHW sets the end breakpoints to the range of the projected heights, so
+        #   the new points are projected onto the updated fit in the same way
+        if np.any(igoodhw):
+            hhat,what,isd,fallback=MapPointsToHypsometricCurve(hnew[igoodhw],wnew[igoodhw],
+                    area_fit['fit_coeffs'][:,:,0],area_fit['h_break'][:,0],self.sigh,self.sigw)
+            area_fit['h_break'][0]=min(area_fit['h_break'][0,0],np.nanmin(hhat))
+            area_fit['h_break'][-1]=max(area_fit['h_break'][-1,0],np.nanmax(hhat))
+
+        # area at the median height, as in PackAreaFit
+        area_fit['med_flow_area']=array(0.)
+        dA_Hbar,hhat,what,dAunc=area(np.median(fit_stats['hsorted']),np.median(fit_stats['wsorted']),area_fit)
+        area_fit['med_flow_area']=dA_Hbar
 
-        WSEmin=min(self.h[r,igoodhw])
-        WSEmax=max(self.h[r,igoodhw])
-        WSErange=WSEmax-WSEmin
-        WSErange=WSEmax-WSEmin
-        init_params_outer=[WSEmin+WSErange/3, WSEmin+2*WSErange/3]
+        if r == 0:
+            self.area_fit=area_fit
+            self.HWparams=HWparams
 
-        #2 compute a solution where we set the breakpoints at 1/3 of the way through the domain
-        ReturnSolution=True
-        Jset,p_inner_set=SSE_outer(init_params_outer,self.h[r,igoodhw],self.w[r,igoodhw],ReturnSolution,self.sigh,self.sigw,self.Verbose)
-
-        #if self.Verbose:
-        #    print('height-width fit for set breakpoints')
-        #    plot3SDfit(self.h[r,:],self.w[r,:],p_inner_set,init_params_outer)
-
-        #3 optimize both inner and outer loop simultaneously
-
-        #3.1 parameter bounds
-        nparams_outer=len(init_params_outer)
-        lb=zeros(nparams_outer,)
-        ub=zeros(nparams_outer,)
-
-        lb[0]=WSEmin+WSErange*0.1
-        ub[0]=WSEmin+WSErange*0.9
-        lb[1]=WSEmin+WSErange*0.1
-        ub[1]=WSEmin+WSErange*0.9
-
-        param_bounds_outer=optimize.Bounds(lb,ub)
-
-        #3.2 constrain breakpoints to be monotonic
-        A=array([[1,-1]])
-        constraint2=optimize.LinearConstraint(A,-inf,-0.1)    
-
-        #3.3 nested solution to three-subdomain fit
-        if self.CalcAreaFitOpt == 2:
-            #3.3.1 optimize breakpoints
-            ReturnSolution=False
-            res = optimize.minimize(fun=SSE_outer,
-                    x0=init_params_outer,
-                    args=(self.h[r,:],self.w[r,:],ReturnSolution,self.sigh,self.sigw,self.Verbose),
-                    bounds=param_bounds_outer,
-                    method='trust-constr',    
-                    constraints=constraint2,
-                    options={'disp':self.Verbose,'maxiter':1e2,'verbose':0})
-
-            params_outer_hat=res.x
-
-            #3.3.2 compute optimal fits for optimal breakpoints
-            ReturnSolution=True
-            [Jnest,params_inner_nest]=SSE_outer(params_outer_hat,self.h[r,:],self.w[r,:],ReturnSolution,self.sigh,self.sigw,self.Verbose)
-
-#            if self.Verbose:
-#                 print('height-width fit for nested optimization')
-#                 plot3SDfit(self.h[r,:],self.w[r,:],params_inner_nest,params_outer_hat)
-
-        #3.3.3 determine whether to use optimal breakpoint solution or equal-spaced breakpoints 
-        if self.CalcAreaFitOpt == 2  and(res.success or (Jnest<Jset)):
-             print('nested optimiztion sucess:',res.success)
-             print('nested objective:',Jnest)
-             print('set objective function:',Jset)
-             print('using nested solution')
-             self.Hbp=params_outer_hat
-             self.HWparams=params_inner_nest
-        else:
-             self.Hbp=init_params_outer
-             self.HWparams= p_inner_set
-
-        #3.4 compute simple optimal breakpoints, then compute fits
-        if self.CalcAreaFitOpt == 3:
-             #3.4.1 optimize breakpoints 
-             def piecewise_linear2(x, x0, y0, x1, k1, k2, k3):
-                 return piecewise(x, [x < x0, ((x>=x0)&(x<x1)), x>=x1], \
-                     [lambda x:k1*x + y0-k1*x0, lambda x:k2*x + y0-k2*x0, lambda x:k3*x + k2*x1+y0-k2*x0-k3*x1])
-
-             p2 , e2 = optimize.curve_fit(piecewise_linear2, self.h[r,igoodhw], self.w[r,igoodhw],\
-                     bounds=([lb[0],-inf,lb[0],0,0,0],[ub[0],inf,ub[0],inf,inf,inf]),\
-                     p0=[init_params_outer[0],mean(self.w[r,igoodhw]),init_params_outer[1],0,0,0] )
- 
-             #this specifies the two WSE breakpoints
-             params_outer_hat=[p2[0],p2[2]]
+        return area_fit
 
-             #3.4.2 compute parameters
-             ReturnSolution=True
-             Jsimple,p_inner_simple=SSE_outer(params_outer_hat,self.h[r,igoodhw],self.w[r,igoodhw],ReturnSolution,self.sigh,self.sigw,self.Verbose)
+def CalcAreaFit(h,w,sigh,sigw,CalcAreaFitOpt,AreaFitEngine='trust-constr',AreaFitSubDomains=3,Verbose=False):
 
-             #if self.Verbose:
-             #    print('height-width fit for simple optimized breakpoints')
-             #    plot3SDfit(self.h[r,:],self.w[r,:],p_inner_simple,params_outer_hat)
- 
-             #3.4.3 determine whether to use optimal breakpoint solution or equal-spaced breakpoints 
-             #if self.Verbose:
-                  #print('simple objective:',Jsimple)
-                  #print('set objective function:',Jset)
-             if Jset < Jsimple or p2[0] > p2[2]:  
-                 if self.Verbose:
-                     if p2[0] > p2[2]:
-                         print('p2[0]>p2[2]. p2[0]=', p2[0], 'p2[2]=', p2[2])
-                     print('using set breakpoint fit')
-                 self.Hbp = init_params_outer
-                 self.HWparams = p_inner_set
-             else:
-                 if self.Verbose:
-                     print('using simple solution ')
-                 self.Hbp = params_outer_hat
-                 self.HWparams = p_inner_simple
-
-        #4 pack up fit parameter data matching swot-format 
-        #4.0 initialize
-        area_fit={}
-        #4.1 set the dataset stats
-        area_fit['h_variance']=array(var(self.h[r,igoodhw]))
-        area_fit['w_variance']=array(var(self.w[r,igoodhw]))
-        hwcov=cov(self.w[r,igoodhw],self.h[r,igoodhw])
-        area_fit['hw_covariance']=hwcov[0,1]
-        area_fit['med_flow_area']=array(0.) #this value estimated as described below 
-        area_fit['h_err_stdev']=array(self.sigh)
-        area_fit['w_err_stdev']=array(self.sigw)
-        area_fit['h_w_nobs']=array(self.D.nt)
-
-        #4.2 set fit_coeffs aka parameters aka coefficients - translate to SWOT L2 style format
-        # pi = p00, p01, p10, p11, p20,p21 i.e. p[domain 0][coefficient 0], p[domain 0][coefficient 1], p[domain 1][coefficient 0],...
-        nsd=3
-        ncoef=2
-        area_fit['fit_coeffs']=zeros((ncoef,nsd,1))
-        for sd in range(nsd):
-            for coef in range(ncoef):
-                param_indx=sd*ncoef+coef
-                area_fit['fit_coeffs'][coef,sd] = self.HWparams[param_indx]
+    warnings.filterwarnings("ignore", message="delta_grad == 0.0. Check if the approximated function is linear.")
 
-        #4.3 set h_break
-        area_fit['h_break']=zeros((4,1))
-        area_fit['h_break'][0]=np.nanmin(self.h[r,:])
-        area_fit['h_break'][1]=self.Hbp[0]
-        area_fit['h_break'][2]=self.Hbp[1]
-        area_fit['h_break'][3]=np.nanmax(self.h[r,:])
+    # this computes the SWOT-like height-width fit for one reach. it only depends on its 
+    #   arguments, so reaches can be fit independently, e.g. on a worker pool
 
-        #4.4 set w_break... though i do not think this get used so just initializing for now
-        area_fit['w_break']=zeros((4,1))
+    # h,w : WSE and width timeseries for the reach
+    # returns area_fit, Hbp, HWparams; or None if there are no good data
 
-        #4.5 calculate cross-sectional area at median value of H
-        # a bit confusing, but we are centering the dA on the median H. so to get a dA value that
-        # coresponds to Hbar, we set dA_hbar to zero, then evaluate the area fit at a value of 
-        # Hbar. That returns the area value at median H that we use going forward
-        Hbar=nanmedian(self.h[r,:])
-        wbar=nanmedian(self.w[r,:])
+    # outer level parameter vector:
+    # po = Hb0,Hb1 i.e. WSE breakpoint 0, then WSE breakpoint 1
+    # inner level parameter vector:
+    # pi = p00, p01, p10, p11, p20,p21 i.e. p[domain 0][coefficient 0], p[domain 0][coefficient 1], p[domain 1][coefficient 0],...
 
-        dA_Hbar,hhat,what,dAunc=area(Hbar, wbar, area_fit)
+    #0 check uncertainties
+    if sigw<0:
+         sigw=10 
+    igoodh=np.logical_not(np.isnan(h))
+    igoodw=np.logical_not(np.isnan(w))
+    igoodhw=np.logical_and(igoodh,igoodw)
 
-        area_fit['med_flow_area']=dA_Hbar
+    if not any(igoodhw):
+        print('No good data. Not computing height-width fits.')
+        return None
+
+    #1 option 4 finds all breakpoints at once and does not need the three sub-domain steps below
+    if CalcAreaFitOpt == 4:
+         Hbp=CalcBreakpointsDP(h[igoodhw],w[igoodhw],AreaFitSubDomains,sigh,sigw)
+         Jdp,HWparams=SolveInnerKKT(Hbp,h[igoodhw],w[igoodhw],sigh,sigw)
+         if Verbose:
+             print('dynamic programming breakpoints:',Hbp,'objective:',Jdp)
+         return PackAreaFit(h,w,igoodhw,Hbp,HWparams,sigh,sigw),Hbp,HWparams
+
+    #1 choose initial parameters for outer loop
+
+    WSEmin=min(h[igoodhw])
+    WSEmax=max(h[igoodhw])
+    WSErange=WSEmax-WSEmin
+    WSErange=WSEmax-WSEmin
+    init_params_outer=[WSEmin+WSErange/3, WSEmin+2*WSErange/3]
+
+    #2 compute a solution where we set the breakpoints at 1/3 of the way through the domain
+    ReturnSolution=True
+    Jset,p_inner_set=SSE_outer(init_params_outer,h[igoodhw],w[igoodhw],ReturnSolution,sigh,sigw,Verbose,AreaFitEngine)
+
+    #if Verbose:
+    #    print('height-width fit for set breakpoints')
+    #    plot3SDfit(h,w,p_inner_set,init_params_outer)
+
+    #3 optimize both inner and outer loop simultaneously
+
+    #3.1 parameter bounds
+    nparams_outer=len(init_params_outer)
+    lb=zeros(nparams_outer,)
+    ub=zeros(nparams_outer,)
+
+    lb[0]=WSEmin+WSErange*0.1
+    ub[0]=WSEmin+WSErange*0.9
+    lb[1]=WSEmin+WSErange*0.1
+    ub[1]=WSEmin+WSErange*0.9
+
+    param_bounds_outer=optimize.Bounds(lb,ub)
 
-        #4.6 save fit data
-        self.area_fit=area_fit
+    #3.2 constrain breakpoints to be monotonic
+    A=array([[1,-1]])
+    constraint2=optimize.LinearConstraint(A,-inf,-0.1)    
 
-        #if self.Verbose:
-            #print('area fit parameters=',self.area_fit)
+    #3.3 nested solution to three-subdomain fit
+    if CalcAreaFitOpt == 2:
+        #3.3.1 optimize breakpoints
+        ReturnSolution=False
+        res = optimize.minimize(fun=SSE_outer,
+                x0=init_params_outer,
+                args=(h,w,ReturnSolution,sigh,sigw,Verbose,AreaFitEngine),
+                bounds=param_bounds_outer,
+                method='trust-constr',    
+                constraints=constraint2,
+                options={'disp':Verbose,'maxiter':1e2,'verbose':0})
 
-        return 
+        params_outer_hat=res.x
+
+        #3.3.2 compute optimal fits for optimal breakpoints
+        ReturnSolution=True
+        [Jnest,params_inner_nest]=SSE_outer(params_outer_hat,h,w,ReturnSolution,sigh,sigw,Verbose,AreaFitEngine)
+
+#        if Verbose:
+#             print('height-width fit for nested optimization')
+#                 plot3SDfit(h,w,params_inner_nest,params_outer_hat)
+
+    #3.3.3 determine whether to use optimal breakpoint solution or equal-spaced breakpoints 
+    if CalcAreaFitOpt == 2  and(res.success or (Jnest<Jset)):
+         print('nested optimiztion sucess:',res.success)
+         print('nested objective:',Jnest)
+         print('set objective function:',Jset)
+         print('using nested solution')
+         Hbp=params_outer_hat
+         HWparams=params_inner_nest
+    else:
+         Hbp=init_params_outer
+         HWparams= p_inner_set
+
+    #3.4 compute simple optimal breakpoints, then compute fits
+    if CalcAreaFitOpt == 3:
+         #3.4.1 optimize breakpoints 
+         def piecewise_linear2(x, x0, y0, x1, k1, k2, k3):
+             return piecewise(x, [x < x0, ((x>=x0)&(x<x1)), x>=x1], \
+                 [lambda x:k1*x + y0-k1*x0, lambda x:k2*x + y0-k2*x0, lambda x:k3*x + k2*x1+y0-k2*x0-k3*x1])
+
+         p2 , e2 = optimize.curve_fit(piecewise_linear2, h[igoodhw], w[igoodhw],\
+                 bounds=([lb[0],-inf,lb[0],0,0,0],[ub[0],inf,ub[0],inf,inf,inf]),\
+                 p0=[init_params_outer[0],mean(w[igoodhw]),init_params_outer[1],0,0,0] )
+ 
+         #this specifies the two WSE breakpoints
+         params_outer_hat=[p2[0],p2[2]]
+
+         #3.4.2 compute parameters
+         ReturnSolution=True
+         Jsimple,p_inner_simple=SSE_outer(params_outer_hat,h[igoodhw],w[igoodhw],ReturnSolution,sigh,sigw,Verbose,AreaFitEngine)
+
+         #if Verbose:
+         #    print('height-width fit for simple optimized breakpoints')
+         #    plot3SDfit(h,w,p_inner_simple,params_outer_hat)
+ 
+         #3.4.3 determine whether to use optimal breakpoint solution or equal-spaced breakpoints 
+         #if Verbose:
+              #print('simple objective:',Jsimple)
+              #print('set objective function:',Jset)
+         if Jset < Jsimple or p2[0] > p2[2]:  
+             if Verbose:
+                 if p2[0] > p2[2]:
+                     print('p2[0]>p2[2]. p2[0]=', p2[0], 'p2[2]=', p2[2])
+                 print('using set breakpoint fit')
+             Hbp = init_params_outer
+             HWparams = p_inner_set
+         else:
+             if Verbose:
+                 print('using simple solution ')
+             Hbp = params_outer_hat
+             HWparams = p_inner_simple
+
+    #4 pack up fit parameter data matching swot-format 
+    return PackAreaFit(h,w,igoodhw,Hbp,HWparams,sigh,sigw),Hbp,HWparams
+
+def PackAreaFit(h,w,igoodhw,Hbp,HWparams,sigh,sigw):
+    # translate the breakpoints in Hbp and the fits in HWparams into a SWOT 
+    #   L2 style area_fit dict
+
+    #4.0 initialize
+    area_fit={}
+    #4.1 set the dataset stats
+    area_fit['h_variance']=array(var(h[igoodhw]))
+    area_fit['w_variance']=array(var(w[igoodhw]))
+    hwcov=cov(w[igoodhw],h[igoodhw])
+    area_fit['hw_covariance']=hwcov[0,1]
+    area_fit['med_flow_area']=array(0.) #this value estimated as described below 
+    area_fit['h_err_stdev']=array(sigh)
+    area_fit['w_err_stdev']=array(sigw)
+    area_fit['h_w_nobs']=array(np.count_nonzero(igoodhw))
+
+    #4.2 set fit_coeffs aka parameters aka coefficients - translate to SWOT L2 style format
+    # pi = p00, p01, p10, p11, p20,p21 i.e. p[domain 0][coefficient 0], p[domain 0][coefficient 1], p[domain 1][coefficient 0],...
+    nsd=len(Hbp)+1
+    ncoef=2
+    area_fit['fit_coeffs']=zeros((ncoef,nsd,1))
+    for sd in range(nsd):
+        for coef in range(ncoef):
+            param_indx=sd*ncoef+coef
+            area_fit['fit_coeffs'][coef,sd] = HWparams[param_indx]
+
+    #4.3 set h_break
+    area_fit['h_break']=zeros((nsd+1,1))
+    area_fit['h_break'][0]=np.nanmin(h)
+    for sd in range(1,nsd):
+        area_fit['h_break'][sd]=Hbp[sd-1]
+    area_fit['h_break'][nsd]=np.nanmax(h)
+
+    #4.4 set w_break... though i do not think this get used so just initializing for now
+    area_fit['w_break']=zeros((nsd+1,1))
+
+    #4.5 calculate cross-sectional area at median value of H
+    # a bit confusing, but we are centering the dA on the median H. so to get a dA value that
+    # coresponds to Hbar, we set dA_hbar to zero, then evaluate the area fit at a value of 
+    # Hbar. That returns the area value at median H that we use going forward
+    Hbar=nanmedian(h)
+    wbar=nanmedian(w)
+
+    dA_Hbar,hhat,what,dAunc=area(Hbar, wbar, area_fit)
+
+    area_fit['med_flow_area']=dA_Hbar
+
+    #if Verbose:
+        #print('area fit parameters=',area_fit)
+
+    return area_fit
 
 def ChooseInitParamsInner(h,w):
     #function to choose initial parameters describing SWOT-like height-width fit
@@ -551,7 +888,14 @@ def SetInnerParamBounds(nparams):
     return lb,ub
 
 # define outer objective function, with inner objective function nested within
-def SSE_outer(param_outer,h,w,ReturnSolution,sigh,sigw,Verbose):
+def SSE_outer(param_outer,h,w,ReturnSolution,sigh,sigw,Verbose,Engine='trust-constr'):
+
+    if Engine == 'kkt':
+        J,params_inner=SolveInnerKKT(param_outer,h,w,sigh,sigw)
+        if ReturnSolution:
+            return J,params_inner
+        else:
+            return J
     
     [init_params_inner,nparams_inner]=ChooseInitParamsInner(h,w)
     
@@ -601,6 +945,302 @@ def SSE_outer(param_outer,h,w,ReturnSolution,sigh,sigw,Verbose):
     else:
         return res.fun
 
+def SolveInnerKKT(param_outer,h,w,sigh,sigw,maxiter=100,tol=1e-10):
+    """
+    Solves the inner sub-domain height-width fit of SSE_outer directly, as an 
+    alternative to trust-constr. Same objective (Fuller 1.3.20 in each sub-domain), 
+    same constraints, same output layout: p00, p01, p10, p11, p20, p21, ...
+    param_outer holds the nsd-1 breakpoints, so any number of sub-domains works.
+    The data enter only through their sub-domain moments; see SolveInnerKKTMoments.
+    """
+
+    href=mean(h)
+    moments=SubDomainMoments(h,w,param_outer,href)
+
+    return SolveInnerKKTMoments(param_outer,moments,href,sigh,sigw,None,maxiter,tol)
+
+def SubDomainMoments(h,w,param_outer,href):
+    # sufficient statistics of the height-width data in each sub-domain: 
+    #   n, sum(h'), sum(w), sum(h'^2), sum(w^2), sum(h'w), where h'=h-href. 
+    #   moments of new data can simply be added to these
+
+    x=np.atleast_1d(np.asarray(param_outer,dtype=float))
+    nsd=len(x)+1
+
+    isd=np.searchsorted(x,h,side='right') if nsd > 1 else np.zeros(np.shape(h),dtype=int)
+    hp=h-href
+
+    moments=zeros((nsd,6))
+    for k,stat in enumerate( (np.ones(np.shape(h)),hp,w,hp*hp,w*w,hp*w) ):
+        moments[:,k]=np.bincount(isd,weights=stat,minlength=nsd)[0:nsd]
+
+    return moments
+
+def SolveInnerKKTMoments(param_outer,moments,href,sigh,sigw,init_params_inner=None,maxiter=100,tol=1e-10):
+    """
+    Core of SolveInnerKKT, working from sub-domain moments (see SubDomainMoments) 
+    rather than the data, so it costs the same however many observations there are.
+    init_params_inner optionally warm-starts it from a previous fit, in the 
+    p00, p01, p10, p11, ... layout; otherwise it starts from the single sub-domain fit.
+
+    The continuity constraints are linear, so they are eliminated by writing every 
+    sub-domain line in terms of theta = [v, s0, s1, ...], where v is the width at the 
+    first breakpoint and s are the slopes. The objective is then a ratio of quadratics
+    in nsd+1 unknowns; the Fuller weights depend on slope, so it is minimized with a 
+    damped Newton iteration on the exact gradient and Hessian. The slope >= 0 bounds are
+    handled as an active set. Heights are shifted by href to keep the sums well 
+    conditioned.
+    """
+
+    x=np.atleast_1d(np.asarray(param_outer,dtype=float))-href
+    nsd=len(x)+1
+    ntheta=nsd+1
+    xref=x[0] if nsd > 1 else 0.
+
+    #1 per-sub-domain normal equations: w_hat = X @ theta within each sub-domain, where 
+    #   each row of X is u + h'*e
+    G=zeros((nsd,ntheta,ntheta))
+    c=zeros((nsd,ntheta))
+    q=zeros(nsd)
+    for sd in range(nsd):
+        n,Sh,Sw,Shh,Sww,Shw=moments[sd]
+        u=zeros(ntheta)
+        e=zeros(ntheta)
+        u[0]=1.
+        if sd == 0:
+            u[1]=-xref
+        else:
+            u[2:sd+1]=np.diff(x[:sd])
+            u[sd+1]=-x[sd-1]
+        e[sd+1]=1.
+        G[sd]=n*np.outer(u,u) + Sh*(np.outer(u,e)+np.outer(e,u)) + Shh*np.outer(e,e)
+        c[sd]=Sw*u + Shw*e
+        q[sd]=Sww
+
+    #2 objective, gradient and hessian. d is the Fuller variance, R the sum of squares
+    isd=np.arange(nsd)
+    def SSE_theta(theta,derivs=False):
+        d=sigw**2 + theta[1:]**2 * sigh**2
+        Gtheta=np.einsum('kij,j->ki',G,theta)
+        R=Gtheta @ theta - 2*c @ theta + q
+        J=sum(R/d)
+        if not derivs:
+            return J
+
+        gR=2*(Gtheta-c)
+        gd=zeros((nsd,ntheta))
+        gd[isd,isd+1]=2*sigh**2*theta[1:]
+        g=np.sum(gR/d[:,np.newaxis] - R[:,np.newaxis]*gd/d[:,np.newaxis]**2,axis=0)
+        H=zeros((ntheta,ntheta))
+        for sd in range(nsd):
+            H+=2*G[sd]/d[sd] - (np.outer(gR[sd],gd[sd])+np.outer(gd[sd],gR[sd]))/d[sd]**2 \
+                + 2*R[sd]*np.outer(gd[sd],gd[sd])/d[sd]**3
+            H[sd+1,sd+1]-=2*sigh**2*R[sd]/d[sd]**2
+        return J,g,H
+
+    #3 start from the previous fit, or from the single sub-domain fit as trust-constr does
+    if init_params_inner is not None:
+        slopes=np.maximum(np.asarray(init_params_inner[0::2],dtype=float),0.)
+        theta=np.concatenate(([init_params_inner[0]*(xref+href)+init_params_inner[1]], slopes))
+    else:
+        n,Sh,Sw,Shh,Sww,Shw=moments.sum(axis=0)
+        slope=(Shw-Sh*Sw/n)/(Shh-Sh**2/n)
+        theta=np.concatenate(([(Sw-slope*Sh)/n+slope*xref], np.full(nsd,max(slope,0.))))
+
+    #4 projected newton, with slopes at zero and pushing down held in the active set
+    for it in range(maxiter):
+        J,g,H=SSE_theta(theta,True)
+        active=np.concatenate(([False], (theta[1:]<=0) & (g[1:]>0) ))
+        free=np.logical_not(active)
+
+        # the hessian is indefinite away from the solution: flip & floor its eigenvalues
+        ev,V=np.linalg.eigh(H[np.ix_(free,free)])
+        ev=np.maximum(np.abs(ev),1e-8*max(np.abs(ev).max(),1e-300))
+        step=zeros(ntheta)
+        step[free]=-V @ ((V.T @ g[free])/ev)
+
+        # backtracking line search on the projected step
+        t=1.
+        while True:
+            theta_new=theta+t*step
+            theta_new[1:]=np.maximum(theta_new[1:],0.)
+            if SSE_theta(theta_new) <= J+1e-4*g @ (theta_new-theta) or t < 1e-10:
+                break
+            t/=2
+
+        converged=np.max(np.abs(theta_new-theta)) <= tol*(1+np.max(np.abs(theta)))
+        theta=theta_new
+        if converged:
+            break
+
+    #5 translate back to slope & intercept for each sub-domain, in unshifted heights
+    slopes=theta[1:]
+    wbreak=theta[0]+np.concatenate(([0.,0.], np.cumsum(slopes[1:-1]*np.diff(x))))[:nsd]
+    xbreak=np.concatenate(([xref], x))
+    params_inner=zeros(2*nsd)
+    params_inner[0::2]=slopes
+    params_inner[1::2]=wbreak-slopes*(xbreak+href)
+
+    return SSE_theta(theta),params_inner
+
+def FitEIVBatch(x,y,delta=1.0):
+    # ReachObservations.FitEIV for many reaches at once: x and y are (nR,nt), and NaN 
+    #   values are left out. returns the slope and intercept for each reach. as in 
+    #   FitEIV, the variances are population variances and the covariance is a sample one
+
+    igood=np.logical_and(np.isfinite(x),np.isfinite(y))
+    n=np.count_nonzero(igood,axis=1)
+    x=np.where(igood,x,0.)
+    y=np.where(igood,y,0.)
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        mx=np.sum(x,axis=1)/n
+        my=np.sum(y,axis=1)/n
+        dx=np.where(igood,x-mx[:,np.newaxis],0.)
+        dy=np.where(igood,y-my[:,np.newaxis],0.)
+
+        mXX=np.sum(dx*dx,axis=1)/n
+        mYY=np.sum(dy*dy,axis=1)/n
+        mXY=np.sum(dx*dy,axis=1)/(n-1)
+
+        beta1hat=((mYY-delta*mXX)+( (mYY-delta*mXX)**2 + 4*delta*mXY**2   )**0.5 ) / (2*mXY)
+
+    beta0hat=my-beta1hat*mx
+
+    return beta1hat, beta0hat
+
+def MapPointsToHypsometricCurve(h,w,fit_coeffs,h_break,sigh,sigw):
+    """
+    Batch version of ReachObservations.MapPointToHypsometricCurve: projects every 
+    height-width observation onto the sub-domain fits (Fuller 1.3.17) in one pass.
+
+    h, w - observations, shape (nt,) for one reach or (nR,nt) for several
+    fit_coeffs - slope (row 0) and intercept (row 1) of each sub-domain fit, shape 
+        (2,nsd) or (nR,2,nsd), i.e. area_fit['fit_coeffs'] without its last axis
+    h_break - WSE breakpoints, shape (nsd+1,) or (nR,nsd+1)
+    sigh, sigw - height & width error standard deviations, scalars or one per reach
+
+    Returns hhat, what, the sub-domain used for each point, and a mask of the points 
+    that did not map into a valid sub-domain and were put on the nearest breakpoint 
+    instead. Missing observations stay nan and are not counted as fallbacks.
+    """
+
+    h=np.asarray(h,dtype=float)[...,np.newaxis]
+    w=np.asarray(w,dtype=float)[...,np.newaxis]
+    fit_coeffs=np.asarray(fit_coeffs,dtype=float)
+    p1=fit_coeffs[...,0,np.newaxis,:] #slope
+    p0=fit_coeffs[...,1,np.newaxis,:] #intercept
+    h_break=np.asarray(h_break,dtype=float)[...,np.newaxis,:]
+    sigh=np.asarray(sigh,dtype=float)[...,np.newaxis,np.newaxis]
+    sigw=np.asarray(sigw,dtype=float)[...,np.newaxis,np.newaxis]
+    nsd=fit_coeffs.shape[-1]
+
+    #1 project each point onto every sub-domain fit, as in MapPointToSubDomain
+    vhat=w-p0-p1*h
+    suv=-p1*sigh**2
+    svv=sigw**2 + p1**2 * sigh**2
+    hhatsd=h-suv/svv*vhat
+    whatsd=p0+p1*hhatsd
+
+    #2 keep the last sub-domain whose projection lands inside it, or extrapolates validly
+    with np.errstate(invalid='ignore'):
+        valid=np.logical_and(hhatsd >= h_break[...,:-1], hhatsd < h_break[...,1:])
+        valid[...,0]=np.logical_or(valid[...,0],hhatsd[...,0] < h_break[...,0])
+        valid[...,-1]=np.logical_or(valid[...,-1],hhatsd[...,-1] > h_break[...,nsd-1])
+    mapped=np.any(valid,axis=-1)
+    isd=nsd-1-np.argmax(valid[...,::-1],axis=-1)
+
+    #3 fallback: put the point on the breakpoint closest to h, using the nearest fit
+    close_break=np.argmin(np.abs(np.nan_to_num(h_break-h,nan=inf)),axis=-1)
+    isd_fallback=np.minimum(close_break,nsd-1)
+
+    observed=np.logical_and(np.isfinite(h[...,0]),np.isfinite(w[...,0]))
+    fallback=np.logical_and(observed,np.logical_not(mapped))
+    isd=np.where(mapped,isd,isd_fallback)
+
+    def pick(x,i):
+        # x[...,i] for a different i at every point
+        x=np.broadcast_to(x,h.shape[:-1]+x.shape[-1:])
+        return np.take_along_axis(x,i[...,np.newaxis],axis=-1)[...,0]
+
+    hbreak=pick(h_break,close_break)
+    hhat=np.where(fallback,hbreak,pick(hhatsd,isd))
+    what=np.where(fallback,pick(p0,isd)+pick(p1,isd)*hbreak,pick(whatsd,isd))
+    hhat=np.where(observed,hhat,np.nan)
+    what=np.where(observed,what,np.nan)
+
+    return hhat,what,isd,fallback
+
+def CalcBreakpointsDP(h,w,nsd,sigh,sigw,MaxCandidates=200,MinObsPerSD=3):
+    """
+    Finds the nsd-1 WSE breakpoints that minimize the total Fuller ratio-of-variances 
+    misfit of nsd independent sub-domain lines, by dynamic programming over the sorted 
+    heights. Each sub-domain cost comes from prefix sums of the sorted data in O(1), so 
+    the search is exact over the candidate breakpoints. Candidates are the midpoints 
+    between successive distinct heights, thinned to at most MaxCandidates, so the cost 
+    is O(n log n + nsd*MaxCandidates^2) however many observations there are.
+
+    Continuity between sub-domains is not part of the DP cost; it is imposed afterwards
+    when the fit is computed at these breakpoints with SolveInnerKKT.
+    """
+
+    isort=np.argsort(h)
+    hs=h[isort]-mean(h)
+    ws=w[isort]-mean(w)
+    n=len(hs)
+
+    #1 candidate cut positions m: sub-domain boundary between sorted points m-1 and m
+    m=np.arange(MinObsPerSD,n-MinObsPerSD+1)
+    m=m[hs[m-1]<hs[np.minimum(m,n-1)]]
+    if len(m) > MaxCandidates:
+        m=m[np.round(linspace(0,len(m)-1,MaxCandidates)).astype(int)]
+    cuts=np.concatenate(([0],m,[n]))
+    ncuts=len(cuts)
+
+    #2 fuller sub-domain cost for every pair of cuts, from prefix sums
+    def prefix(x):
+        return np.concatenate(([0.],np.cumsum(x)))[cuts]
+    S=[prefix(x) for x in (np.ones(n),hs,ws,hs*hs,ws*ws,hs*ws)]
+    nobs,Sh,Sw,Shh,Sww,Shw=[x[np.newaxis,:]-x[:,np.newaxis] for x in S]
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        mX=Sh/nobs
+        mY=Sw/nobs
+        mXX=np.maximum(Shh/nobs-mX**2,0.)
+        mYY=np.maximum(Sww/nobs-mY**2,0.)
+        mXY=Shw/nobs-mX*mY
+
+        # Fuller 1.3.7, with slope >= 0: a negative correlation gets a flat line
+        delta=sigw**2/sigh**2
+        beta1hat=((mYY-delta*mXX)+( (mYY-delta*mXX)**2 + 4*delta*mXY**2 )**0.5 ) / (2*mXY)
+        beta1hat=np.where(mXY>0,beta1hat,0.)
+        cost=nobs*np.maximum(mYY-2*beta1hat*mXY+beta1hat**2*mXX,0.)/(sigw**2+beta1hat**2*sigh**2)
+
+    cost[np.logical_not(nobs >= MinObsPerSD)]=inf
+
+    #3 dynamic program: E[k,j] = best cost of k+1 sub-domains covering cuts 0..j
+    E=np.full((nsd,ncuts),inf)
+    iprev=zeros((nsd,ncuts),dtype=int)
+    E[0]=cost[0]
+    for k in range(1,nsd):
+        total=E[k-1][:,np.newaxis]+cost
+        iprev[k]=np.argmin(total,axis=0)
+        E[k]=total[iprev[k],np.arange(ncuts)]
+
+    if not np.isfinite(E[nsd-1,-1]):
+        print('CalcBreakpointsDP: not enough data for',nsd,'sub-domains. Using equal-spaced breakpoints.')
+        return (min(h)+(max(h)-min(h))*np.arange(1,nsd)/nsd).tolist()
+
+    #4 trace the optimal cuts back, and put breakpoints halfway between the heights
+    j=ncuts-1
+    icut=[]
+    for k in range(nsd-1,0,-1):
+        j=iprev[k,j]
+        icut.insert(0,cuts[j])
+    hs=hs+mean(h)
+
+    return [(hs[i-1]+hs[i])/2 for i in icut]
+
 def plot3SDfit(h,w,params_inner,params_outer):
     fig,ax = plt.subplots()
     ax.scatter(h,w,marker='o')
@@ -623,6 +1263,105 @@ def plot3SDfit(h,w,params_inner,params_outer):
 # the area and estimate_height functions below are copy and pasted from discharge.py 
 # in the offline-discharge-data-product-creation repo. february 3, 2022 -mike
 
+def DeltaAHatIncrements(h,w):
+    """
+    MetroMan-style trapezoid area increments between successive overpasses. h and w have
+    time along the last axis, e.g. (nR,nt) or (K,nR,nt); the increments are (...,nt-1).
+    If h or w is missing at an overpass, the next increment spans back to the last good
+    overpass, so a gap does not poison dA for the rest of the series.
+    """
+
+    igood=np.logical_and(np.isfinite(h),np.isfinite(w))
+    nt=h.shape[-1]
+
+    # index of the last good overpass before each of t=1..nt-1 (-1 if there is none)
+    ilast=np.maximum.accumulate(np.where(igood,np.arange(nt),-1),axis=-1)
+    iprev=ilast[...,:-1]
+
+    hprev=np.take_along_axis(h,np.maximum(iprev,0),axis=-1)
+    wprev=np.take_along_axis(w,np.maximum(iprev,0),axis=-1)
+
+    with np.errstate(invalid='ignore'):
+        return np.where(np.logical_and(igood[...,1:],iprev>=0),
+                        (wprev+w[...,1:])/2 * (h[...,1:]-hprev), 0.)
+
+def CalcdAMetroMan(h,w):
+    """
+    MetroMan-style dA for h and w with time along the last axis: the running sum of 
+    DeltaAHatIncrements, zero at the first overpass, and nan where h or w is missing.
+    Same as ReachObservations.CalcdA with dAOpt=0, for any number of leading axes.
+    """
+
+    dA=np.zeros(np.broadcast(h,w).shape)
+    np.cumsum(DeltaAHatIncrements(h,w),axis=-1,out=dA[...,1:])
+    dA[np.logical_not(np.logical_and(np.isfinite(h),np.isfinite(w)))]=np.nan
+
+    return dA
+
+def dAMetroManPartials(h,w,sigh,sigw,Projection=None):
+    """
+    First-order error propagation through CalcdAMetroMan, for h and w with time along the
+    last axis and independent errors sigh and sigw (scalars, one per reach, or one per
+    observation). dA at overpass t sums the trapezoids back to the first good overpass,
+    so it depends on h and w there and at every good overpass in between.
+
+    Returns dAdH and dAdW, the derivatives of dA with respect to the h and w of the same 
+    overpass, and dAVarH and dAVarW, the variance dA gets from the h and w errors of the
+    earlier overpasses. All are zero at the first good overpass and nan where h or w is
+    missing. If h and w were themselves projected from observations, Projection is a 
+    dict of their derivatives dHdh, dHdw, dWdh and dWdw with respect to the 
+    observations, as in ReachObservations.CalcObsPartials, and sigh and sigw are the
+    errors of the observations.
+    """
+
+    igood=np.logical_and(np.isfinite(h),np.isfinite(w))
+    nt=h.shape[-1]
+    it=np.arange(nt)
+
+    def ObsVariance(sig):
+        sig=np.asarray(sig,dtype=float)
+        if sig.ndim == 1:
+            sig=sig[:,np.newaxis]
+        return np.broadcast_to(sig**2,h.shape)
+
+    # the good overpasses just before and just after each one (-1 or nt if none)
+    ilast=np.maximum.accumulate(np.where(igood,it,-1),axis=-1)
+    inext=np.minimum.accumulate(np.where(igood,it,nt)[...,::-1],axis=-1)[...,::-1]
+    iprev=np.concatenate((np.full(h.shape[:-1]+(1,),-1),ilast[...,:-1]),axis=-1)
+    inext=np.concatenate((inext[...,1:],np.full(h.shape[:-1]+(1,),nt)),axis=-1)
+
+    def At(x,i):
+        return np.take_along_axis(x,np.clip(i,0,nt-1),axis=-1)
+    hp,wp=At(h,iprev),At(w,iprev)
+    hn,wn=At(h,inext),At(w,inext)
+
+    first=np.logical_and(igood,iprev < 0)
+    later=np.logical_and(igood,iprev >= 0)
+
+    with np.errstate(invalid='ignore'):
+        # own overpass: the trapezoid back to the previous good overpass
+        dAdH=np.where(later,(wp+w)/2,0.)
+        dAdW=np.where(later,(h-hp)/2,0.)
+
+        # as an earlier overpass: the trapezoids on either side of it
+        inner=np.logical_and(igood,inext < nt)
+        ch=np.where(first,-(w+wn)/2,(wp-wn)/2)
+        cw=np.where(first,(hn-h)/2,(hn-hp)/2)
+        if Projection is not None:
+            ch,cw=ch*Projection['dHdh']+cw*Projection['dWdh'],ch*Projection['dHdw']+cw*Projection['dWdw']
+        VarH=np.where(inner,ch**2*ObsVariance(sigh),0.)
+        VarW=np.where(inner,cw**2*ObsVariance(sigw),0.)
+
+    # sum over the earlier overpasses only
+    dAVarH=np.cumsum(VarH,axis=-1)-VarH
+    dAVarW=np.cumsum(VarW,axis=-1)-VarW
+
+    missing=np.logical_not(igood)
+    for x in (dAdH,dAdW,dAVarH,dAVarW):
+        x[missing]=np.nan
+
+    return dAdH,dAdW,dAVarH,dAVarW
+
 def area(observed_height, observed_width, area_fits):
     """
     Provides a nicer interface for _area wrapping up the unpacking of prior
@@ -633,10 +1372,9 @@ def area(observed_height, observed_width, area_fits):
     area_fits - dictionary of things extracted from prior DB
     """
     height_breakpoints = np.squeeze(area_fits['h_break'])
+    fit_coeffs = np.asarray(area_fits['fit_coeffs'])
     poly_fits = [
-        np.squeeze(area_fits['fit_coeffs'])[:, 0],
-        np.squeeze(area_fits['fit_coeffs'])[:, 1],
-        np.squeeze(area_fits['fit_coeffs'])[:, 2]]
+        fit_coeffs[:, sd].ravel() for sd in range(fit_coeffs.shape[1])]
 
     area_median_flow = np.squeeze(area_fits['med_flow_area'])
 
@@ -762,3 +1500,111 @@ def estimate_height(observed_width, observed_height, poly_fit, fit_width_var,
     sigma_uv = -poly_fit[0] * fit_height_var
     v = observed_width - poly_fit[1] - poly_fit[0] * observed_height
     return observed_height - v * sigma_uv/sigma_vv
+
+class AreaFit:
+    """
+    Array version of area(). The area_fits dict is unpacked once, and area() then 
+    evaluates any number of height-width observations in one pass, with the same 
+    branches as _area: the estimated height within a sub-domain, and the extrapolation
+    above and below the breakpoints.
+    """
+
+    def __init__(self,area_fits):
+        fit_coeffs=np.asarray(area_fits['fit_coeffs'])
+        fit_coeffs=np.reshape(fit_coeffs,fit_coeffs.shape[0:2])
+
+        self.height_breakpoints=np.ravel(area_fits['h_break']).astype(float)
+        self.height_fits_ll=self.height_breakpoints[0:-1]
+        self.height_fits_ul=self.height_breakpoints[1:]
+        self.slopes=fit_coeffs[0,:]
+        self.intercepts=fit_coeffs[1,:]
+
+        self.area_median_flow=float(np.squeeze(area_fits['med_flow_area']))
+        self.fit_width_var=float(np.squeeze(area_fits['w_err_stdev']))**2
+        self.fit_height_var=float(np.squeeze(area_fits['h_err_stdev']))**2
+        self.low_height_snr=(float(np.squeeze(area_fits['h_variance']))
+                             - self.fit_height_var)/self.fit_height_var < 2
+
+        # integral of each sub-domain fit from its lower breakpoint, and the area for 
+        #   heights above the top breakpoint, which only depend on the fit
+        self.area_ll=self.IntegrateFit(self.height_fits_ll,np.arange(len(self.slopes)))
+        self.area_above=(self.IntegrateFit(self.height_breakpoints[-1],-1)
+                         - self.IntegrateFit(self.height_breakpoints[-2],-1)
+                         + self.area_median_flow)
+
+    def IntegrateFit(self,height,ifit):
+        # antiderivative of fit ifit at height, as np.polyval(np.polyint(fit),height)
+        return (self.slopes[ifit]/2*height + self.intercepts[ifit])*height
+
+    def FindSubDomain(self,height):
+        # index of the first sub-domain containing each height, and whether there is one
+        in_sd=np.logical_and(height[...,np.newaxis] >= self.height_fits_ll,
+                             height[...,np.newaxis] < self.height_fits_ul)
+        return np.argmax(in_sd,axis=-1),np.any(in_sd,axis=-1)
+
+    def EstimateHeight(self,observed_width,observed_height,ifit):
+        # estimate_height for each observation, using sub-domain ifit
+        sigma_vv = self.fit_width_var + self.slopes[ifit]**2 * self.fit_height_var
+        sigma_uv = -self.slopes[ifit] * self.fit_height_var
+        v = observed_width - self.intercepts[ifit] - self.slopes[ifit] * observed_height
+        return observed_height - v * sigma_uv/sigma_vv
+
+    def area(self,observed_height,observed_width):
+        """
+        observed_height - swot observed heights, any shape
+        observed_width - swot observed widths, broadcastable against observed_height
+        returns delta_area_hat, observed_width_hat, observed_height_hat, dAunc, shaped 
+            like the broadcast inputs
+        """
+        observed_height,observed_width=np.broadcast_arrays(
+            np.asarray(observed_height,dtype=float),np.asarray(observed_width,dtype=float))
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+            #1 heights that fall in a sub-domain
+            ifit,in_fit=self.FindSubDomain(observed_height)
+            if self.low_height_snr:
+                observed_height_hat=observed_height
+            else:
+                observed_height_hat=self.EstimateHeight(observed_width,observed_height,ifit)
+
+            ifit_hat,in_fit_hat=self.FindSubDomain(observed_height_hat)
+            ifit=np.where(in_fit_hat,ifit_hat,ifit)
+            observed_height_hat=np.where(in_fit_hat,
+                self.EstimateHeight(observed_width,observed_height,ifit),observed_height_hat)
+
+            if self.low_height_snr:
+                observed_width_hat=observed_width
+            else:
+                observed_width_hat=self.slopes[ifit]*observed_height_hat+self.intercepts[ifit]
+
+            # sum the sub-domain integrals up to and including ifit
+            isd=np.arange(len(self.slopes))
+            area_sd=(self.IntegrateFit(np.minimum(observed_height_hat[...,np.newaxis],self.height_fits_ul),isd)
+                     - self.area_ll)
+            area_sd=np.where(isd <= ifit[...,np.newaxis],area_sd,0.)
+            delta_area_hat=np.sum(area_sd,axis=-1)-self.area_median_flow
+
+            slope=self.slopes[ifit]
+            height_ul=self.height_fits_ul[ifit]
+            mu = (np.sqrt(slope/2) * (observed_height_hat - height_ul)
+                  + (slope*height_ul+self.intercepts[ifit]) / np.sqrt(2 * slope))
+            sigma = np.sqrt(slope/2) * np.sqrt(self.fit_height_var)
+            dAunc = np.where(slope == 0, self.intercepts[ifit]*np.sqrt(self.fit_height_var),
+                             np.sqrt(4*mu**2*sigma**2 + 2*sigma**4))
+
+            #2 heights outside the breakpoints
+            above=observed_height > self.height_breakpoints.max()
+            delta_area_out=np.where(above,self.area_above,
+                - self.area_median_flow - ((self.height_breakpoints[0]-observed_height)
+                * (observed_width + self.slopes[0]*self.height_breakpoints[0]
+                + self.intercepts[0])/2))
+            height_edge=np.where(above,self.height_breakpoints[-1],self.height_breakpoints[0])
+            dAunc_out=np.sqrt(self.fit_height_var*observed_width**2 +
+                2*self.fit_width_var*(observed_height-height_edge)**2)
+
+            delta_area_hat=np.where(in_fit,delta_area_hat,delta_area_out)
+            observed_width_hat=np.where(in_fit,observed_width_hat,observed_width)
+            observed_height_hat=np.where(in_fit,observed_height_hat,np.nan)
+            dAunc=np.where(in_fit,dAunc,dAunc_out)
+
+        return delta_area_hat[()],observed_width_hat[()],observed_height_hat[()],dAunc[()]
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 12:16:33 2026
+
+@author: mtd
+"""
+
+import os
+import pickle
+import hashlib
+import tempfile
+from numpy import ascontiguousarray,ndarray
+
+class ResultCache:
+    # on-disk cache of computed results, keyed by a hash of everything that went into
+    #   computing them. each entry is one pickle file in CacheDir. when the files add up
+    #   to more than MaxBytes, the least recently used ones are deleted, down to 
+    #   EvictFraction of MaxBytes. the size of the cache is counted once, when it is 
+    #   opened, and then kept up to date as entries are saved, so a save does not look
+    #   at the rest of the directory unless it pushes the total over MaxBytes. entries 
+    #   written by other processes sharing CacheDir are only counted at the next eviction
+
+    def __init__(self,CacheDir,MaxBytes=1e9,EvictFraction=0.9):
+        self.CacheDir=CacheDir
+        self.MaxBytes=MaxBytes
+        self.EvictFraction=EvictFraction
+        os.makedirs(self.CacheDir,exist_ok=True)
+
+        self.hits=0
+        self.misses=0
+        self.nbytes=sum(entry[1] for entry in self.Entries())
+
+    def MakeKey(self,*parts):
+        # hash of the inputs. arrays are hashed by dtype, shape and contents
+        sha=hashlib.sha256()
+        for part in parts:
+            if isinstance(part,ndarray):
+                part=ascontiguousarray(part)
+                sha.update(repr((part.dtype.str,part.shape)).encode())
+                sha.update(part.tobytes())
+            else:
+                sha.update(repr(part).encode())
+            sha.update(b'|')
+        return sha.hexdigest()
+
+    def Path(self,key):
+        return os.path.join(self.CacheDir,key+'.pkl')
+
+    def Load(self,key):
+        # returns the cached result, or None if there is none
+        try:
+            with open(self.Path(key),'rb') as fid:
+                result=pickle.load(fid)
+        except (OSError,EOFError,pickle.UnpicklingError):
+            self.misses+=1
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(self.Path(key))
+        except OSError:
+            pass
+
+        self.hits+=1
+        return result
+
+    def Save(self,key,result):
+        # write to a temporary file first, so other processes never read a partial entry
+        fd,tmpname=tempfile.mkstemp(dir=self.CacheDir,suffix='.tmp')
+        with os.fdopen(fd,'wb') as fid:
+            pickle.dump(result,fid,protocol=pickle.HIGHEST_PROTOCOL)
+            size=fid.tell()
+
+        # an entry that is replaced no longer counts
+        try:
+            self.nbytes-=os.stat(self.Path(key)).st_size
+        except OSError:
+            pass
+        os.replace(tmpname,self.Path(key))
+        self.nbytes+=size
+
+        if self.nbytes > self.MaxBytes:
+            self.Evict()
+
+    def Entries(self):
+        # (last used time, size, path) of each entry
+        entries=[]
+        for entry in os.scandir(self.CacheDir):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat=entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime,stat.st_size,entry.path))
+        return entries
+
+    def Evict(self):
+        # delete least recently used entries until the cache fits in EvictFraction of 
+        #   MaxBytes. the directory is recounted, which also picks up entries saved by
+        #   other processes
+        entries=self.Entries()
+        self.nbytes=sum(entry[1] for entry in entries)
+        for mtime,size,path in sorted(entries):
+            if self.nbytes <= self.EvictFraction*self.MaxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.nbytes-=size
+
+    def Clear(self):
+        for entry in os.scandir(self.CacheDir):
+            if entry.name.endswith('.pkl'):
+                os.remove(entry.path)
+        self.nbytes=0
@@ -0,0 +1,42 @@
+# fixtures for the checks in this directory: the bundled example data, read once.
+#   run with python -m pytest from the repository directory
+
+import os
+import sys
+import io
+import contextlib
+
+import pytest
+
+RepoDir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,RepoDir)
+
+from RiverIO import RiverIO
+from Domain import Domain
+from ReachObservations import ReachObservations
+from ReachTruth import ReachTruth
+
+# bundled test cases: directory and observation file name
+DataSets={'ArcticDEMSag':'SWOTobs.txt','PepsiSac':'SWOTObs.txt'}
+
+def ReadData(name):
+    BaseDir=os.path.join(RepoDir,name)
+    IO=RiverIO('MetroManTxt',obsFname=os.path.join(BaseDir,DataSets[name]),
+               truthFname=os.path.join(BaseDir,'truth.txt'))
+    return IO,Domain(IO.ObsData),ReachTruth(IO.TruthData)
+
+def MakeObs(name,*args,**kwargs):
+    # ReachObservations, without its printout
+    IO,D,Truth=ReadData(name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        Obs=ReachObservations(D,IO.ObsData,*args,**kwargs)
+    return Obs,D,Truth
+
+@pytest.fixture(scope='session',params=list(DataSets))
+def data(request):
+    return ReadData(request.param)
+
+@pytest.fixture(scope='session',params=list(DataSets))
+def obs(request):
+    # MetroMan-style dA from the raw observations
+    return MakeObs(request.param,False,0,0)
@@ -0,0 +1,209 @@
+import io
+import copy
+import contextlib
+import warnings
+
+import numpy as np
+import pytest
+
+from Domain import Domain
+from ReachObservations import ReachObservations,SSE_outer,SolveInnerKKT,AreaFit,area,\
+    MapPointsToHypsometricCurve,CalcAreaFit,CalcBreakpointsDP
+from conftest import MakeObs,ReadData
+
+def Breakpoints(h):
+    # the initial breakpoints CalcAreaFit uses, at a third and two thirds of the range
+    return np.nanmin(h)+np.array([1,2])/3*(np.nanmax(h)-np.nanmin(h))
+
+# trust-constr warns about its quasi-Newton updates on these small problems
+@pytest.mark.filterwarnings('ignore::UserWarning')
+def test_kkt_inner_fit_matches_trust_constr(obs):
+    Obs,D,Truth=obs
+    for r in range(D.nR):
+        igood=np.isfinite(Obs.h[r])&np.isfinite(Obs.w[r])
+        h,w=Obs.h[r,igood],Obs.w[r,igood]
+        xbreak=Breakpoints(h)
+
+        J_tc,p_tc=SSE_outer(xbreak,h,w,True,Obs.sigh,Obs.sigw,False,'trust-constr')
+        J_kkt,p=SSE_outer(xbreak,h,w,True,Obs.sigh,Obs.sigw,False,'kkt')
+
+        # the same or a better objective, with the constraints met exactly
+        assert J_kkt <= J_tc*(1+1e-6)+1e-9
+        assert np.all(p[0::2] >= 0)
+        for i,x in enumerate(xbreak):
+            assert np.isclose(p[2*i]*x+p[2*i+1],p[2*i+2]*x+p[2*i+3])
+
+def test_area_engine_matches_area():
+    Obs,D,Truth=MakeObs('PepsiSac',True,1,1)
+    for r,area_fits in enumerate(Obs.area_fits):
+        if area_fits is None:
+            continue
+        # the observations, and some below the lowest and above the highest breakpoint
+        h_break=np.ravel(area_fits['h_break'])
+        h=np.concatenate((Obs.hobs[r],[h_break[0]-1,h_break[-1]+1]))
+        w=np.concatenate((Obs.wobs[r],[np.nanmin(Obs.wobs[r]),np.nanmax(Obs.wobs[r])]))
+        expected=np.array([area(hi,wi,area_fits) for hi,wi in zip(h,w)],dtype=float).T
+        got=np.array(AreaFit(area_fits).area(h,w))
+        assert np.allclose(got,expected,rtol=1e-10,atol=1e-8,equal_nan=True)
+
+def test_update_area_fit_matches_refit():
+    # fit all but the last few overpasses, then add those one at a time
+    IO,D,Truth=ReadData('PepsiSac')
+    full=IO.ObsData
+    k=4
+    part=copy.deepcopy(full)
+    for key in ('h','w','S'):
+        part[key]=full[key][:,:-k]
+    part['nt']=full['nt']-k
+    with contextlib.redirect_stdout(io.StringIO()):
+        Obs=ReachObservations(Domain(part),part,True,1,1,AreaFitEngine='kkt')
+
+    for r in range(D.nR):
+        nobs=int(Obs.area_fits[r]['h_w_nobs'])
+        for t in range(full['nt']-k,full['nt']):
+            area_fit=Obs.UpdateAreaFit(full['h'][r,t],full['w'][r,t],r)
+        # a missing width does not count as an observation
+        area_fit=Obs.UpdateAreaFit([full['h'][r,-1],np.nan],[full['w'][r,-1],np.nan],r)
+        assert area_fit['h_w_nobs'] == nobs+k+1
+
+        # the same fit as solving with all of the data at the same breakpoints
+        h=np.append(full['h'][r],full['h'][r,-1])
+        w=np.append(full['w'][r],full['w'][r,-1])
+        igood=np.isfinite(h)&np.isfinite(w)
+        Hbp=area_fit['h_break'][1:-1,0]
+        J,HWparams=SolveInnerKKT(Hbp,h[igood],w[igood],Obs.sigh,Obs.sigw)
+        assert np.allclose(np.ravel(area_fit['fit_coeffs'][:,:,0],order='F'),HWparams,rtol=1e-6,atol=1e-8)
+
+        # the end breakpoints cover the projected heights, as in ConstrainHW
+        hhat=MapPointsToHypsometricCurve(full['h'][r,-k:],full['w'][r,-k:],
+                area_fit['fit_coeffs'][:,:,0],area_fit['h_break'][:,0],Obs.sigh,Obs.sigw)[0]
+        assert area_fit['h_break'][0,0] <= np.nanmin(hhat)+1e-9
+        assert area_fit['h_break'][-1,0] >= np.nanmax(hhat)-1e-9
+
+def test_eiv_projection_per_reach():
+    # the batched EIV projection gives each reach the residual spread of its own line.
+    #   a reach with no data gets nan, without a warning
+    IO,D,Truth=ReadData('PepsiSac')
+    RiverData=copy.deepcopy(IO.ObsData)
+    RiverData['h'][1,:]=np.nan
+    with contextlib.redirect_stdout(io.StringIO()),warnings.catch_warnings():
+        warnings.simplefilter('error')
+        Obs=ReachObservations(D,RiverData)
+
+    assert Obs.stdh_LOChat.shape == (D.nR,) and Obs.stdw_LOChat.shape == (D.nR,)
+    assert np.isnan(Obs.stdh_LOChat[1]) and np.isnan(Obs.stdw_LOChat[1])
+    for r in (0,2):
+        x,y=RiverData['h'][r],RiverData['w'][r]
+        xn=(x-x.mean())/np.ptp(x)
+        yn=(y-y.mean())/np.ptp(y)
+        m,b=Obs.FitEIV(xn,yn)
+        mo=-1/m
+        hhat=((yn-mo*xn-b)/(m-mo))*np.ptp(x)+x.mean()
+        assert np.isclose(Obs.stdh_LOChat[r],np.std(x-hhat))
+
+def FullerCost(h,w,sigh,sigw):
+    # the ratio-of-variances misfit of one line through h,w, slope >= 0
+    mXX,mYY,mXY=np.var(h),np.var(w),np.mean((h-h.mean())*(w-w.mean()))
+    delta=sigw**2/sigh**2
+    b=((mYY-delta*mXX)+((mYY-delta*mXX)**2+4*delta*mXY**2)**0.5)/(2*mXY) if mXY > 0 else 0.
+    return len(h)*max(mYY-2*b*mXY+b**2*mXX,0.)/(sigw**2+b**2*sigh**2)
+
+def test_dp_breakpoints_match_brute_force():
+    # three lines of different slope, few enough points to try every pair of cuts
+    rng=np.random.default_rng(4)
+    h=np.sort(rng.uniform(0,3,21))
+    w=np.where(h<1,10*h,np.where(h<2,10+40*(h-1),50+5*(h-2)))+rng.normal(0,0.5,h.size)
+    sigh,sigw=0.1,0.5
+    def Cost(i,j):
+        return sum(FullerCost(h[a:b],w[a:b],sigh,sigw) for a,b in ((0,i),(i,j),(j,h.size)))
+    best=min(Cost(i,j) for i in range(3,h.size-5) for j in range(i+3,h.size-2))
+
+    Hbp=CalcBreakpointsDP(h,w,3,sigh,sigw)
+    i,j=np.searchsorted(h,Hbp)
+    assert np.isclose(Cost(i,j),best,rtol=1e-9)
+
+def test_dp_breakpoints_fall_back_with_too_few_data():
+    # fewer than three observations per sub-domain: equal-spaced breakpoints, and still a fit
+    h=np.array([1.,2.,3.,4.,5.])
+    w=10*h
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        Hbp=CalcBreakpointsDP(h,w,3,0.1,1.)
+        area_fit,Hbp_fit,HWparams=CalcAreaFit(h,w,0.1,1.,4)
+    assert 'not enough data' in out.getvalue()
+    assert np.allclose(Hbp,[1+4/3,1+8/3])
+    assert np.allclose(Hbp_fit,Hbp)
+    assert area_fit['fit_coeffs'].shape == (2,3,1)
+    assert np.all(np.isfinite(HWparams))
+
+@pytest.mark.parametrize('nsd',[2,4])
+def test_dp_area_fit_layout(nsd):
+    # any number of sub-domains gives an area_fit that ConstrainHW and area() accept
+    Obs,D,Truth=MakeObs('PepsiSac',True,4,1,AreaFitSubDomains=nsd)
+    for r,area_fits in enumerate(Obs.area_fits):
+        assert area_fits['fit_coeffs'].shape == (2,nsd,1)
+        assert area_fits['h_break'].shape == (nsd+1,1)
+        assert area_fits['w_break'].shape == (nsd+1,1)
+        assert np.all(np.diff(area_fits['h_break'][:,0]) > 0)
+
+        expected=np.array([area(hi,wi,area_fits) for hi,wi in zip(Obs.hobs[r],Obs.wobs[r])],dtype=float).T
+        got=np.array(AreaFit(area_fits).area(Obs.hobs[r],Obs.wobs[r]))
+        assert np.allclose(got,expected,rtol=1e-10,atol=1e-8,equal_nan=True)
+
+    assert np.all((Obs.hw_subdomain >= 0) & (Obs.hw_subdomain < nsd))
+    assert np.all(np.isfinite(Obs.h)) and np.all(np.isfinite(Obs.dA))
+
+def test_batched_projection_matches_scalar():
+    # the one-pass projection puts every point where MapPointToHypsometricCurve does,
+    #   including the points that fall back to the nearest breakpoint
+    Obs,D,Truth=MakeObs('PepsiSac',False,1,1,AreaFitEngine='kkt')
+    rng=np.random.default_rng(6)
+    nfallback=0
+    for r,area_fits in enumerate(Obs.area_fits):
+        h_break=area_fits['h_break'][:,0]
+        wmin,wmax=np.nanmin(Obs.wobs[r]),np.nanmax(Obs.wobs[r])
+        h=np.concatenate((Obs.hobs[r],rng.uniform(h_break[0]-1,h_break[-1]+1,200)))
+        w=np.concatenate((Obs.wobs[r],rng.uniform(2*wmin-wmax,2*wmax-wmin,200)))
+        hhat,what,isd,fallback=MapPointsToHypsometricCurve(h,w,area_fits['fit_coeffs'][:,:,0],
+                                                           h_break,Obs.sigh,Obs.sigw)
+        Obs.area_fit=area_fits
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            expected=np.array([np.ravel(Obs.MapPointToHypsometricCurve(hi,wi)) for hi,wi in zip(h,w)])
+        assert out.getvalue().count('did not map') == np.count_nonzero(fallback)
+        assert np.allclose(hhat,expected[:,0],rtol=1e-12,atol=1e-10)
+        assert np.allclose(what,expected[:,1],rtol=1e-12,atol=1e-10)
+        nfallback+=np.count_nonzero(fallback)
+    assert nfallback > 0
+
+@pytest.mark.parametrize('PoolType,AreaFitEngine',[('process','kkt'),('thread','kkt'),('process','trust-constr')])
+def test_pooled_area_fits_match_serial(PoolType,AreaFitEngine):
+    # the reaches are fit independently, so the worker pool changes nothing
+    serial=MakeObs('PepsiSac',True,1,1,AreaFitEngine=AreaFitEngine)[0]
+    pooled=MakeObs('PepsiSac',True,1,1,AreaFitEngine=AreaFitEngine,nWorkers=2,PoolType=PoolType)[0]
+    for fit,expected in zip(pooled.area_fits,serial.area_fits):
+        assert fit.keys() == expected.keys()
+        for key in expected:
+            assert np.array_equal(fit[key],expected[key],equal_nan=True)
+    assert np.array_equal(pooled.Hbp,serial.Hbp) and np.array_equal(pooled.HWparams,serial.HWparams)
+    assert np.array_equal(pooled.dA,serial.dA,equal_nan=True)
+
+def test_area_fit_counts_good_pairs():
+    # h_w_nobs counts the height-width pairs the fit used, in the first fit and in updates
+    IO,D,Truth=ReadData('PepsiSac')
+    RiverData=copy.deepcopy(IO.ObsData)
+    RiverData['w'][0,0:5]=np.nan
+    RiverData['h'][0,5]=np.nan
+    with contextlib.redirect_stdout(io.StringIO()):
+        Obs=ReachObservations(D,RiverData,True,1,1,AreaFitEngine='kkt')
+    nobs=np.count_nonzero(np.isfinite(RiverData['h'][0])&np.isfinite(RiverData['w'][0]))
+    assert Obs.area_fits[0]['h_w_nobs'] == nobs
+    assert Obs.area_fits[1]['h_w_nobs'] == D.nt
+
+    area_fit=Obs.UpdateAreaFit([RiverData['h'][0,-1],np.nan],[RiverData['w'][0,-1],1.],0)
+    assert area_fit['h_w_nobs'] == nobs+1
+
+def test_update_area_fit_without_fits():
+    # with CalcAreaFitOpt=0 there is nothing to update: a message, and None
+    Obs,D,Truth=MakeObs('PepsiSac',False,0,0)
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        assert Obs.UpdateAreaFit(Obs.hobs[0,-1],Obs.wobs[0,-1],0) is None
+    assert 'no height-width fit for reach 0' in out.getvalue()
@@ -0,0 +1,59 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from BatchCalibration import BatchCalibration,MakeJobs,BLASThreadVars,BLASThreadEnviron,LimitBLASThreads,\
+    DefaultWorkers
+from FlowLaws import MWACN,AHGW,MOMMA
+from conftest import MakeObs
+
+def WorkerEnviron(i):
+    return [os.environ.get(var) for var in BLASThreadVars]
+
+def test_workers_get_one_blas_thread(monkeypatch):
+    for var in BLASThreadVars:
+        monkeypatch.delenv(var,raising=False)
+    assert DefaultWorkers() == (os.cpu_count() or 1)
+
+    with BLASThreadEnviron(), ProcessPoolExecutor(max_workers=2,initializer=LimitBLASThreads) as pool:
+        for values in pool.map(WorkerEnviron,range(4)):
+            assert values == ['1']*len(BLASThreadVars)
+
+    # the parent's environment is left as it was
+    assert all(var not in os.environ for var in BLASThreadVars)
+
+def test_blas_threads_set_by_user_are_kept(monkeypatch):
+    monkeypatch.setenv('OMP_NUM_THREADS','2')
+    assert DefaultWorkers() == max(1,(os.cpu_count() or 1)//2)
+    with BLASThreadEnviron():
+        assert os.environ['OMP_NUM_THREADS'] == '2'
+        assert os.environ['MKL_NUM_THREADS'] == '1'
+    assert 'MKL_NUM_THREADS' not in os.environ
+
+def test_telemetry_summary_totals_the_attempts():
+    Obs,D,Truth=MakeObs('PepsiSac',False,0,0)
+    jobs=MakeJobs(Obs,Truth,{'Constant-n':MWACN,'AHG':AHGW,'MOMMA':MOMMA},reaches=[0,1])
+    batch=BatchCalibration(D,jobs,nWorkers=1)
+    batch.Calibrate()
+
+    # one row per attempt of each job
+    telemetry=batch.telemetry
+    for (r,variant),rows in telemetry.groupby(['reach','variant']):
+        assert list(rows['attempt']) == list(range(len(rows)))
+    assert len(telemetry) >= len(jobs)
+
+    summary=batch.TelemetrySummary()
+    assert summary['attempts'].sum() == len(telemetry)
+    for (variant,method),row in summary.iterrows():
+        rows=telemetry[(telemetry['variant'] == variant) & (telemetry['method'] == method)]
+        assert row['attempts'] == len(rows)
+        assert row['successes'] == rows['success'].sum()
+        assert row['nfev'] == rows['nfev'].sum() and row['njev'] == rows['njev'].sum()
+        assert np.isclose(row['time'],rows['time'].sum())
+        assert np.isclose(row['mean_time'],rows['time'].mean())
+        assert row['success_rate'] == row['successes']/row['attempts']
+    assert summary.loc[('AHG','polyfit'),'attempts'] == 2
+
+    by_method=batch.TelemetrySummary(by=('method',))
+    assert by_method['nfev'].sum() == telemetry['nfev'].sum()
@@ -0,0 +1,71 @@
+import io
+import contextlib
+
+import numpy as np
+
+import FlowLawCalibration as FLC
+from FlowLawCalibration import FlowLawCalibration
+from FlowLaws import MWACN
+from ResultCache import ResultCache
+from CalibrationScheduler import CalibrationScheduler
+from conftest import MakeObs
+
+def Calibrate(D,FlowLaw,Qtrue,**kwargs):
+    cal=FlowLawCalibration(D,Qtrue,FlowLaw)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cal.CalibrateReach(verbose=False,**kwargs)
+    return cal
+
+def test_cache_round_trip(tmp_path,monkeypatch):
+    Obs,D,Truth=MakeObs('PepsiSac',False,0,0)
+    FlowLaw=MWACN.FromReachObservations(Obs,0)
+    Cache=ResultCache(str(tmp_path))
+
+    cal=Calibrate(D,FlowLaw,Truth.Q[0],Cache=Cache,CacheLabel=(0,'MWACN'))
+    assert cal.success and not cal.CacheHit
+
+    cached=Calibrate(D,FlowLaw,Truth.Q[0],Cache=Cache,CacheLabel=(0,'MWACN'))
+    assert cached.CacheHit and cached.Telemetry == []
+    assert np.array_equal(cached.param_est,cal.param_est)
+    assert np.array_equal(cached.Qhat,cal.Qhat)
+    assert cached.Performance.RMSE == cal.Performance.RMSE
+
+    # new data: no hit, but a warm start from the last calibration of the reach
+    Qtrue=Truth.Q[0]*1.01
+    warm=Calibrate(D,FlowLaw,Qtrue,Cache=Cache,CacheLabel=(0,'MWACN'))
+    cold=Calibrate(D,FlowLaw,Qtrue)
+    assert not warm.CacheHit and warm.success
+    assert sum(r['nfev'] for r in warm.Telemetry) < sum(r['nfev'] for r in cold.Telemetry)
+
+    # a new version of the code does not reuse old results
+    monkeypatch.setattr(FLC,'CalibrationVersion',FLC.CalibrationVersion+1)
+    assert not Calibrate(D,FlowLaw,Truth.Q[0],Cache=Cache).CacheHit
+
+def test_failed_warm_start(tmp_path,monkeypatch):
+    # when nothing works from the warm start, the restart from GetInitParams is cached
+    #   under the key with the warm start, and the scheduler gets both sets of attempts
+    Obs,D,Truth=MakeObs('PepsiSac',False,0,0)
+    FlowLaw=MWACN.FromReachObservations(Obs,0)
+    Cache=ResultCache(str(tmp_path))
+    Scheduler=CalibrationScheduler(MinAttempts=100)
+    init_params=np.array(FlowLaw.GetInitParams())*[2,1.5]
+
+    RunStrategy=FlowLawCalibration.RunStrategy
+    def FailWarm(self,strategy,start,lb,ub,verbose=False):
+        res=RunStrategy(self,strategy,start,lb,ub,verbose)
+        if np.allclose(start,np.clip(init_params,lb,ub)):
+            res.success=False
+            self.Telemetry[-1]['success']=False
+        return res
+    monkeypatch.setattr(FlowLawCalibration,'RunStrategy',FailWarm)
+
+    cal=Calibrate(D,FlowLaw,Truth.Q[0],init_params=init_params,Cache=Cache,Scheduler=Scheduler)
+    assert cal.success
+    nstrategies=len(FLC.UniqueStrategies(FLC.DefaultStrategies))
+    assert len(cal.Telemetry) == nstrategies+1
+    attempts=sum(stat['attempts'] for stat in Scheduler.stats['MWACN'].values())
+    assert attempts == len(cal.Telemetry) and Scheduler.ncalibrations['MWACN'] == 1
+
+    again=Calibrate(D,FlowLaw,Truth.Q[0],init_params=init_params,Cache=Cache,Scheduler=Scheduler)
+    assert again.CacheHit
+    assert np.array_equal(again.param_est,cal.param_est)
@@ -0,0 +1,32 @@
+from CalibrationScheduler import CalibrationScheduler
+from FlowLawCalibration import DefaultStrategies
+
+def Record(method,success,time=1.):
+    return {'method':method,'nfev':1,'njev':1,'time':time,'objective':0.,'success':success,
+            'status':0,'message':''}
+
+def test_update_records_strategies_only():
+    Scheduler=CalibrationScheduler()
+    Scheduler.Update('MOMMA',[Record('polyfit',False),Record('varpro least_squares',False),
+                              Record('multi-start least_squares',True)])
+    assert Scheduler.stats == {} and Scheduler.ncalibrations == {}
+
+    Scheduler.Update('MOMMA',[Record('varpro least_squares',False),Record('least_squares',False),
+                              Record('L-BFGS-B',True)])
+    assert set(Scheduler.stats['MOMMA']) == {'least_squares','L-BFGS-B'}
+    assert Scheduler.ncalibrations['MOMMA'] == 1
+
+def test_order_follows_success_rate(tmp_path):
+    Scheduler=CalibrationScheduler(str(tmp_path/'sched.json'),MinAttempts=3)
+    telemetry=[Record('least_squares',False),Record('L-BFGS-B',False),Record('trust-constr',True)]
+    for i in range(2):
+        Scheduler.Update('MWAVN',telemetry)
+        assert Scheduler.Order('MWAVN',DefaultStrategies) == DefaultStrategies
+    Scheduler.Update('MWAVN',telemetry)
+    assert Scheduler.Order('MWAVN',DefaultStrategies)[0]['name'] == 'trust-constr'
+    # other flow laws keep the given order
+    assert Scheduler.Order('MWACN',DefaultStrategies) == DefaultStrategies
+
+    Scheduler.Save()
+    Loaded=CalibrationScheduler(str(tmp_path/'sched.json'),MinAttempts=3)
+    assert Loaded.Order('MWAVN',DefaultStrategies) == Scheduler.Order('MWAVN',DefaultStrategies)
@@ -0,0 +1,90 @@
+import io
+import contextlib
+
+import numpy as np
+import pytest
+
+from FlowLaws import FlowLaws,MWACN,SplitParams
+from FlowLawCalibration import FlowLawCalibration
+from CalibrationUncertainty import CalibrationUncertainty
+from conftest import MakeObs
+
+class LinearLaw(FlowLaws):
+    # Q=a+b*W: a linear least squares problem, whose resampling covariance is known
+    def CalcQ(self,params):
+        params=SplitParams(params)
+        return params[0]+params[1]*self.W
+    def CalcQJacobianQ(self,params):
+        return self.CalcQ(params),np.column_stack((np.ones_like(self.W),self.W))
+    def GetInitParams(self):
+        return [0.,1.]
+    def GetParamBounds(self):
+        return ( (-np.inf,np.inf), (-np.inf,np.inf) )
+
+def LinearCalibration(n=60,seed=3):
+    # the least squares fit of LinearLaw to synthetic data, as CalibrateReach would give it
+    rng=np.random.default_rng(seed)
+    W=rng.uniform(50,150,n)
+    Qtrue=20+3*W+rng.normal(0,10,n)
+    FlowLaw=LinearLaw(np.zeros(n),W,np.ones(n),np.zeros(n))
+    cal=FlowLawCalibration(None,Qtrue,FlowLaw)
+    X=np.column_stack((np.ones(n),W))
+    cal.param_est=np.linalg.lstsq(X,Qtrue,rcond=None)[0]
+    cal.Qhat=FlowLaw.CalcQ(cal.param_est)
+    cal.success=True
+    return cal,X
+
+def Resample(cal,**kwargs):
+    unc=CalibrationUncertainty(cal,**kwargs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        unc.Run()
+    return unc
+
+def test_jackknife_covariance_of_linear_model():
+    # leaving out overpass i moves the least squares fit by -(X'X)^-1 x_i e_i/(1-h_i)
+    cal,X=LinearCalibration()
+    n=len(X)
+    XtXinv=np.linalg.inv(X.T@X)
+    e=cal.Qtrue-cal.Qhat
+    h=np.einsum('ij,jk,ik->i',X,XtXinv,X)
+    shift=-(X@XtXinv)*(e/(1-h))[:,None]
+    dev=shift-shift.mean(axis=0)
+    expected=(n-1)/n*dev.T@dev
+
+    unc=Resample(cal,Method='jackknife')
+    assert unc.ReplicateSuccess.all()
+    assert np.allclose(unc.ParamReplicates,cal.param_est+shift,rtol=1e-6,atol=1e-8)
+    assert np.allclose(unc.ParamCov,expected,rtol=1e-5)
+
+def test_bootstrap_covariance_of_linear_model():
+    # resampling the overpasses estimates the sandwich covariance (X'X)^-1 X'diag(e^2)X (X'X)^-1,
+    #   to within the sampling error of 400 replicates
+    cal,X=LinearCalibration()
+    XtXinv=np.linalg.inv(X.T@X)
+    e=cal.Qtrue-cal.Qhat
+    sandwich=XtXinv@(X.T*e**2)@X@XtXinv
+
+    unc=Resample(cal,Method='bootstrap',nReplicates=400,seed=7)
+    assert unc.ReplicateSuccess.all()
+    assert np.allclose(np.diag(unc.ParamCov),np.diag(sandwich),rtol=0.2)
+    assert np.isclose(unc.ParamCov[0,1]/np.sqrt(unc.ParamCov[0,0]*unc.ParamCov[1,1]),
+                      sandwich[0,1]/np.sqrt(sandwich[0,0]*sandwich[1,1]),atol=0.05)
+
+    # and the percentile intervals cover the estimate
+    assert np.all(unc.ParamInterval[0] < cal.param_est) and np.all(cal.param_est < unc.ParamInterval[1])
+
+@pytest.mark.parametrize('Method',['bootstrap','jackknife'])
+def test_pooled_replicates_match_serial(Method):
+    # each replicate draws its own sample from the seed, so a pool changes nothing
+    Obs,D,Truth=MakeObs('PepsiSac',False,0,0)
+    cal=FlowLawCalibration(D,Truth.Q[0],MWACN.FromReachObservations(Obs,0))
+    with contextlib.redirect_stdout(io.StringIO()):
+        cal.CalibrateReach(verbose=False)
+
+    serial=Resample(cal,Method=Method,nReplicates=24,seed=5)
+    pooled=Resample(cal,Method=Method,nReplicates=24,seed=5,nWorkers=2)
+    for name in ('ParamReplicates','ReplicateSuccess','ParamCov','ParamInterval','QhatBand'):
+        assert np.array_equal(getattr(serial,name),getattr(pooled,name),equal_nan=True),name
+
+    other=Resample(cal,Method=Method,nReplicates=24,seed=6)
+    assert np.array_equal(other.ParamInterval,serial.ParamInterval) == (Method == 'jackknife')
@@ -0,0 +1,19 @@
+import numpy as np
+
+def test_u_operator_matches_dense(data):
+    IO,D,Truth=data
+    U=D.CalcU()
+    Uop=D.CalcUOperator()
+    Usparse=D.CalcUSparse()
+
+    rng=np.random.default_rng(0)
+    x=rng.standard_normal(U.shape[1])
+    X=rng.standard_normal((U.shape[1],3))
+    y=rng.standard_normal(U.shape[0])
+
+    assert Uop.shape == U.shape
+    assert np.allclose(Uop @ x,U @ x)
+    assert np.allclose(Uop.matmat(X),U @ X)
+    assert np.allclose(Uop.rmatvec(y),U.T @ y)
+    assert np.allclose(Uop.T @ y,U.T @ y)
+    assert np.array_equal(Usparse.toarray(),U)
@@ -0,0 +1,175 @@
+import io
+import contextlib
+
+import numpy as np
+import pytest
+
+import FlowLaws
+import FlowLawCalibration as FLC
+from FlowLawCalibration import FlowLawCalibration
+from conftest import MakeObs
+from test_flow_laws import TestParams
+
+# the flow laws with a linear parameter, and more than one parameter, i.e. those VarPro applies to
+VarProNames=[name for name in ['MWACN','MWAPN','MWAVN','MWHCN','AHGW','AHGD','MOMMA','MWHFN','PVK','AHGD_field']
+             if getattr(FlowLaws,name).LinearParam is not None]
+
+@pytest.fixture(scope='module')
+def pepsi():
+    return MakeObs('PepsiSac',False,0,0)
+
+def Calibrate(D,FlowLaw,Qtrue,**kwargs):
+    cal=FlowLawCalibration(D,Qtrue,FlowLaw)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cal.CalibrateReach(verbose=False,**kwargs)
+    return cal
+
+def Projection(D,FlowLaw,Qtrue,bounds):
+    cal=FlowLawCalibration(D,Qtrue,FlowLaw)
+    cal.LinearParamBounds=bounds
+    cal.VPParams=None
+    return cal
+
+@pytest.mark.parametrize('name',VarProNames)
+def test_varpro_objective_is_full_sse(pepsi,name):
+    # at the linear parameter EvalResVP solves for, its residuals are those of the full 
+    #   parameter vector, that parameter is the least squares one, and the jacobian 
+    #   includes its change with the other parameters
+    Obs,D,Truth=pepsi
+    FlowLaw=getattr(FlowLaws,name).FromReachObservations(Obs,0)
+    Qtrue=Truth.Q[0]
+    bounds=(-np.inf,np.inf) if FlowLaw.LinearParam == 'direct' else (0.,np.inf)
+    cal=Projection(D,FlowLaw,Qtrue,bounds)
+    for params in TestParams(FlowLaw):
+        params_full,res,J=cal.EvalResVP(params[1:],Qtrue)
+        Q,res_full,sse,grad,JQ=FlowLaw.CalcObjective(params_full,Qtrue)
+        assert np.allclose(res,res_full,rtol=1e-10,atol=1e-8*np.abs(Qtrue).max())
+        assert np.isclose(np.sum(res**2),sse,rtol=1e-10)
+
+        for f in (0.99,1.01):
+            assert FlowLaw.CalcObjective(np.concatenate(([f*params_full[0]],params[1:])),Qtrue)[2] > sse
+
+        for i in range(1,len(params)):
+            dp=1e-6*max(abs(params[i]),1.)
+            pplus,pminus=params[1:].copy(),params[1:].copy()
+            pplus[i-1]+=dp
+            pminus[i-1]-=dp
+            fd=(cal.EvalResVP(pplus,Qtrue)[1]-cal.EvalResVP(pminus,Qtrue)[1])/(2*dp)
+            assert np.allclose(J[:,i-1],fd,rtol=1e-4,atol=1e-6*np.abs(J).max()), (name,i)
+
+# MOMMA's fit on this reach has some negative discharge, which ErrorStats warns about
+@pytest.mark.filterwarnings('ignore:invalid value encountered in log:RuntimeWarning')
+@pytest.mark.parametrize('name',VarProNames)
+def test_varpro_linear_parameter_within_bounds(pepsi,name):
+    # with the least squares linear parameter outside its bounds, the nearest bound is used
+    Obs,D,Truth=pepsi
+    FlowLaw=getattr(FlowLaws,name).FromReachObservations(Obs,0)
+    Qtrue=Truth.Q[0]
+    params=TestParams(FlowLaw)[1]
+    free=(-np.inf,np.inf) if FlowLaw.LinearParam == 'direct' else (0.,np.inf)
+    p0=Projection(D,FlowLaw,Qtrue,free).EvalResVP(params[1:],Qtrue)[0][0]
+    for bounds in ((2*p0,3*p0),(p0/3,p0/2)):
+        params_full,res,J=Projection(D,FlowLaw,Qtrue,bounds).EvalResVP(params[1:],Qtrue)
+        assert bounds[0] <= params_full[0] <= bounds[1]
+        assert np.isclose(params_full[0],bounds[0] if bounds[0] > p0 else bounds[1],rtol=1e-12)
+        assert np.allclose(res,FlowLaw.CalcQ(params_full)-Qtrue)
+
+    # and the calibration keeps all of its parameters within GetParamBounds
+    cal=Calibrate(D,FlowLaw,Qtrue,VarPro=True)
+    lb,ub=cal.GetParamBoundArrays()
+    assert cal.success
+    assert np.all(cal.param_est >= lb) and np.all(cal.param_est <= ub)
+
+def test_varpro_falls_back_to_full_problem(pepsi,monkeypatch):
+    # a projection that does not give a usable linear parameter is dropped, and the 
+    #   calibration carries on with all of the parameters, as without VarPro
+    Obs,D,Truth=pepsi
+    FlowLaw=FlowLaws.MWAPN.FromReachObservations(Obs,0)
+    Qtrue=Truth.Q[0]
+    EvalResVP=FlowLawCalibration.EvalResVP
+    def Invalid(self,params_nonlin,Q):
+        params,res,J=EvalResVP(self,params_nonlin,Q)
+        return np.concatenate(([np.nan],params[1:])),res,J
+    monkeypatch.setattr(FlowLawCalibration,'EvalResVP',Invalid)
+
+    cal=Calibrate(D,FlowLaw,Qtrue,VarPro=True)
+    full=Calibrate(D,FlowLaw,Qtrue)
+    assert cal.success and not cal.VarPro
+    assert cal.Telemetry[0]['method'] == 'varpro least_squares' and not cal.Telemetry[0]['success']
+    assert [r['method'] for r in cal.Telemetry[1:]] == [r['method'] for r in full.Telemetry]
+    assert np.array_equal(cal.param_est,full.param_est)
+
+def MultiStart(D,FlowLaw,Qtrue,**kwargs):
+    cal=FlowLawCalibration(D,Qtrue,FlowLaw)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cal.CalibrateReachMultiStart(**kwargs)
+    return cal
+
+@pytest.mark.parametrize('name',['MWACN','MOMMA'])
+def test_multistart_same_for_any_workers(pepsi,name):
+    # the starts are taken in order whatever the pool, so the result does not change
+    Obs,D,Truth=pepsi
+    FlowLaw=getattr(FlowLaws,name).FromReachObservations(Obs,0)
+    serial=MultiStart(D,FlowLaw,Truth.Q[0],nStarts=8)
+    pooled=MultiStart(D,FlowLaw,Truth.Q[0],nStarts=8,nWorkers=2)
+    assert serial.success == pooled.success
+    assert np.array_equal(serial.param_est,pooled.param_est)
+    assert len(serial.MultiStartResults) == len(pooled.MultiStartResults)
+    for a,b in zip(serial.MultiStartResults,pooled.MultiStartResults):
+        assert np.array_equal(a[0],b[0]) and np.array_equal(a[1],b[1]) and a[2:] == b[2:]
+    assert [r['nfev'] for r in serial.Telemetry] == [r['nfev'] for r in pooled.Telemetry]
+
+def test_multistart_stops_when_starts_agree(pepsi):
+    # MWACN has one minimum, so the first nAgree solves agree and the rest are dropped
+    Obs,D,Truth=pepsi
+    FlowLaw=FlowLaws.MWACN.FromReachObservations(Obs,0)
+    cal=MultiStart(D,FlowLaw,Truth.Q[0],nStarts=16,nAgree=3)
+    assert cal.success
+    assert len(cal.MultiStartResults) < 16 and len(cal.Telemetry) == len(cal.MultiStartResults)
+    best=min(result[2] for result in cal.MultiStartResults if result[3])
+    assert sum(result[2] <= best*(1+1e-6) for result in cal.MultiStartResults if result[3]) >= 3
+
+    single=Calibrate(D,FlowLaw,Truth.Q[0])
+    assert np.sum((cal.Qhat-Truth.Q[0])**2) <= np.sum((single.Qhat-Truth.Q[0])**2)*(1+1e-6)
+
+@pytest.mark.parametrize('Sampler',['lhs','sobol'])
+@pytest.mark.parametrize('name',['MWACN','MWAPN','MWHCN','AHGD','MOMMA','PVK'])
+def test_multistart_starts_within_start_bounds(pepsi,name,Sampler):
+    Obs,D,Truth=pepsi
+    FlowLaw=getattr(FlowLaws,name).FromReachObservations(Obs,0)
+    lb,ub=FlowLaw.GetStartBounds()
+    starts=FLC.DrawStarts(lb,ub,15,Sampler,seed=1)
+    assert starts.shape == (15,len(lb))
+    assert np.all(starts >= lb) and np.all(starts <= ub)
+    assert len(np.unique(starts,axis=0)) == 15
+
+    cal=MultiStart(D,FlowLaw,Truth.Q[0],nStarts=16,nAgree=16,Sampler=Sampler,seed=1)
+    used=np.array([result[0] for result in cal.MultiStartResults])
+    assert len(used) == 16
+    assert np.allclose(used[0],np.clip(FlowLaw.GetInitParams(),*cal.GetParamBoundArrays()))
+    assert np.all(used >= lb) and np.all(used <= ub)
+
+def test_every_attempt_is_recorded(pepsi):
+    # a strategy cut short after one iteration fails, and the next one is tried: both 
+    #   attempts are in the telemetry, in order
+    Obs,D,Truth=pepsi
+    FlowLaw=FlowLaws.MWAPN.FromReachObservations(Obs,0)
+    Qtrue=Truth.Q[0]
+    Strategies=[{'name':'L-BFGS-B one step','solver':'minimize','method':'L-BFGS-B','options':{'maxiter':1}},
+                {'name':'least_squares','solver':'least_squares'}]
+    cal=Calibrate(D,FlowLaw,Qtrue,Strategies=Strategies)
+
+    assert cal.success and cal.Method == 'least_squares'
+    assert [record['method'] for record in cal.Telemetry] == ['L-BFGS-B one step','least_squares']
+    assert [record['success'] for record in cal.Telemetry] == [False,True]
+    for record in cal.Telemetry:
+        assert set(record) == {'method','nfev','njev','time','objective','success','status','message'}
+        assert isinstance(record['nfev'],int) and record['nfev'] > 0
+        assert record['time'] > 0
+    assert np.isclose(cal.Telemetry[-1]['objective'],np.sum((cal.Qhat-Qtrue)**2))
+
+    # the polyfit shortcut and the variable projection are recorded too
+    AHGW=Calibrate(D,FlowLaws.AHGW.FromReachObservations(Obs,0),Qtrue)
+    assert AHGW.Telemetry[0]['method'] == 'polyfit' and AHGW.Telemetry[0]['nfev'] == 0
+    VarPro=Calibrate(D,FlowLaw,Qtrue,VarPro=True)
+    assert [record['method'] for record in VarPro.Telemetry] == ['varpro least_squares']
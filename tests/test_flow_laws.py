@@ -0,0 +1,174 @@
+import io
+import copy
+import contextlib
+
+import numpy as np
+import pytest
+
+import FlowLaws
+from ReachObservations import ReachObservations,CalcdAMetroMan,dAMetroManPartials
+
+# every flow law in FlowLaws
+FlowLawNames=['MWACN','MWAPN','MWAVN','MWHCN','AHGW','AHGD','MOMMA','MWHFN','PVK','AHGD_field']
+
+def ReachFlowLaws(Obs,name):
+    FlowLaw=getattr(FlowLaws,name)
+    for r in range(Obs.D.nR):
+        yield r,FlowLaw.FromReachObservations(Obs,r)
+
+def TestParams(FlowLaw):
+    # the initial parameters, and a point a tenth of the way from there to the middle 
+    #   of the start bounds, so the check is not only made at round numbers
+    init_params=np.asarray(FlowLaw.GetInitParams(),dtype=float)
+    lb,ub=FlowLaw.GetStartBounds()
+    return [init_params,init_params+0.1*((lb+ub)/2-init_params)]
+
+@pytest.mark.parametrize('name',FlowLawNames)
+def test_jacobian_matches_finite_differences(obs,name):
+    Obs,D,Truth=obs
+    for r,FlowLaw in ReachFlowLaws(Obs,name):
+        for params in TestParams(FlowLaw):
+            Q,JQ=FlowLaw.CalcQJacobianQ(params)
+            assert JQ.shape == (D.nt,len(params))
+            assert np.allclose(Q,FlowLaw.CalcQ(params))
+            assert FlowLaw.CheckJacobianQ(params) < 1e-4, (name,r,params)
+
+@pytest.mark.parametrize('name',FlowLawNames)
+def test_objective_gradient(obs,name):
+    # the gradient CalibrateReach gives the minimize fallbacks matches the jacobian
+    Obs,D,Truth=obs
+    for r,FlowLaw in ReachFlowLaws(Obs,name):
+        params=np.asarray(FlowLaw.GetInitParams(),dtype=float)
+        Q,res,sse,grad,JQ=FlowLaw.CalcObjective(params,Truth.Q[r])
+        assert np.isclose(sse,np.sum((FlowLaw.CalcQ(params)-Truth.Q[r])**2))
+        assert np.allclose(grad,2*JQ.T @ res)
+        assert np.allclose(grad,FlowLaw.Jacobian(params,Truth.Q[r]))
+
+@pytest.mark.parametrize('name',FlowLawNames)
+def test_observation_jacobian_matches_finite_differences(obs,name):
+    Obs,D,Truth=obs
+    for r,FlowLaw in ReachFlowLaws(Obs,name):
+        for params in TestParams(FlowLaw):
+            assert FlowLaw.CheckObsJacobian(params=params) < 1e-4, (name,r,params)
+
+def test_metroman_area_partials(obs):
+    # dAMetroManPartials against finite differences of CalcdAMetroMan, one overpass at a
+    #   time: the same-overpass derivatives, and the variance from the other overpasses
+    Obs,D,Truth=obs
+    h,w=Obs.h[0],Obs.w[0]
+    sigh,sigw=0.1,5.
+    dAdH,dAdW,dAVarH,dAVarW=dAMetroManPartials(h,w,sigh,sigw)
+
+    nt=len(h)
+    Jh=np.zeros((nt,nt))
+    Jw=np.zeros((nt,nt))
+    for t in range(nt):
+        for J,x,dx in ((Jh,h,1e-4),(Jw,w,1e-2)):
+            xplus,xminus=x.copy(),x.copy()
+            xplus[t]+=dx
+            xminus[t]-=dx
+            if x is h:
+                J[:,t]=(CalcdAMetroMan(xplus,w)-CalcdAMetroMan(xminus,w))/(2*dx)
+            else:
+                J[:,t]=(CalcdAMetroMan(h,xplus)-CalcdAMetroMan(h,xminus))/(2*dx)
+
+    assert np.allclose(dAdH,np.diag(Jh))
+    assert np.allclose(dAdW,np.diag(Jw))
+    other=1-np.eye(nt)
+    assert np.allclose(dAVarH,((Jh*other)**2).sum(axis=1)*sigh**2)
+    assert np.allclose(dAVarW,((Jw*other)**2).sum(axis=1)*sigw**2)
+
+def FiniteDifferenceGradient(f,params,rel_step=1e-6):
+    grad=np.zeros(len(params))
+    for i in range(len(params)):
+        dp=rel_step*max(abs(params[i]),1.)
+        pplus,pminus=params.copy(),params.copy()
+        pplus[i]+=dp
+        pminus[i]-=dp
+        grad[i]=(f(pplus)-f(pminus))/(2*dp)
+    return grad
+
+@pytest.mark.parametrize('name',FlowLawNames)
+def test_cached_terms_follow_replaced_observations(obs,name):
+    # replacing dA, W, S and H clears the cached observation terms: Q, its jacobian and 
+    #   the objective gradient are those of a flow law built on the new observations, and
+    #   still match finite differences
+    Obs,D,Truth=obs
+    FlowLaw=getattr(FlowLaws,name).FromReachObservations(Obs,0)
+    FlowLaw.CalcQJacobianQ(np.asarray(FlowLaw.GetInitParams(),dtype=float))
+    for r in range(1,D.nR):
+        FlowLaw.dA,FlowLaw.W,FlowLaw.S,FlowLaw.H=Obs.dA[r],Obs.w[r],Obs.S[r],Obs.h[r]
+        Fresh=getattr(FlowLaws,name).FromReachObservations(Obs,r)
+        for params in TestParams(Fresh):
+            Q,JQ=FlowLaw.CalcQJacobianQ(params)
+            Qf,JQf=Fresh.CalcQJacobianQ(params)
+            assert np.array_equal(Q,Qf,equal_nan=True) and np.array_equal(JQ,JQf,equal_nan=True)
+            assert FlowLaw.CheckJacobianQ(params) < 1e-4, (name,r,params)
+
+            Q,res,sse,grad,JQ=FlowLaw.CalcObjective(params,Truth.Q[r])
+            fd=FiniteDifferenceGradient(lambda p: FlowLaw.CalcObjective(p,Truth.Q[r])[2],params)
+            assert np.allclose(grad,fd,rtol=1e-4,atol=1e-6*np.abs(grad).max()), (name,r,params)
+
+@pytest.mark.parametrize('name',FlowLawNames)
+def test_parameter_matrix_rows_match_vectors(obs,name):
+    # CalcQ of a (P,nparams) matrix gives, in each row, CalcQ of that row's parameters
+    Obs,D,Truth=obs
+    for r,FlowLaw in ReachFlowLaws(Obs,name):
+        lb,ub=FlowLaw.GetStartBounds()
+        params=np.vstack(TestParams(FlowLaw)+[lb+(ub-lb)*f for f in (0.25,0.5,0.75)])
+        Q=FlowLaw.CalcQ(params)
+        assert Q.shape == (len(params),D.nt)
+        for row,p in zip(Q,params):
+            assert np.allclose(row,FlowLaw.CalcQ(p),rtol=1e-12,atol=0,equal_nan=True), (name,r,p)
+
+def test_mwavn_invalid_rows_are_inf(obs):
+    # RHS is positive for real widths, so W**2 is made negative here to reach the RHS <= 0
+    #   check: only the parameter sets with RHS <= 0 somewhere give inf
+    Obs,D,Truth=obs
+    FlowLaw=FlowLaws.MWAVN.FromReachObservations(Obs,0)
+    FlowLaw.obs['W2']=-FlowLaw.obs['W2']
+    params=np.asarray(FlowLaw.GetInitParams(),dtype=float)
+    A=params[1]+FlowLaw.dA
+    p2max=np.sqrt(6/5*np.min(A**2/np.abs(FlowLaw.obs['W2'])))
+    params=np.vstack([params]*4)
+    params[:,2]=[0.5*p2max,2*p2max,0.,10*p2max]
+
+    Q=FlowLaw.CalcQ(params)
+    invalid=np.array([False,True,False,True])
+    assert np.all(np.isinf(Q[invalid]))
+    assert np.all(np.isfinite(Q[~invalid]))
+    for row,p in zip(Q,params):
+        assert np.array_equal(row,np.broadcast_to(FlowLaw.CalcQ(p),row.shape))
+
+@pytest.mark.parametrize('name',FlowLawNames)
+def test_reach_block_matches_single_reaches(data,name):
+    # one flow law on the (nR,nt) block of all reaches gives, row by row, the discharge 
+    #   and objective of the single reach flow laws, with the missing observations left out
+    IO,D,Truth=data
+    RiverData=copy.deepcopy(IO.ObsData)
+    RiverData['h'][0,3:6]=np.nan
+    RiverData['w'][-1,0]=np.nan
+    with contextlib.redirect_stdout(io.StringIO()):
+        Obs=ReachObservations(D,RiverData)
+
+    Block=getattr(FlowLaws,name).FromReachObservations(Obs)
+    igood=Block.GetObsMask()
+    assert np.array_equal(igood,np.isfinite(Obs.dA)&np.isfinite(Obs.w)&np.isfinite(Obs.S)&np.isfinite(Obs.h))
+    assert not igood[0,3:6].any() and not igood[-1,0]
+
+    # the single reach flow laws, on all of the reach's overpasses and on the good ones
+    Reaches=[getattr(FlowLaws,name).FromReachObservations(Obs,r) for r in range(D.nR)]
+    Good=[getattr(FlowLaws,name)(Obs.dA[r,g],Obs.w[r,g],Obs.S[r,g],Obs.h[r,g]) for r,g in enumerate(igood)]
+    params=Block.GetInitParamBlock()
+    assert params.shape == (D.nR,len(Reaches[0].GetInitParams()))
+    for r,FlowLaw in enumerate(Reaches):
+        assert np.allclose(np.asarray(FlowLaw.GetInitParams(),dtype=float),params[r],rtol=1e-12)
+
+    for block_params in (params,np.vstack([TestParams(FlowLaw)[1] for FlowLaw in Reaches])):
+        Q=Block.CalcQ(block_params)
+        assert Q.shape == (D.nR,D.nt)
+        sse=np.sum(np.where(igood,Q-Truth.Q,0.)**2,axis=1)
+        for r in range(D.nR):
+            g=igood[r]
+            assert np.allclose(Q[r],Reaches[r].CalcQ(block_params[r]),rtol=1e-12,equal_nan=True)
+            assert np.isclose(sse[r],Good[r].CalcObjective(block_params[r],Truth.Q[r,g])[2],rtol=1e-10)
@@ -0,0 +1,79 @@
+import io
+import contextlib
+
+import numpy as np
+import pytest
+
+from FlowLaws import MWACN
+from FlowLawCalibration import FlowLawCalibration
+from ObservationEnsemble import ObservationEnsemble
+from conftest import MakeObs
+
+@pytest.fixture(scope='module')
+def calibrated():
+    Obs,D,Truth=MakeObs('PepsiSac',False,0,0)
+    cals=[]
+    for r in range(D.nR):
+        cal=FlowLawCalibration(D,Truth.Q[r],MWACN.FromReachObservations(Obs,r))
+        with contextlib.redirect_stdout(io.StringIO()):
+            cal.CalibrateReach(verbose=False)
+        cals.append(cal)
+    return Obs,cals
+
+def FixedMembers(monkeypatch,Q):
+    # CalcQMembers hands each ensemble the members of Q in order, whatever the chunk size
+    given={}
+    def CalcQMembers(self,rng,k):
+        n=given[id(self)]=given.get(id(self),0)+k
+        return Q[n-k:n].copy()
+    monkeypatch.setattr(ObservationEnsemble,'CalcQMembers',CalcQMembers)
+
+@pytest.mark.parametrize('ChunkSize',[1,7])
+def test_chunked_quantiles_match_one_chunk(calibrated,monkeypatch,ChunkSize):
+    # the same members in small chunks: quantiles from the histogram are within a bin or
+    #   two of the exact ones, and the mean and standard deviation are the same
+    Obs,cals=calibrated
+    K=1200
+    Q=ObservationEnsemble(Obs,cals,K=K).CalcQMembers(np.random.default_rng(1),K)
+    FixedMembers(monkeypatch,Q)
+
+    Exact=ObservationEnsemble(Obs,cals,K=K,ChunkSize=K)
+    Exact.Run()
+    with np.errstate(invalid='ignore'):
+        assert np.array_equal(Exact.Qquantiles,np.nanquantile(Q,Exact.Quantiles,axis=0),equal_nan=True)
+
+    Chunked=ObservationEnsemble(Obs,cals,K=K,ChunkSize=ChunkSize,nBins=200,nPilot=400)
+    Chunked.Run()
+    assert Chunked.nPilot == 400
+    assert np.array_equal(Chunked.nValid,Exact.nValid)
+    assert np.allclose(Chunked.Qmean,Exact.Qmean,equal_nan=True)
+    assert np.allclose(Chunked.Qstd,Exact.Qstd,equal_nan=True)
+
+    width=Chunked.HistWidth
+    ok=np.isfinite(Exact.Qquantiles)
+    assert np.array_equal(ok,np.isfinite(Chunked.Qquantiles))
+    assert np.all(np.abs(Chunked.Qquantiles-Exact.Qquantiles)[ok] <= np.broadcast_to(2*width,ok.shape)[ok])
+
+def test_pilot_of_all_members_is_exact(calibrated,monkeypatch):
+    # when the pilot takes every member, there is no histogram at all
+    Obs,cals=calibrated
+    K=300
+    Q=ObservationEnsemble(Obs,cals,K=K).CalcQMembers(np.random.default_rng(2),K)
+    FixedMembers(monkeypatch,Q)
+
+    Ensemble=ObservationEnsemble(Obs,cals,K=K,ChunkSize=7)
+    Ensemble.Run()
+    assert Ensemble.nPilot == K and not hasattr(Ensemble,'HistCounts')
+    with np.errstate(invalid='ignore'):
+        assert np.array_equal(Ensemble.Qquantiles,np.nanquantile(Q,Ensemble.Quantiles,axis=0),equal_nan=True)
+
+def test_one_member_chunks(calibrated):
+    # one member at a time, with the members drawn as usual: the quantiles agree with a
+    #   single chunk run to within the sampling error of 2000 members
+    Obs,cals=calibrated
+    Exact=ObservationEnsemble(Obs,cals,K=2000,ChunkSize=2000)
+    Exact.Run()
+    Chunked=ObservationEnsemble(Obs,cals,K=2000,ChunkSize=1,nBins=200)
+    Chunked.Run()
+    ok=np.isfinite(Exact.Qquantiles)
+    assert np.all((np.abs(Chunked.Qquantiles-Exact.Qquantiles)/Exact.Qstd)[ok] < 0.5)
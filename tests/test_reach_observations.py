@@ -0,0 +1,93 @@
+import io
+import copy
+import contextlib
+
+import numpy as np
+import pytest
+
+from ReachObservations import ReachObservations
+from conftest import ReadData
+
+def Build(D,RiverData,*args,**kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return ReachObservations(D,RiverData,*args,**kwargs)
+
+def test_metroman_dA_bridges_gaps():
+    IO,D,Truth=ReadData('PepsiSac')
+    RiverData=copy.deepcopy(IO.ObsData)
+    RiverData['h'][0,5:8]=np.nan
+    RiverData['w'][2,10]=np.nan
+    RiverData['h'][1,0]=np.nan
+    Obs=Build(D,RiverData)
+    Full=Build(D,IO.ObsData)
+
+    igood=np.isfinite(RiverData['h'])&np.isfinite(RiverData['w'])
+    assert np.array_equal(np.isnan(Obs.dA),~igood)
+
+    # at the good overpasses, dA is the trapezoid sum over the good overpasses only,
+    #   i.e. the dA of the record with the gaps taken out
+    for r in range(D.nR):
+        g=igood[r]
+        h,w=RiverData['h'][r,g],RiverData['w'][r,g]
+        dA=np.concatenate(([0.],np.cumsum((w[1:]+w[:-1])/2*np.diff(h))))
+        assert np.allclose(Obs.dA[r,g],dA)
+
+    # reaches without gaps are unchanged
+    for r in range(3,D.nR):
+        assert np.array_equal(Obs.dA[r],Full.dA[r])
+
+Products=['h','w','hobs','wobs','hv','Sv','wv','dA','dAv','DeltaAHatv','stdh_LOChat','stdw_LOChat',
+          'hw_subdomain','hw_fallback','Hbp','HWparams']
+
+@pytest.mark.filterwarnings('ignore::UserWarning')
+@pytest.mark.parametrize('CalcAreaFitOpt',[0,1,2,3,4])
+def test_lazy_matches_eager(CalcAreaFitOpt):
+    IO,D,Truth=ReadData('PepsiSac')
+    args=(CalcAreaFitOpt > 0,CalcAreaFitOpt,int(CalcAreaFitOpt > 0))
+    Eager=Build(D,IO.ObsData,*args,AreaFitEngine='kkt')
+    Lazy=Build(D,IO.ObsData,*args,AreaFitEngine='kkt',Lazy=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name in Products:
+            if hasattr(Eager,name):
+                assert np.array_equal(getattr(Lazy,name),getattr(Eager,name),equal_nan=True),name
+            else:
+                assert not hasattr(Lazy,name),name
+        if CalcAreaFitOpt > 0:
+            for fit,expected in zip(Lazy.area_fits,Eager.area_fits):
+                for key in expected:
+                    assert np.array_equal(fit[key],expected[key],equal_nan=True)
+        else:
+            assert not hasattr(Lazy,'area_fits')
+
+def test_lazy_copies_only_when_constraining():
+    IO,D,Truth=ReadData('PepsiSac')
+    RiverData=copy.deepcopy(IO.ObsData)
+    h,w=RiverData['h'].copy(),RiverData['w'].copy()
+
+    # without the constraint, h and w are views of the input
+    Obs=Build(D,RiverData,Lazy=True)
+    Obs.dA
+    assert np.shares_memory(Obs.h,RiverData['h']) and np.shares_memory(Obs.w,RiverData['w'])
+
+    # with it, they are copied before they are changed, and the input is left alone
+    Obs=Build(D,RiverData,True,1,1,AreaFitEngine='kkt',Lazy=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        Obs.dA
+    assert not np.shares_memory(Obs.h,RiverData['h']) and not np.shares_memory(Obs.w,RiverData['w'])
+    assert not np.array_equal(Obs.h,h)
+    assert np.array_equal(RiverData['h'],h) and np.array_equal(RiverData['w'],w)
+
+def test_lazy_step_reruns_after_failure(monkeypatch):
+    # a step that raises is not marked done, so the next access runs it again
+    IO,D,Truth=ReadData('PepsiSac')
+    Obs=Build(D,IO.ObsData,True,1,1,AreaFitEngine='kkt',Lazy=True)
+    CalcAllAreaFits=ReachObservations.CalcAllAreaFits
+    def Fail(self):
+        raise RuntimeError('interrupted')
+    monkeypatch.setattr(ReachObservations,'CalcAllAreaFits',Fail)
+    with pytest.raises(RuntimeError):
+        Obs.area_fits
+    monkeypatch.setattr(ReachObservations,'CalcAllAreaFits',CalcAllAreaFits)
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert len(Obs.area_fits) == D.nR
+    assert np.all(np.isfinite(Obs.dA))
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+
+from ResultCache import ResultCache
+from conftest import MakeObs
+
+def test_round_trip(tmp_path):
+    Cache=ResultCache(str(tmp_path))
+    result={'params':np.array([0.03,120.]),'success':True}
+    key=Cache.MakeKey('test',np.arange(3.),(1,'a'))
+
+    assert Cache.Load(key) is None
+    Cache.Save(key,result)
+    loaded=Cache.Load(key)
+    assert np.array_equal(loaded['params'],result['params']) and loaded['success']
+    assert (Cache.hits,Cache.misses) == (1,1)
+
+    # the key depends on the contents, the dtype and the shape of arrays
+    assert key != Cache.MakeKey('test',np.arange(3),(1,'a'))
+    assert key != Cache.MakeKey('test',np.arange(3.).reshape(3,1),(1,'a'))
+
+    # a cache opened on the same directory finds the entry
+    assert ResultCache(str(tmp_path)).Load(key) is not None
+
+def test_eviction_keeps_recently_used(tmp_path):
+    Cache=ResultCache(str(tmp_path),MaxBytes=1e4)
+    keys=[Cache.MakeKey(i) for i in range(40)]
+    for i,key in enumerate(keys):
+        Cache.Save(key,np.full(100,float(i)))
+        # file times can be coarse
+        os.utime(Cache.Path(key),(i,i))
+        # use the first entry, so it stays
+        if i > 0:
+            assert Cache.Load(keys[0]) is not None
+            os.utime(Cache.Path(keys[0]),(i+0.5,i+0.5))
+
+    ondisk=sum(entry[1] for entry in Cache.Entries())
+    assert Cache.nbytes == ondisk <= Cache.MaxBytes
+    assert Cache.Load(keys[0]) is not None
+    assert Cache.Load(keys[-1]) is not None
+    assert Cache.Load(keys[1]) is None
+
+    # replacing an entry does not count it twice
+    nbytes=Cache.nbytes
+    Cache.Save(keys[-1],np.full(100,-1.))
+    assert Cache.nbytes == nbytes
+
+def test_save_does_not_rescan(tmp_path,monkeypatch):
+    # below MaxBytes a save only looks at its own entry
+    Cache=ResultCache(str(tmp_path))
+    scans=[]
+    monkeypatch.setattr(os,'scandir',lambda path: scans.append(path) or iter(()))
+    for i in range(20):
+        Cache.Save(Cache.MakeKey(i),np.arange(10.))
+    assert scans == []
+
+def test_area_fit_cache(tmp_path):
+    Cache=ResultCache(str(tmp_path))
+    Obs,D,Truth=MakeObs('PepsiSac',True,1,1,AreaFitCache=Cache)
+    assert Cache.hits == 0 and Cache.misses == D.nR
+
+    Cached,D,Truth=MakeObs('PepsiSac',True,1,1,AreaFitCache=Cache)
+    assert Cache.hits == D.nR
+    for fit,cached in zip(Obs.area_fits,Cached.area_fits):
+        assert fit.keys() == cached.keys()
+        for name in fit:
+            assert np.array_equal(fit[name],cached[name],equal_nan=True)
+    assert np.array_equal(Obs.dA,Cached.dA,equal_nan=True)